@@ -1,5 +1,2 @@
-from bme680 import BME680
-from ccs811 import CCS811
-from htu21d import HTU21D
-from k30 import K30
-
+# Drivers are not imported here.  "from i2c import sgp30" or registry.get()
+# loads one when it is used, so sensd only pays for the sensors it runs.
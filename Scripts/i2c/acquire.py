@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#
+# Acquisition cycle for sensd
+# Raspberry Pi
+#
+# Holds the periodic driver jobs and runs the ones due on a tick in one
+# of three ways:
+#
+#   SERIAL    one after the other, each sleeping through its own waits
+#   OVERLAP   all measure commands first, each result read back once its
+#             own conversion time has passed (steps.run_all)
+#   SCHEDULED handed to the bus scheduler thread (sched.py)
+#
+# Once the jobs of a tick are done whatever they published is committed
+# to the hub, which writes the node snapshot (hub.py).
+#
+# Each job has its own cadence, every so many periods, and the absolute
+# clock.now() deadline of its next run, so a slow tick or the wall clock
+# being set does not shift the schedule.  sleep() waits for the earliest
+# deadline and returns at once when the loop is behind.  A job that has
+# fallen a whole cadence or more behind is handled by the overrun policy:
+#
+#   SKIP      run it once and drop the runs it missed
+#   CATCH_UP  make the missed runs up on the following ticks, at most
+#             CATCH_UP_MAX of them
+#   SHED      as SKIP, and while the loop is a whole period behind the low
+#             priority jobs are not run at all until it has caught up
+#
+# Every job counts its runs, the runs started a period or more late and
+# the deadlines it missed, see stats() and report().
+#
+from . import clock
+from . import hub
+from . import sched
+from . import steps
+
+SERIAL    = "serial"
+OVERLAP   = "overlap"
+SCHEDULED = "sched"
+
+MODES = ( SERIAL, OVERLAP, SCHEDULED )
+
+SKIP     = "skip"
+CATCH_UP = "catchup"
+SHED     = "shed"
+
+POLICIES = ( SKIP, CATCH_UP, SHED )
+
+CATCH_UP_MAX = 10     # missed runs a job makes up, older ones are dropped
+
+
+#-----------------------------------------------------------------------------
+# A periodic driver job
+#-----------------------------------------------------------------------------
+class Job:
+
+    def __init__(self, name, steps, every, device, priority):
+        self.name = name
+        self.steps = steps         # callable returning a step generator
+        self.every = every         # periods between runs
+        self.device = device
+        self.priority = priority
+        self.next = None           # clock time the next run is due, set on the first tick
+        self.runs = 0
+        self.late = 0              # runs started a period or more after their deadline
+        self.missed = 0            # deadlines dropped without a run
+
+
+#-----------------------------------------------------------------------------
+# Acquisition cycle
+#-----------------------------------------------------------------------------
+class Acquirer:
+
+    def __init__(self, mode=OVERLAP, scheduler=None, hub=hub.HUB, period=1.0, policy=SKIP):
+        if mode not in MODES:
+            raise ValueError("acquire mode '{}' should be one of {}".format(mode, MODES))
+        if policy not in POLICIES:
+            raise ValueError("acquire policy '{}' should be one of {}".format(policy, POLICIES))
+
+        self.mode = mode
+        self.period = period
+        self.policy = policy
+        self.jobs = []
+        self.count = 0
+        self.overruns = 0     # ticks that took longer than a period
+        self.shed = 0         # low priority runs dropped while behind
+        self.finished = {}    # job name -> clock time its last run completed
+        self.hub = hub
+
+        self.scheduler = scheduler
+        if mode == SCHEDULED and scheduler is None:
+            self.scheduler = sched.Scheduler()
+            self.scheduler.start()
+
+    #-----------------------------------------------------------------------------
+    # Add a job, jobs due on the same tick are started in the order added
+    #-----------------------------------------------------------------------------
+    def add(self, name, steps, every=1, device=None, priority=sched.PRIO_NORMAL):
+        self.jobs.append( Job(name, steps, every, device, priority) )
+
+    # a job first runs every - 1 periods after the first tick, as it did
+    # when ticks were counted, and is due from half a period before its
+    # deadline so a tick a little early is not a whole period late
+    def due(self, now):
+        jobs = []
+        for job in self.jobs:
+            if job.next is None:
+                job.next = now + (job.every - 1) * self.period
+            if job.next <= now + self.period / 2:
+                jobs.append(job)
+        return jobs
+
+    #-----------------------------------------------------------------------------
+    # Move the deadlines of the due jobs on, by the overrun policy
+    #-----------------------------------------------------------------------------
+    def _schedule(self, jobs, now):
+        run = []
+        behind = jobs and now - min([ job.next for job in jobs ]) >= self.period
+        for job in jobs:
+            cadence = job.every * self.period
+            # deadlines passed, this one included
+            owed = int((now + self.period / 2 - job.next) // cadence) + 1
+            if now - job.next >= self.period:
+                job.late += 1
+            if self.policy == SHED and behind and job.priority == sched.PRIO_LOW:
+                job.missed += owed
+                job.next += owed * cadence
+                self.shed += 1
+                continue
+            if self.policy == CATCH_UP:
+                dropped = max(0, owed - 1 - CATCH_UP_MAX)
+                job.missed += dropped
+                job.next += (dropped + 1) * cadence
+            else:
+                job.missed += owed - 1
+                job.next += owed * cadence
+            job.runs += 1
+            run.append(job)
+        return run
+
+    # until the earliest deadline, not at all when a job is already due
+    def sleep(self):
+        if not self.jobs:
+            clock.sleep(self.period)
+            return
+        deadlines = [ job.next for job in self.jobs if job.next is not None ]
+        if len(deadlines) == len(self.jobs):
+            clock.sleep(min(deadlines) - clock.now())
+
+    #-----------------------------------------------------------------------------
+    # Run one tick, returns { job name: result } for the jobs that ran
+    #-----------------------------------------------------------------------------
+    def tick(self, period=None):
+        if period is None:
+            period = self.period
+        self.count += 1
+        began = clock.now()
+        jobs = self._schedule(self.due(began), began)
+        results = {}
+
+        if self.mode == SERIAL:
+            for job in jobs:
+                results[job.name] = steps.run( job.steps() )
+                self.finished[job.name] = clock.now()
+
+        elif self.mode == OVERLAP:
+            gens = [ job.steps() for job in jobs ]
+            devices = [ job.device for job in jobs ]
+            finished = [ None ] * len(jobs)
+            for i, result in enumerate( steps.run_all(gens, devices, finished) ):
+                results[jobs[i].name] = result
+                self.finished[jobs[i].name] = finished[i]
+
+        else:
+            # jobs at the tick rate have to be done before the next tick
+            deadline = clock.now() + period
+            pending = []
+            for job in jobs:
+                due_by = None
+                if job.every == 1:
+                    due_by = deadline
+                xact = self.scheduler.submit( job.steps(), job.priority, due_by, job.device )
+                pending.append( ( job, xact ) )
+            for job, xact in pending:
+                results[job.name] = xact.wait()
+                self.finished[job.name] = xact.finished_at
+
+        self.hub.commit()
+        if clock.now() - began > period:
+            self.overruns += 1
+        return results
+
+    #-----------------------------------------------------------------------------
+    # Counters, per job and for the loop
+    #-----------------------------------------------------------------------------
+    def stats(self):
+        info = { "policy": self.policy,
+                 "ticks": self.count,
+                 "overruns": self.overruns,
+                 "shed": self.shed,
+                 "jobs": {} }
+        for job in self.jobs:
+            info["jobs"][job.name] = { "runs": job.runs, "late": job.late, "missed": job.missed }
+        return info
+
+    def report(self):
+        info = self.stats()
+        print "acquire: %s ticks: %d overruns: %d shed: %d" % \
+            ( info["policy"], info["ticks"], info["overruns"], info["shed"] )
+        for job in self.jobs:
+            j = info["jobs"][job.name]
+            if j["late"] or j["missed"]:
+                print "acquire: %s runs: %d late: %d missed: %d" % \
+                    ( job.name, j["runs"], j["late"], j["missed"] )
+
+#-----------------------------------------------------------------------------
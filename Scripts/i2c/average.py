@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Moving average over the last N samples
+# Raspberry Pi
+#
+# Replaces the per driver buffer lists that were re-summed on every
+# publish.  The sum is kept as samples come and go, and only the samples
+# actually seen count, so there is no start up skew from a buffer full of
+# zeros or seed values.
+#
+import array
+import math
+
+
+#-----------------------------------------------------------------------------
+# Ring buffer with a running sum
+#-----------------------------------------------------------------------------
+class RingAverager(object):
+    __slots__ = ( "size", "values", "pos", "count", "total" )
+
+    def __init__(self, size):
+        self.size = size
+        self.values = array.array("d", [ 0.0 ]) * size
+        self.reset()
+
+    def reset(self):
+        self.pos = 0
+        self.count = 0      # valid samples, up to size
+        self.total = 0.0
+
+    def add(self, value):
+        values = self.values
+        pos = self.pos
+        if self.count < self.size:
+            self.count += 1
+            self.total += value
+        else:
+            self.total += value - values[pos]
+        values[pos] = value
+
+        pos += 1
+        if pos == self.size:
+            pos = 0
+            # once per lap, so rounding in the running sum can't build up
+            if self.count == self.size:
+                self.total = math.fsum(values)
+        self.pos = pos
+
+    # None until the first sample
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def full(self):
+        return self.count == self.size
+
+    def __len__(self):
+        return self.count
+
+#-----------------------------------------------------------------------------
@@ -13,16 +13,33 @@
 #
 #------------------------------------------------------------------------------
 from .bme680const import *
+import json
 import math
-import time
-
-from smbus import SMBus
+import zlib
+
+from ..average import RingAverager
+from ..busmgr import BUSES
+from ..channel import Channel
+from .. import clock
+from .. import evloop
+from .. import registry
+from .. import hub
+from ..htu21d.htu21d import abs_humidity
+from .. import steps
 import os
 
 I2CBUS = 1
 
 BME680_MAX = 60
-BME680_MAX_FLOAT = 60.0
+
+# configuration registers kept in the register cache, ( start, length )
+# heater set points and waits 0x5a-0x6d, gas/hum/meas/filter 0x70-0x75
+SHADOW_BLOCKS = ( ( RES_HEAT0_ADDR, 20 ), ( CONF_HEAT_CTRL_ADDR, 6 ) )
+
+# register/value pairs per block write, 1 + 31 bytes fills an smbus block
+MAX_PAIRS = 16
+
+OS_CYCLES = [ 0, 1, 2, 4, 8, 16 ]
 
 
 #------------------------------------------------------------------------------
@@ -36,17 +53,26 @@ class BME680(BME680Data):
     Gas, pressure, temperature and humidity sensor.
 
     :param i2c_addr: One of I2C_ADDR_PRIMARY (0x76) or I2C_ADDR_SECONDARY (0x77)
-    :param i2c_device: Optional smbus or compatible instance for facilitating i2c communications.
+    :param bus: i2c bus number
+    :param directory: Where the channels are written, /tmp/<name> by default
 
     """
+
+    # acquisition jobs and how sensd reports the main one, see registry.py
+    JOBS = ( ( "", "task_steps", 1, "normal" ), )
+    REPORT = None
+    # channel -> ( job publishing it, runs of that job per publish )
+    PUBLISHES = { "": ( "", 20 ) }
     
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def __init__(self, name, i2c_addr=I2C_ADDR_PRIMARY):
+    def __init__(self, name, i2c_addr=I2C_ADDR_PRIMARY, bus=I2CBUS, directory=None, average=BME680_MAX):
         BME680Data.__init__(self)
 
         self.i2c_addr = i2c_addr
+        self.I2Caddr = i2c_addr     # as the other drivers have it
+        self.bus = bus
         #self._i2c = i2c_device
         #if self._i2c is None:
         #    import smbus
@@ -57,36 +83,54 @@ class BME680(BME680Data):
             raise RuntimeError("BME680 Not Found. Invalid CHIP ID: 0x{0:02x}".format(self.chip_id))
 
 
-        directory = "/tmp/" + name
+        if directory is None:
+            directory = "/tmp/" + name
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        self.FptrTC = directory + "/tc"
-        self.FptrRH = directory + "/rh"
-        self.FptrHPA = directory + "/hpa"
-        self.FptrRES = directory + "/res"
+        # T, RH and AH are what the VOC sensors compensate with
+        self.tc = Channel(directory, "tc", "%.1f", quantity=hub.TEMPERATURE)
+        self.rh = Channel(directory, "rh", "%.1f", quantity=hub.HUMIDITY)
+        self.ah = Channel(directory, "ah", "%.1f", quantity=hub.ABS_HUMIDITY)
+        self.hpa = Channel(directory, "hpa", "%.2f")
+        self.res = Channel(directory, "res", "%.1f")
+        # parsed calibration, survives sensd restarts but not a reboot
+        self.FptrCalib = directory + "/.calib"
         
         
-        self.tc_buff = [0] * BME680_MAX
-        self.rh_buff = [0] * BME680_MAX
-        self.hpa_buff = [0] * BME680_MAX
-        self.res_buff = [0] * BME680_MAX
+        # 1 minute moving averages
+        self.tc_avg = RingAverager(average)
+        self.rh_avg = RingAverager(average)
+        self.hpa_avg = RingAverager(average)
+        self.res_avg = RingAverager(average)
         self.ptr = 0
-        self.init_buffs = 1
+
+        # register cache, see _set_bits() and flush()
+        self.shadow = {}
+        self.pending = []
+        self.deferred = False
+        self.chip_mode = SLEEP_MODE   # mode bits as last read from the sensor
 
         self.soft_reset()
         self.set_power_mode(SLEEP_MODE)
         self._get_calibration_data()
+
+        # the settings go out together in one block write
+        self.defer_writes()
         self.set_humidity_oversample(OS_2X)
         self.set_pressure_oversample(OS_4X)
         self.set_temperature_oversample(OS_8X)
         self.set_filter(FILTER_SIZE_3)
         self.set_gas_status(ENABLE_GAS_MEAS)
+        self.flush()
         self.task()
 
+        # the heater set point needs the ambient temperature from task()
+        self.defer_writes()
         self.set_gas_heater_temperature(320)
         self.set_gas_heater_duration(150)
         self.select_gas_heater_profile(0)
+        self.flush()
 
 
 
@@ -94,9 +138,18 @@ class BME680(BME680Data):
     #
     #--------------------------------------------------------------------------
     def _get_calibration_data(self):
-        """Retrieves the sensor calibration data and stores it in .calibration_data"""
+        """Retrieves the sensor calibration data and stores it in .calibration_data
+        
+        The second coefficient block identifies the part, when it matches
+        the one saved with the cached calibration the rest is not read.
+
+        """
+        key = self._get_regs(COEFF_ADDR2, COEFF_ADDR2_LEN)
+        if self._load_calibration(key):
+            return
+
         calibration = self._get_regs(COEFF_ADDR1, COEFF_ADDR1_LEN)
-        calibration += self._get_regs(COEFF_ADDR2, COEFF_ADDR2_LEN)
+        calibration += key
 
         heat_range = self._get_regs(ADDR_RES_HEAT_RANGE_ADDR, 1)
         heat_value = twos_comp(self._get_regs(ADDR_RES_HEAT_VAL_ADDR, 1), bits=8)
@@ -104,6 +157,58 @@ class BME680(BME680Data):
 
         self.calibration_data.set_from_array(calibration)
         self.calibration_data.set_other(heat_range, heat_value, sw_error)
+        self._save_calibration(key)
+
+
+    #--------------------------------------------------------------------------
+    #
+    #--------------------------------------------------------------------------
+    def _calibration_checksum(self, cache):
+        """crc32 over everything in the cache file but the checksum"""
+        body = dict(cache)
+        body.pop("checksum", None)
+        return zlib.crc32(json.dumps(body, sort_keys=True).encode("ascii")) & 0xffffffff
+
+    def _save_calibration(self, key):
+        """Write the parsed calibration next to the readings"""
+        params = dict(self.calibration_data.__dict__)
+        params.pop("t_fine", None)
+        cache = { "chip_id": self.chip_id, "key": list(key), "calibration": params }
+        cache["checksum"] = self._calibration_checksum(cache)
+        try:
+            f = open(self.FptrCalib + ".tmp", "w")
+            json.dump(cache, f, sort_keys=True)
+            f.close()
+            os.rename(self.FptrCalib + ".tmp", self.FptrCalib)
+        except:
+            print "bme680._save_calibration() failed"
+
+    def _load_calibration(self, key):
+        """Use the cached calibration if it is intact and for this part"""
+        try:
+            f = open(self.FptrCalib)
+            cache = json.load(f)
+            f.close()
+        except:
+            return False
+
+        try:
+            if cache["checksum"] != self._calibration_checksum(cache):
+                print "bme680._load_calibration() bad checksum"
+                return False
+            if cache["chip_id"] != self.chip_id or cache["key"] != list(key):
+                print "bme680._load_calibration() different part"
+                return False
+            params = cache["calibration"]
+            for name in self.calibration_data.__dict__:
+                if name != "t_fine" and name not in params:
+                    return False
+        except:
+            return False
+
+        for name in params:
+            setattr(self.calibration_data, str(name), params[name])
+        return True
 
     #--------------------------------------------------------------------------
     #
@@ -111,7 +216,8 @@ class BME680(BME680Data):
     def soft_reset(self):
         """Initiate a soft reset"""
         self._set_regs(SOFT_RESET_ADDR, SOFT_RESET_CMD) 
-        time.sleep(RESET_PERIOD / 1000.0)
+        clock.sleep(RESET_PERIOD / 1000.0)
+        self._load_shadow()
 
 
     #--------------------------------------------------------------------------
@@ -136,9 +242,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_humidity_oversample(self):
+    def get_humidity_oversample(self, refresh=False):
         """Get humidity oversampling"""
-        return (self._get_regs(CONF_OS_H_ADDR, 1) & OSH_MSK) >> OSH_POS
+        return (self._get_reg(CONF_OS_H_ADDR, refresh) & OSH_MSK) >> OSH_POS
 
 
     #--------------------------------------------------------------------------
@@ -163,9 +269,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_pressure_oversample(self):
+    def get_pressure_oversample(self, refresh=False):
         """Get pressure oversampling"""
-        return (self._get_regs(CONF_T_P_MODE_ADDR, 1) & OSP_MSK) >> OSP_POS
+        return (self._get_reg(CONF_T_P_MODE_ADDR, refresh) & OSP_MSK) >> OSP_POS
 
     
     #--------------------------------------------------------------------------
@@ -190,9 +296,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_temperature_oversample(self):
+    def get_temperature_oversample(self, refresh=False):
         """Get temperature oversampling"""
-        return (self._get_regs(CONF_T_P_MODE_ADDR, 1) & OST_MSK) >> OST_POS
+        return (self._get_reg(CONF_T_P_MODE_ADDR, refresh) & OST_MSK) >> OST_POS
 
     
     #--------------------------------------------------------------------------
@@ -218,9 +324,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_filter(self):
+    def get_filter(self, refresh=False):
         """Get filter size"""
-        return (self._get_regs(CONF_ODR_FILT_ADDR, 1) & FILTER_MSK) >> FILTER_POS
+        return (self._get_reg(CONF_ODR_FILT_ADDR, refresh) & FILTER_MSK) >> FILTER_POS
 
     #--------------------------------------------------------------------------
     #
@@ -241,9 +347,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_gas_heater_profile(self):
+    def get_gas_heater_profile(self, refresh=False):
         """Get gas sensor conversion profile: 0 to 9"""
-        return self._get_regs(CONF_ODR_RUN_GAS_NBC_ADDR, 1) & NBCONV_MSK
+        return self._get_reg(CONF_ODR_RUN_GAS_NBC_ADDR, refresh) & NBCONV_MSK
 
 
     #--------------------------------------------------------------------------
@@ -257,9 +363,9 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_gas_status(self):
+    def get_gas_status(self, refresh=False):
         """Get the current gas status"""
-        return (self._get_regs(CONF_ODR_RUN_GAS_NBC_ADDR, 1) & RUN_GAS_MSK) >> RUN_GAS_POS
+        return (self._get_reg(CONF_ODR_RUN_GAS_NBC_ADDR, refresh) & RUN_GAS_MSK) >> RUN_GAS_POS
 
 
     #--------------------------------------------------------------------------
@@ -332,19 +438,53 @@ class BME680(BME680Data):
 
         self._set_bits(CONF_T_P_MODE_ADDR, MODE_MSK, MODE_POS, value)
 
-        while blocking and self.get_power_mode() != self.power_mode:
-            time.sleep(POLL_PERIOD_MS / 1000.0)
+        # forced mode runs one conversion and drops back to sleep on its
+        # own, wait that out rather than polling the mode bits
+        if blocking and value == FORCED_MODE and not self.deferred:
+            clock.sleep(self.get_measure_duration())
 
 
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def get_power_mode(self):
-        """Get power mode"""
-        self.power_mode = self._get_regs(CONF_T_P_MODE_ADDR, 1)
+    def get_power_mode(self, refresh=False):
+        """Get power mode
+        
+        The cached mode is the one the sensor settles in, a forced
+        conversion still running only shows with refresh=True.
+
+        """
+        if refresh:
+            self.refresh()
+            self.power_mode = self.chip_mode
+        else:
+            self.power_mode = self.shadow[CONF_T_P_MODE_ADDR] & MODE_MSK
         return self.power_mode
 
 
+    #--------------------------------------------------------------------------
+    #
+    #--------------------------------------------------------------------------
+    def get_measure_duration(self):
+        """Seconds a forced mode conversion takes with the current settings"""
+        ctrl_meas = self.shadow[CONF_T_P_MODE_ADDR]
+        cycles = OS_CYCLES[min(5, (ctrl_meas & OST_MSK) >> OST_POS)]
+        cycles += OS_CYCLES[min(5, (ctrl_meas & OSP_MSK) >> OSP_POS)]
+        cycles += OS_CYCLES[min(5, (self.shadow[CONF_OS_H_ADDR] & OSH_MSK) >> OSH_POS)]
+
+        # Bosch: 1963us per cycle, TPH switching 4 x 477us, gas 5 x 477us,
+        # 500us rounding, plus 1ms to wake up
+        duration = cycles * 1963 + 477 * 4 + 477 * 5 + 500
+        duration = (duration + 500) // 1000 + 1
+
+        run_gas = self.shadow[CONF_ODR_RUN_GAS_NBC_ADDR]
+        if run_gas & RUN_GAS_MSK:
+            wait = self.shadow[GAS_WAIT0_ADDR + (run_gas & NBCONV_MSK)]
+            duration += (wait & 0x3f) * (4 ** (wait >> 6))
+
+        return duration / 1000.0
+
+
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
@@ -354,14 +494,25 @@ class BME680(BME680Data):
         Stores data in .data and returns True upon success.
 
         """
+        return steps.run(self.task_steps())
+
+    def atask(self, loop=None):
+        """task() on an event loop, returns an evloop Task"""
+        return evloop.spawn(self.task_steps(), self.i2c_addr, loop)
+
+    def task_steps(self):
+        """task() as a step generator, yields the new data polling waits"""
+        result = False
         try:
-            self.set_power_mode(FORCED_MODE)
+            self.set_power_mode(FORCED_MODE, blocking=False)
+            yield self.get_measure_duration()
 
+            # in case the conversion runs a little longer than computed
             for attempt in range(10):
                 status = self._get_regs(FIELD0_ADDR, 1)
 
                 if (status & NEW_DATA_MSK) == 0:
-                    time.sleep(POLL_PERIOD_MS / 1000.0)
+                    yield POLL_PERIOD_MS / 1000.0
                     continue
 
                 regs = self._get_regs(FIELD0_ADDR, FIELD_LENGTH)
@@ -390,67 +541,41 @@ class BME680(BME680Data):
                 self.data.humidity = self._calc_humidity(adc_hum) / 1000.0
                 self.data.gas_resistance = self._calc_gas_resistance(adc_gas_res, gas_range)
             
-                # runs first pass only
-                if self.init_buffs :
-                    for i in range(BME680_MAX):
-                        self.tc_buff[i] = self.data.temperature
-                        self.rh_buff[i] = self.data.humidity
-                        self.hpa_buff[i] = self.data.pressure
-                        self.res_buff[i] = self.data.gas_resistance
-                
-                    self.init_buffs = 0    
-                else:        
-                    # maintain buffers for 1 minute moving average
-                    self.tc_buff[self.ptr] = self.data.temperature
-                    self.rh_buff[self.ptr] = self.data.humidity
-                    self.hpa_buff[self.ptr] = self.data.pressure
-                    self.res_buff[self.ptr] = self.data.gas_resistance
+                # maintain 1 minute moving averages
+                self.tc_avg.add(self.data.temperature)
+                self.rh_avg.add(self.data.humidity)
+                self.hpa_avg.add(self.data.pressure)
+                self.res_avg.add(self.data.gas_resistance)
+
+                self.tc.sample(self.data.temperature)
+                self.rh.sample(self.data.humidity)
+                self.ah.sample(abs_humidity(self.data.temperature, self.data.humidity))
+                self.hpa.sample(self.data.pressure)
+                self.res.sample(self.data.gas_resistance)
 
                 # Every 20 seconds update file system
                 if (self.ptr % 20 == 0):
 
-                    avg_tc = 0
-                    avg_rh = 0
-                    avg_hpa = 0
-                    avg_res = 0
-            
-                    for i in range(BME680_MAX):
-                        avg_tc += self.tc_buff[i]
-                        avg_rh += self.rh_buff[i]
-                        avg_hpa += self.hpa_buff[i]
-                        avg_res += self.res_buff[i]
-                
-                    avg_tc /= BME680_MAX_FLOAT
-                    avg_rh /= BME680_MAX_FLOAT
-                    avg_hpa /= BME680_MAX_FLOAT
-                    avg_res /= BME680_MAX_FLOAT
-            
-                    f = open(self.FptrTC,"w")
-                    f.write("%.1f" % avg_tc)
-                    f.close()
-            
-                    f = open(self.FptrRH,"w")
-                    f.write("%.1f" % avg_rh)
-                    f.close()
-            
-                    f = open(self.FptrHPA,"w")
-                    f.write("%.2f" % avg_hpa)
-                    f.close()
-            
-                    f = open(self.FptrRES,"w")
-                    f.write("%.1f" % avg_res)
-                    f.close()
+                    self.tc.publish(self.tc_avg.mean())
+                    self.rh.publish(self.rh_avg.mean())
+                    self.ah.publish(abs_humidity(self.tc_avg.mean(), self.rh_avg.mean()))
+                    self.hpa.publish(self.hpa_avg.mean())
+                    self.res.publish(self.res_avg.mean())
             
                 self.ptr += 1
                 if self.ptr >= BME680_MAX:
                     self.ptr = 0
             
-                return True
+                result = True
+                break
 
-        except:
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "bme680.task() error"
+        except Exception:
             print "bme680.task() error"
             
-        return False    
+        yield steps.Done(result)
 
 
     #--------------------------------------------------------------------------
@@ -458,7 +583,10 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     def _set_bits(self, register, mask, position, value):
         """Mask out and set one or more bits in a register"""
-        temp = self._get_regs(register, 1)
+        if register in self.shadow:
+            temp = self.shadow[register]
+        else:
+            temp = self._get_regs(register, 1)
         temp &= ~mask
         temp |= value << position
         self._set_regs(register, temp)
@@ -469,24 +597,103 @@ class BME680(BME680Data):
     #--------------------------------------------------------------------------
     def _set_regs(self, register, value):
         
-        bus = SMBus(I2CBUS)
+        if isinstance(value, int) and register in self.shadow:
+            self.shadow[register] = value
+            if register not in self.pending:
+                self.pending.append(register)
+            if not self.deferred:
+                self.flush()
+            return
+
+        bus = BUSES.get(self.bus)
         if isinstance(value, int):
             bus.write_byte_data(self.i2c_addr, register, value)
         else:
             bus.write_i2c_block_data(self.i2c_addr, register, value)
-        bus.close()
+
+
+    #--------------------------------------------------------------------------
+    # Register cache
+    #--------------------------------------------------------------------------
+    def defer_writes(self):
+        """Hold cached register writes until flush()"""
+        self.deferred = True
+
+    def flush(self):
+        """Write every changed cached register
+
+        The BME680 takes register/value pairs in one write, so the changes
+        go out as a single block write per MAX_PAIRS registers.  ctrl_meas
+        is written last since it is what applies ctrl_hum and starts a
+        forced conversion.
+
+        """
+        self.deferred = False
+        if not self.pending:
+            return
+
+        regs = sorted(self.pending, key=lambda r: ( r == CONF_T_P_MODE_ADDR, r ))
+        self.pending = []
+
+        bus = BUSES.get(self.bus)
+        for i in range(0, len(regs), MAX_PAIRS):
+            pairs = []
+            for reg in regs[i:i + MAX_PAIRS]:
+                pairs += [ reg, self.shadow[reg] ]
+            if len(pairs) == 2:
+                bus.write_byte_data(self.i2c_addr, pairs[0], pairs[1])
+            else:
+                bus.write_i2c_block_data(self.i2c_addr, pairs[0], pairs[1:])
+
+        # forced mode is a one shot, the sensor is back asleep afterwards
+        self.shadow[CONF_T_P_MODE_ADDR] &= ~MODE_MSK
+
+    def refresh(self):
+        """Re-read the cached registers, returns False if the sensor disagreed
+
+        Pending writes are flushed first.  On a mismatch, e.g. the sensor
+        was reset behind our back, the cache takes the sensor's values.
+
+        """
+        self.flush()
+        old = dict(self.shadow)
+        self._load_shadow()
+        match = True
+        for reg in old:
+            if old[reg] != self.shadow[reg]:
+                match = False
+        if not match:
+            print "bme680.refresh() register cache was stale"
+        return match
+
+    def _load_shadow(self):
+        """Fill the register cache from the sensor, one block read per range"""
+        self.pending = []
+        for start, length in SHADOW_BLOCKS:
+            regs = self._get_regs(start, length)
+            for i in range(length):
+                self.shadow[start + i] = regs[i]
+
+        # a running conversion is not a setting
+        self.chip_mode = self.shadow[CONF_T_P_MODE_ADDR] & MODE_MSK
+        self.shadow[CONF_T_P_MODE_ADDR] &= ~MODE_MSK
+
+    def _get_reg(self, register, refresh=False):
+        """A cached register, re-read from the sensor first with refresh"""
+        if refresh:
+            self.refresh()
+        return self.shadow[register]
 
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
     def _get_regs(self, register, length):
                 
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         if length == 1:
             resp = bus.read_byte_data(self.i2c_addr, register)
         else:
             resp = bus.read_i2c_block_data(self.i2c_addr, register, length)
-        bus.close()
         return resp
 
     #--------------------------------------------------------------------------
@@ -606,3 +813,5 @@ class BME680(BME680Data):
             return int(duration + (factor * 64))
 
         return 0xff
+
+registry.register("bme680", BME680)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# I2C bus handle manager
+# Raspberry Pi
+#
+# Keeps one long lived SMBus handle per i2c bus for the whole process
+# instead of every driver opening and closing /dev/i2c-N around each
+# register access.  A handle is only reopened after a driver reports a
+# bus fault, an IOError or OSError from the bus, and never for an error in
+# the driver's own code, so one driver's bug does not reset the bus under
+# the others.
+#
+# The backend is pluggable: set_backend() takes any SMBus compatible
+# factory plus its i2c_msg class.  With I2C_BACKEND=sim in the environment
+# the in-memory simulator (simbus.py) is used instead of /dev/i2c-N.
+#
+# With I2C_LOCK=1 in the environment, as the sensdsup workers have it, each
+# call on a handle is made holding an flock on the bus' LOCK_PATH, so the
+# processes sharing a bus never interleave their transfers.
+#
+import fcntl
+import os
+import threading
+import time
+
+LOCK_PATH = "/tmp/i2c-%d.lock"
+
+#-----------------------------------------------------------------------------
+# SMBus backend
+#-----------------------------------------------------------------------------
+# smbus2 is preferred, the legacy smbus module has the same block/byte API
+# used by the drivers but no i2c_msg
+def _default_backend():
+    if os.environ.get("I2C_BACKEND") == "sim":
+        from . import simbus
+        return simbus.backend()
+    try:
+        from smbus2 import SMBus, i2c_msg
+    except ImportError:
+        from smbus import SMBus
+        i2c_msg = None
+    return SMBus, i2c_msg
+
+
+#-----------------------------------------------------------------------------
+# A handle whose every call holds the bus lock of other processes out
+#-----------------------------------------------------------------------------
+class LockedBus(object):
+
+    def __init__(self, bus, fd):
+        self.bus = bus
+        self.fd = fd
+
+    def __getattr__(self, name):
+        attr = getattr(self.bus, name)
+        if not callable(attr):
+            return attr
+        fd = self.fd
+
+        def locked(*args, **kwargs):
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        # looked up once per method
+        self.__dict__[name] = locked
+        return locked
+
+
+#-----------------------------------------------------------------------------
+# Process wide bus manager
+#-----------------------------------------------------------------------------
+class BusManager:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.factory = None
+        self.msg = None     # i2c_msg class of the backend
+        self.handles = {}   # bus number -> open SMBus handle
+        self.opens = {}     # bus number -> times the bus was opened
+        self.requests = {}  # bus number -> times a handle was asked for
+        self.faults = {}    # bus number -> times a driver reported an error
+        self.open_time = 0.0    # seconds spent opening buses, backend import included
+        self.locking = os.environ.get("I2C_LOCK") == "1"
+        self.lock_fds = {}  # bus number -> lock file shared with other processes
+        # False reopens the bus on every get(), the old per call behaviour,
+        # only useful for comparing the two
+        self.pooled = True
+
+    #-----------------------------------------------------------------------------
+    # Get the shared handle for a bus, opening it on first use or after a fault
+    #-----------------------------------------------------------------------------
+    def get(self, busnum):
+        with self.lock:
+            self.requests[busnum] = self.requests.get(busnum, 0) + 1
+            bus = self.handles.get(busnum)
+            if bus is not None and not self.pooled:
+                bus.close()
+                bus = None
+            if bus is None:
+                began = time.time()
+                if self.factory is None:
+                    self.factory, self.msg = _default_backend()
+                bus = self.factory(busnum)
+                if self.locking:
+                    bus = LockedBus(bus, self._lock_fd(busnum))
+                self.open_time += time.time() - began
+                self.handles[busnum] = bus
+                self.opens[busnum] = self.opens.get(busnum, 0) + 1
+            return bus
+
+    def _lock_fd(self, busnum):
+        fd = self.lock_fds.get(busnum)
+        if fd is None:
+            fd = os.open(LOCK_PATH % busnum, os.O_RDWR | os.O_CREAT, 0666)
+            self.lock_fds[busnum] = fd
+        return fd
+
+    #-----------------------------------------------------------------------------
+    # Combined transaction messages for i2c_rdwr() from the current backend
+    #-----------------------------------------------------------------------------
+    def read_msg(self, addr, length):
+        return self._msg_class().read(addr, length)
+
+    def write_msg(self, addr, data):
+        return self._msg_class().write(addr, data)
+
+    def _msg_class(self):
+        with self.lock:
+            if self.factory is None:
+                self.factory, self.msg = _default_backend()
+            if self.msg is None:
+                raise IOError("i2c backend has no combined transactions, smbus2 is needed")
+            return self.msg
+
+    #-----------------------------------------------------------------------------
+    # Swap the SMBus backend, open handles are closed first
+    #-----------------------------------------------------------------------------
+    def set_backend(self, factory, msg=None):
+        self.close()
+        with self.lock:
+            self.factory = factory
+            self.msg = msg
+
+    #-----------------------------------------------------------------------------
+    # Drop the handle after an i2c error so the next get() reopens the bus
+    #-----------------------------------------------------------------------------
+    def fault(self, busnum):
+        with self.lock:
+            self.faults[busnum] = self.faults.get(busnum, 0) + 1
+            bus = self.handles.pop(busnum, None)
+        if bus is not None:
+            try:
+                bus.close()
+            except:
+                pass
+
+    #-----------------------------------------------------------------------------
+    # Close every open handle, normally only at process exit
+    #-----------------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            handles = self.handles.values()
+            self.handles = {}
+        for bus in handles:
+            try:
+                bus.close()
+            except:
+                pass
+
+    #-----------------------------------------------------------------------------
+    # Open/request counters per bus, saved is the number of avoided opens
+    #-----------------------------------------------------------------------------
+    def stats(self):
+        with self.lock:
+            info = {}
+            for busnum in self.requests:
+                opens = self.opens.get(busnum, 0)
+                requests = self.requests[busnum]
+                info[busnum] = { "opens": opens,
+                                 "requests": requests,
+                                 "faults": self.faults.get(busnum, 0),
+                                 "saved": requests - opens }
+            return info
+
+    def reset_stats(self):
+        with self.lock:
+            self.opens = {}
+            self.requests = {}
+            self.faults = {}
+
+    def report(self):
+        info = self.stats()
+        for busnum in sorted(info):
+            s = info[busnum]
+            print "busmgr: i2c-%d opens: %d requests: %d faults: %d saved: %d" % \
+                ( busnum, s["opens"], s["requests"], s["faults"], s["saved"] )
+
+
+# shared by every driver in the process
+BUSES = BusManager()
+
+#-----------------------------------------------------------------------------
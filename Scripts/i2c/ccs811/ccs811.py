@@ -9,8 +9,14 @@
 #
 #
 import os
-import time
-from smbus import SMBus
+from ..average import RingAverager
+from ..busmgr import BUSES
+from ..channel import Channel, Input, INPUT_DIR, INPUT_FILES
+from .. import clock
+from .. import evloop
+from .. import registry
+from .. import hub
+from .. import steps
 
 I2CBUS = 1
 
@@ -45,10 +51,8 @@ CCS811_MEAS_MODE_ON  = 0x10 # continuous power, once per second updates
 # Tried every 10 seconds, pulsed mode but readings seemed unstable
 #
 CCS811_T_MAX = 5
-CCS811_T_MAX_FLOAT = 5.0
 #
 CCS811_MAX = 3
-CCS811_MAX_FLOAT = 3.0
 #
 #
 #------------------------------------------------------------------------------
@@ -56,24 +60,42 @@ CCS811_MAX_FLOAT = 3.0
 #------------------------------------------------------------------------------
 class CCS811:
 
-    def __init__(self, name, i2c_addr):
+    # acquisition jobs and how sensd reports the main one, see registry.py
+    JOBS = ( ( "",     "task_steps",      20, "low" ),
+             ( "comp", "comp_task_steps", 60, "normal" ) )
+    REPORT = "%.0f"
+    # channel -> ( job publishing it, runs of that job per publish ), None
+    # for no regular cadence, "" for the other channels
+    PUBLISHES = { "":      ( "", 1 ),
+                  "base":  None,
+                  "error": None }
+    # quantities it compensates with, taken from another sensor (inputs=)
+    COMPENSATES = ( hub.TEMPERATURE, hub.HUMIDITY )
+
+    def __init__(self, name, i2c_addr=CCS811_ADDR, bus=I2CBUS, directory=None, average=CCS811_MAX,
+                 inputs=INPUT_DIR):
         self.I2Caddr   = i2c_addr
+        self.bus       = bus
         
-        directory = "/tmp/" + name
+        if directory is None:
+            directory = "/tmp/" + name
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        self.FptrVoc   = directory + "/voc"
-        self.FptrBase  = directory + "/base"
-        self.FptrError = directory + "/error"
+        self.voc       = Channel( directory, "voc", "%d" )
+        self.base      = Channel( directory, "base", "0x%04x", None )
+        self.error     = Channel( directory, "error", "0x%02x", None )
         
-        # to retreave RH values for compensation
-        self.FptrTemp  = "/tmp/HTU21D/tc"
-        self.FptrHumid = "/tmp/HTU21D/rh"
+        # T & RH for compensation, as HTU21D or BME680 publish them in this
+        # process, or from the files in inputs, the directory of the sensor
+        # providing them, when that runs on its own
+        self.FptrTemp  = inputs + "/" + INPUT_FILES[hub.TEMPERATURE]
+        self.FptrHumid = inputs + "/" + INPUT_FILES[hub.HUMIDITY]
+        self.temp_in   = Input( hub.TEMPERATURE, self.FptrTemp )
+        self.humid_in  = Input( hub.HUMIDITY, self.FptrHumid )
         
         # for maintaining the moving averages
-        self.voc_buff  = [ 0 ] * CCS811_MAX
-        self.voc_ptr   = 0
+        self.voc_avg   = RingAverager( average )
         
         # for tracking baseline value changes
         self.newcal = 0
@@ -81,10 +103,10 @@ class CCS811:
         # to track RH compenation event
         self.comp_minute = CCS811_T_MAX
         # Long term T & RH averaging 
-        self.temp_buff = [ 23 ] * CCS811_T_MAX
-        self.rh_buff = [ 50 ] * CCS811_T_MAX
+        self.temp_avg = RingAverager( CCS811_T_MAX )
+        self.rh_avg = RingAverager( CCS811_T_MAX )
     
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         resp = bus.read_byte_data( self.I2Caddr, CCS811_REG_STATUS )
         print "ccs811.init() status reg: 0x%02x" % resp
         if resp & CCS811_APP_VALID:
@@ -92,10 +114,9 @@ class CCS811:
             print "ccs811.init() starting application"
         else:
             print "ccs811.init() failed to start application"
-            bus.close()
             sys.exit( 10 )
 
-        time.sleep(1)
+        clock.sleep(1)
 
         # Start making measurements
         bus.write_byte_data( self.I2Caddr, CCS811_REG_MEAS_MODE, CCS811_MEAS_MODE_ON )
@@ -126,7 +147,6 @@ class CCS811:
         self.set_comp( temp_c, r_humidity )
         # will implement periodically in loop
         #print "CCS811 init complete"
-        bus.close()
 
     #-----------------------------------------------------------------------------
     # This sets the CCS811 environmental compensation 
@@ -162,9 +182,8 @@ class CCS811:
         print "ccs811.set_comp() set T: %.1f RH: %.1f" % ( t, h )
         print "ccs811.set_comp() regs. 0x%02x 0x%02x 0x%02x 0x%02x" % ( th_i, th_d, rh_i, rh_d )
 
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         bus.write_i2c_block_data( self.I2Caddr, CCS811_REG_ENV_DATA, msg )
-        bus.close()
         return
         
         
@@ -173,41 +192,41 @@ class CCS811:
     #----------------------------------------------------------------------------- 
     # run task once a minute
     def comp_task(self):
+        steps.run( self.comp_task_steps() )
+
+    def acomp_task(self, loop=None):
+        return evloop.spawn( self.comp_task_steps(), self.I2Caddr, loop )
+
+    def comp_task_steps(self):
     
-        # Try to read the externally expected temperature and humidity files
-        try:
-            file = open( self.FptrTemp, "r")
-            c = float( file.read() )
-            file.close()
-            
-            file = open( self.FptrHumid, "r")
-            rh = float( file.read() )
-            file.close()
-            
-            # just making sure T & RH values look okay befor proceeding
-            if c < 40 and rh < 100 and rh >= 0:
-                self.comp_minute -= 1
-                self.temp_buff[self.comp_minute] = c
-                self.rh_buff[self.comp_minute] = rh
-                print "ccs811.comp_task() minute T: %.1f RH: %.1f" % (c, rh)
-
-                if self.comp_minute == 0:
-
-                    # calculate averages and set CCS811 compensation
-                    avg_c  = 0
-                    avg_rh = 0
-                    for i in range(CCS811_T_MAX):
-                        avg_c += self.temp_buff[i]
-                        avg_rh += self.rh_buff[i]
-                        
-                    avg_c  /= CCS811_T_MAX_FLOAT
-                    avg_rh /= CCS811_T_MAX_FLOAT
-
-                    self.set_comp(avg_c, avg_rh)                    
-                    self.comp_minute = CCS811_T_MAX
-
-        except:
-            print "ccs811.comp_task() can't read T & RH files"    
+        c = self.temp_in.read()
+        rh = self.humid_in.read()
+
+        # just making sure T & RH values look okay befor proceeding
+        if c is None or rh is None:
+            print "ccs811.comp_task() no T & RH values"
+        elif c < 40 and rh < 100 and rh >= 0:
+            self.comp_minute -= 1
+            self.temp_avg.add( c )
+            self.rh_avg.add( rh )
+            print "ccs811.comp_task() minute T: %.1f RH: %.1f from %s" % (c, rh, self.temp_in.source)
+
+            if self.comp_minute == 0:
+
+                # calculate averages and set CCS811 compensation
+                avg_c  = self.temp_avg.mean()
+                avg_rh = self.rh_avg.mean()
+
+                try:
+                    self.set_comp(avg_c, avg_rh)
+                except (IOError, OSError):
+                    BUSES.fault(self.bus)
+                    print "ccs811.comp_task() can't set compensation"
+                except Exception:
+                    print "ccs811.comp_task() can't set compensation"
+                self.comp_minute = CCS811_T_MAX
+
+        yield steps.Done()
         
         
         
@@ -215,16 +234,21 @@ class CCS811:
     # 
     #-----------------------------------------------------------------------------        
     def get_baseline(self):
+        return steps.run( self.get_baseline_steps() )
+
+    def aget_baseline(self, loop=None):
+        return evloop.spawn( self.get_baseline_steps(), self.I2Caddr, loop )
+
+    def get_baseline_steps(self):
     # Looks like on power up, the CCS811 keeps
     # adjusting its baseline possibly bacause
     # the calculated tVOC value is negitive.
     # In effect the chip is auto zeroing itself.
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         resp = bus.read_i2c_block_data( self.I2Caddr, CCS811_REG_BASELINE, 2 )
-        bus.close()
         bl = (resp[0] << 8) | resp[1]
         #print "Baseline: 0x%04x" % bl
-        return bl
+        yield steps.Done( bl )
 
 
     #-----------------------------------------------------------------------------
@@ -233,9 +257,8 @@ class CCS811:
     def set_baseline( self, hi, lo ):
         msg = [ hi, lo ]
 
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         resp = bus.write_i2c_block_data( self.I2Caddr, CCS8_REG_BASELINE, msg )
-        bus.close()
         return
 
 
@@ -243,9 +266,8 @@ class CCS811:
     # 
     #-----------------------------------------------------------------------------
     def error_reg(self):
-        bus = SMBus(I2CBUS)
+        bus = BUSES.get(self.bus)
         resp = bus.read_byte_data( self.I2Caddr, CCS811_REG_ERROR )
-        bus.close()
         return resp
 
 
@@ -253,70 +275,68 @@ class CCS811:
     # 
     #-----------------------------------------------------------------------------
     def task(self):
+        return steps.run( self.task_steps() )
+
+    def atask(self, loop=None):
+        return evloop.spawn( self.task_steps(), self.I2Caddr, loop )
+
+    # the CCS811 measures on its own, task() only collects the result
+    def task_steps(self):
         
         avg_voc = 99999
+        t_voc = 99999
 
         try:
             
             # see if an update is ready
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             resp = bus.read_byte_data( self.I2Caddr, CCS811_REG_STATUS )
-            bus.close()
 
             if resp & CCS811_STATUS_DATA_RDY:
-                bus = SMBus(I2CBUS)
+                bus = BUSES.get(self.bus)
                 resp = bus.read_i2c_block_data( self.I2Caddr, CCS811_REG_RESULTS, 4 )
-                bus.close()
                 #e_co2 = (resp[0] << 8) | resp[1] 
                 t_voc = (resp[2] << 8) | resp[3]
 
                 # make sure reading looks to be within range
                 # 1187ppb is max possible 
                 if t_voc < 1200:
-                    self.voc_buff[self.voc_ptr] = t_voc
-                    self.voc_ptr += 1
-                    if self.voc_ptr >= CCS811_MAX:
-                        self.voc_ptr = 0
-
-                    # calculate current average voc value
-                    # 3 samples per minute
-                    avg_voc = 0
-                    for i in range(CCS811_MAX):
-                        avg_voc += self.voc_buff[i]
-                    avg_voc /= CCS811_MAX_FLOAT
-                    avg_voc = int(round(avg_voc))
+                    self.voc_avg.add( t_voc )
+                    self.voc.sample( t_voc )
+
+                    # current average voc value, 3 samples per minute
+                    avg_voc = int(round( self.voc_avg.mean() ))
                 
                     print "ccs811.task() avg voc: %d" % avg_voc        
 
-                    f = open(self.FptrVoc,"w")
-                    f.write("%d" % avg_voc)
-                    f.close()
+                    self.voc.publish( avg_voc )
 
                     self.newcal = self.get_baseline()
                     if self.newcal != self.oldcal:
                         print "ccs811.task() new baseline: 0x%04x" % self.newcal
-                        f = open(self.FptrBase,"w")
-                        f.write("0x%04x" % self.newcal)
-                        f.close()
+                        self.base.publish( self.newcal )
                         self.oldcal = self.newcal
 
                     err = self.error_reg()
                     if err:
-                        print "ccs811.task() error reg: 0x%02x" % resp[0]
-                        f = open(self.FptrError,"w")
-                        f.write("0x%02x" % err)
-                        f.close()
+                        print "ccs811.task() error reg: 0x%02x" % err
+                        self.error.publish( err )
                     
-                # returning latest value, not average
-                return t_voc        
             else:
-                print "ccs811.task() not ready yet 0x%02x" % resp[0]
-                return 99999
+                print "ccs811.task() not ready yet 0x%02x" % resp
                 
-        except:
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "ccs811.tast() error"
+            t_voc = 99999
+        except Exception:
             print "ccs811.tast() error"
-            return 99999
+            t_voc = 99999
+
+        # returning latest value, not average
+        yield steps.Done( t_voc )
             
 
     #-----------------------------------------------------------------------------
 
+registry.register("ccs811", CCS811)
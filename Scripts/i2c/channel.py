@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# A published sensor value
+# Raspberry Pi
+#
+# Each driver output (voc, tc, rh, co2 ...) is a Channel.  Every raw
+# reading goes through sample(), which feeds the multi-window statistics.
+# publish() stamps the value with the time and a per channel sequence
+# number and hands it to the hub (hub.py), whose sinks write the node
+# snapshot and the legacy value file /tmp/<name>/<chan> with <chan>.stats
+# next to it, one line per window:
+#
+#   <window seconds> <samples> <mean> <min> <max> <std>
+#
+# Channels made with windows=None (serial numbers, baselines ...) keep no
+# statistics and get no .stats file.
+#
+# An Input is the other end: the latest value of a quantity (hub.QUANTITIES)
+# as published by whichever driver in this process measures it, for the
+# drivers that compensate for temperature or humidity.  When nothing in
+# this process has published it for max_age seconds, as when the sensors
+# run as separate processes, it falls back to reading a value file, the
+# INPUT_FILES channel in the directory of the sensor the config names with
+# inputs = (config.py), or else of the first HTU21D or BME680 there, and
+# INPUT_DIR with no config at all.
+#
+import os
+
+from . import clock
+from . import hub
+from . import stats
+from .hub import QUANTITIES
+
+INPUT_MAX_AGE = 120.0     # seconds
+INPUT_DIR = "/tmp/HTU21D"
+
+# quantity -> value file, as the HTU21D and BME680 name their channels
+INPUT_FILES = { hub.TEMPERATURE:  "tc",
+                hub.HUMIDITY:     "rh",
+                hub.ABS_HUMIDITY: "ah" }
+
+
+#-----------------------------------------------------------------------------
+# One sensor output
+#-----------------------------------------------------------------------------
+class Channel:
+
+    def __init__(self, directory, name, fmt="%3.1f", windows=stats.WINDOWS, hub=hub.HUB,
+                 quantity=None):
+        if quantity is not None and quantity not in QUANTITIES:
+            raise ValueError("channel: no quantity %s" % quantity)
+        self.node = os.path.basename(directory)
+        self.name = name
+        self.path = directory + "/" + name
+        self.fmt = fmt
+        self.quantity = quantity   # what it measures, for subscribers
+        self.stats = None
+        if windows is not None:
+            self.stats = stats.MultiWindow(windows)
+        self.value = None      # last published value
+        self.stamp = None      # clock.wall() when it was published
+        self.seq = 0           # values published so far
+        self.cadence = None    # seconds between publishes, 0 for none regular, None unknown
+        self.hub = hub
+        hub.add(self)
+
+    # every valid reading, whether or not it is published
+    def sample(self, value):
+        if self.stats is not None:
+            self.stats.add( clock.now(), value )
+
+    def publish(self, value):
+        self.value = value
+        self.stamp = clock.wall()
+        self.seq += 1
+        self.hub.publish(self)
+
+    # the value as the legacy file has it
+    def text(self):
+        return self.fmt % self.value
+
+    def format_stats(self):
+        lines = []
+        for span, n, mean, lo, hi, std in self.stats.stats( clock.now() ):
+            if n == 0:
+                lines.append( "%d 0" % span )
+            else:
+                lines.append( "%d %d %.2f %.2f %.2f %.2f" % ( span, n, mean, lo, hi, std ) )
+        return "\n".join(lines) + "\n"
+
+
+#-----------------------------------------------------------------------------
+# Latest value of a quantity some other driver measures
+#-----------------------------------------------------------------------------
+class Input:
+
+    def __init__(self, quantity, fallback=None, max_age=INPUT_MAX_AGE, hub=hub.HUB):
+        self.quantity = quantity
+        self.fallback = fallback   # value file another process writes, or None
+        self.max_age = max_age
+        self.value = None
+        self.source = None         # "node/chan" or the fallback file it came from
+        self.received = None       # clock.now() of the last published value
+        hub.subscribe(quantity, self.update)
+
+    def update(self, ch):
+        if ch.value is None:
+            return
+        self.value = ch.value
+        self.source = ch.node + "/" + ch.name
+        self.received = clock.now()
+
+    # the value, None when there is none to be had
+    def read(self):
+        if self.received is not None and clock.now() - self.received <= self.max_age:
+            return self.value
+        if self.fallback is None:
+            return None
+        try:
+            f = open(self.fallback)
+            value = float(f.read())
+            f.close()
+        except (IOError, ValueError):
+            return None
+        self.source = self.fallback
+        return value
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#
+# Reading sensd values from another process
+# Raspberry Pi
+#
+# Consumers used to read /tmp/<name>/<chan> and check the file time to
+# tell a live sensd from a dead one.  Client does that once for everyone:
+#
+#   from i2c import client
+#   sensors = client.Client()
+#   r = sensors.read("HTU21D", "tc")
+#   if r is not None and not r.stale:
+#       print r.value, r.age, r.seq
+#
+# Values come from the shared memory ring (shmring.py) when sensd has one
+# and from the JSON snapshot (hub.py) otherwise.  A channel is stale once
+# its sequence number has not moved for MISSED of its expected updates,
+# every as many seconds as sensd puts in the snapshot for it (the driver's
+# jobs and the config's every = settings, registry.cadences()),
+# timed on this process's monotonic clock from when the current sequence
+# number was first seen, so a step in the wall clock (the Pi has no RTC
+# and NTP sets it some time after boot) does not flip every channel.  The
+# age reported is wall clock now minus the time sensd published the value.
+#
+# Polling often costs little: a shared memory read is a copy of one slot
+# with no system call, and the snapshot is only parsed again after sensd
+# has replaced the file.  Readings keep the value and time from when their
+# sequence number was first seen.
+#
+# Subscription gets new values pushed from sensd's socket (pubsub.py)
+# instead of polling:
+#
+#   for r in client.Subscription([ "SGP30/voc", "K30/co2" ]):
+#       print r.node, r.name, r.value
+#
+import json
+import os
+import select
+import socket
+
+from . import clock
+from . import hub
+from . import pubsub
+from . import shmring
+
+# seconds between publishes of a channel sensd gives no cadence for
+DEFAULT_CADENCE = 20
+
+# updates a channel may miss before it is stale
+MISSED = 3
+
+
+#-----------------------------------------------------------------------------
+# One channel value
+#-----------------------------------------------------------------------------
+class Reading(object):
+    __slots__ = ( "node", "name", "value", "t", "seq", "age", "stale" )
+
+    def __init__(self, node, name, value, t, seq, age, stale):
+        self.node = node
+        self.name = name
+        self.value = value    # as published, float or int
+        self.t = t            # wall clock time sensd published it
+        self.seq = seq        # publishes of this channel so far
+        self.age = age        # seconds since t
+        self.stale = stale
+
+    def __repr__(self):
+        return "Reading(%s/%s %r seq %d age %.1fs%s)" % ( self.node, self.name, self.value,
+                self.seq, self.age, self.stale and " stale" or "" )
+
+
+#-----------------------------------------------------------------------------
+# Cached view of one sensd
+#-----------------------------------------------------------------------------
+class Client:
+
+    def __init__(self, shm_path=shmring.SHM_PATH, snapshot=hub.SNAPSHOT_JSON,
+                 cadence=None, missed=MISSED):
+        self.shm_path = shm_path
+        self.snapshot = snapshot
+        # seconds between publishes, "node/chan" before "node", None never
+        # stale, over what sensd says
+        self.cadence = dict(cadence or {})
+        self.missed = missed
+        self.shm = None
+        self.snap = None       # parsed snapshot
+        self.snap_id = None    # ( inode, mtime ) it was parsed from
+        self.published = {}    # "node/chan" -> cadence from the snapshot
+        self.seen = {}         # "node/chan" -> [ seq, clock.now() it was first seen, value, t ]
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def expected(self, node, name):
+        key = node + "/" + name
+        if key in self.cadence:
+            return self.cadence[key]
+        if node in self.cadence:
+            return self.cadence[node]
+        if key not in self.published:
+            self._load_snapshot()
+        cadence = self.published.get(key, DEFAULT_CADENCE)
+        if cadence == 0:
+            # no regular cadence
+            return None
+        return cadence
+
+    #-----------------------------------------------------------------------------
+    # Raw ( value, t, seq ) from shared memory, then the snapshot
+    #-----------------------------------------------------------------------------
+    def _shm(self):
+        if self.shm is None and self.shm_path is not None:
+            try:
+                self.shm = shmring.ShmReader(self.shm_path)
+            except:
+                self.shm = None
+        return self.shm
+
+    def _load_snapshot(self):
+        if self.snapshot is None:
+            return None
+        try:
+            st = os.stat(self.snapshot)
+        except OSError:
+            self.snap = None
+            self.snap_id = None
+            return None
+        snap_id = ( st.st_ino, st.st_mtime )
+        if snap_id != self.snap_id:
+            try:
+                f = open(self.snapshot)
+                self.snap = json.load(f)
+                f.close()
+                self.snap_id = snap_id
+                for node, chans in self.snap["sensors"].items():
+                    for name, ch in chans.items():
+                        if "c" in ch:
+                            self.published[node + "/" + name] = ch["c"]
+            except:
+                # caught between sensd's write and rename, or not sensd's
+                self.snap = None
+                self.snap_id = None
+        return self.snap
+
+    def _raw(self, node, name):
+        shm = self._shm()
+        if shm is not None:
+            got = shm.latest(node, name)
+            if got is not None:
+                return got
+        snap = self._load_snapshot()
+        if snap is not None:
+            ch = snap["sensors"].get(node, {}).get(name)
+            if ch is not None and ch["seq"]:
+                return ( ch["v"], ch["t"], ch["seq"] )
+        return None
+
+    #-----------------------------------------------------------------------------
+    # Latest Reading of a channel, None if sensd has never published it
+    #-----------------------------------------------------------------------------
+    def read(self, node, name):
+        raw = self._raw(node, name)
+        if raw is None:
+            return None
+        value, t, seq = raw
+        key = node + "/" + name
+        now = clock.now()
+        age = clock.wall() - t
+
+        seen = self.seen.get(key)
+        if seen is None or seen[0] != seq:
+            # first sight of this value, the best guess is sensd's own stamp
+            seen = [ seq, now - max(age, 0.0), value, t ]
+            self.seen[key] = seen
+
+        stale = False
+        expected = self.expected(node, name)
+        if expected is not None:
+            stale = now - seen[1] > expected * self.missed
+        return Reading(node, name, seen[2], seen[3], seq, age, stale)
+
+    # { "node/chan": Reading } of every published channel
+    def read_all(self):
+        readings = {}
+        for key in self.channels():
+            node, name = key.split("/", 1)
+            r = self.read(node, name)
+            if r is not None:
+                readings[key] = r
+        return readings
+
+    def channels(self):
+        shm = self._shm()
+        if shm is not None:
+            return shm.channels()
+        snap = self._load_snapshot()
+        if snap is None:
+            return []
+        keys = []
+        for node, chans in snap["sensors"].items():
+            for name in chans:
+                keys.append( node + "/" + name )
+        return sorted(keys)
+
+
+#-----------------------------------------------------------------------------
+# Values pushed by sensd as they are published
+#-----------------------------------------------------------------------------
+class Subscription:
+
+    def __init__(self, channels=( "*", ), path=pubsub.SOCK_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.buf = ""
+        self.subscribe(channels)
+
+    def subscribe(self, channels):
+        self.sock.sendall("SUB %s\n" % " ".join(channels))
+
+    def unsubscribe(self, channels):
+        self.sock.sendall("UNSUB %s\n" % " ".join(channels))
+
+    def close(self):
+        self.sock.close()
+
+    #-----------------------------------------------------------------------------
+    # Next Reading, None after timeout seconds without one, EOFError once
+    # sensd has gone or dropped this subscriber
+    #-----------------------------------------------------------------------------
+    def next(self, timeout=None):
+        while "\n" not in self.buf:
+            if timeout is not None:
+                r, w, x = select.select([ self.sock ], [], [], timeout)
+                if not r:
+                    return None
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError("sensd closed the subscription")
+            self.buf += data
+        line, self.buf = self.buf.split("\n", 1)
+        msg = json.loads(line)
+        if "error" in msg:
+            raise ValueError(msg["error"])
+        node, name = msg["ch"].split("/", 1)
+        return Reading(node, name, msg["v"], msg["t"], msg["seq"],
+                       clock.wall() - msg["t"], False)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.next()
+            except EOFError:
+                return
+
+#-----------------------------------------------------------------------------
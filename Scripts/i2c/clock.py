@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Time source shared by the i2c drivers and schedulers
+# Raspberry Pi
+#
+# time.monotonic() does not exist in python 2 so CLOCK_MONOTONIC is read
+# through librt when it is available.  Anything that wants to run the
+# drivers faster or slower than real time can swap in another clock with
+# set_clock().
+#
+import ctypes
+import time
+
+CLOCK_MONOTONIC = 1
+
+#-----------------------------------------------------------------------------
+# Monotonic seconds, falls back to time.time() where it can't be found
+#-----------------------------------------------------------------------------
+class _timespec(ctypes.Structure):
+    _fields_ = [ ("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long) ]
+
+# find_library() runs ldconfig, so it is only asked when the usual name fails
+def _librt():
+    try:
+        return ctypes.CDLL("librt.so.1", use_errno=True)
+    except OSError:
+        from ctypes.util import find_library
+        return ctypes.CDLL(find_library("rt"), use_errno=True)
+
+def _find_monotonic():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        librt = _librt()
+        gettime = librt.clock_gettime
+        gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(_timespec) ]
+        ts = _timespec()
+
+        def monotonic():
+            if gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except:
+        return time.time
+
+monotonic = _find_monotonic()
+
+
+#-----------------------------------------------------------------------------
+# Real time clock
+#-----------------------------------------------------------------------------
+class Clock:
+
+    def now(self):
+        return monotonic()
+
+    # seconds since the epoch, for time stamps other processes read
+    def wall(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+#-----------------------------------------------------------------------------
+# Fast forward clock for benchmarks and soak tests
+#-----------------------------------------------------------------------------
+# Real time keeps running so the cost of the code itself is still seen, but
+# every sleep returns at once and moves the clock ahead instead.
+class SkipClock(Clock):
+
+    def __init__(self):
+        self.skipped = 0.0
+
+    def now(self):
+        return monotonic() + self.skipped
+
+    def wall(self):
+        return time.time() + self.skipped
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.skipped += seconds
+
+
+#-----------------------------------------------------------------------------
+# Purely simulated clock
+#-----------------------------------------------------------------------------
+# Only moves when slept on, so a run on the simulated bus gives the same
+# readings every time regardless of how fast the machine is.
+class VirtualClock(Clock):
+
+    def __init__(self, start=0.0):
+        self.t = start
+
+    def now(self):
+        return self.t
+
+    def wall(self):
+        return self.t
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.t += seconds
+
+
+CLOCK = Clock()
+
+def set_clock(clock):
+    global CLOCK
+    CLOCK = clock
+
+def now():
+    return CLOCK.now()
+
+def wall():
+    return CLOCK.wall()
+
+def sleep(seconds):
+    CLOCK.sleep(seconds)
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+#
+# Sensirion style word codec
+# Raspberry Pi
+#
+# The SGP30 and HTU21D both send 16 bit words MSB first, each followed by
+# a CRC8 (polynomial 0x31) of its two bytes.  They only differ in the CRC
+# initial value.  words() checks and decodes a whole response in one go,
+# straight from the read buffer, and word() builds the same format for
+# commands that take arguments.
+#
+import ctypes
+import struct
+
+POLY = 0x31
+
+CRC_HTU = 0x00      # Instrumant Specialties HTU21D RH sensor
+CRC_SGP = 0xff      # Senserion VOC sensor
+
+
+#-----------------------------------------------------------------------------
+# CRC8 lookup table, one entry per value of the running crc ^ next byte
+#-----------------------------------------------------------------------------
+def _table(poly):
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 0x80:
+                crc = (crc << 1) ^ poly
+            else:
+                crc = crc << 1
+        table[i] = crc & 0xff
+    return table
+
+TABLE = None        # built on first use, not at import
+
+def crc_table():
+    global TABLE
+    if TABLE is None:
+        TABLE = _table(POLY)
+    return TABLE
+
+# a message including its crc byte checks to 0
+def crc8(data, init=CRC_SGP):
+    crc = init
+    table = TABLE or crc_table()
+    for b in bytearray(data):
+        crc = table[crc ^ b]
+    return crc
+
+
+#-----------------------------------------------------------------------------
+# Raw bytes of a read, from an smbus2 i2c_msg, a block read list or bytes
+#-----------------------------------------------------------------------------
+def buffer(resp):
+    if isinstance(resp, bytearray):
+        return resp
+    if isinstance(resp, list):
+        return bytearray(resp)
+    buf = getattr(resp, "buf", None)
+    if isinstance(buf, bytearray):
+        return buf[:resp.len]
+    if buf is not None:
+        # smbus2 keeps the data behind a ctypes char pointer
+        return bytearray(ctypes.string_at(buf, resp.len))
+    return bytearray(resp)
+
+
+#-----------------------------------------------------------------------------
+# Decode n words, a word whose crc fails comes back as None
+#-----------------------------------------------------------------------------
+_FORMATS = {}
+
+def words(resp, n, init=CRC_SGP):
+    data = buffer(resp)
+    fmt = _FORMATS.get(n)
+    if fmt is None:
+        fmt = _FORMATS[n] = struct.Struct(">" + "HB" * n)
+
+    fields = fmt.unpack_from(data)
+    table = TABLE or crc_table()
+    values = []
+    for i in range(0, 2 * n, 2):
+        value = fields[i]
+        crc = table[table[init ^ (value >> 8)] ^ (value & 0xff)]
+        if crc == fields[i + 1]:
+            values.append(value)
+        else:
+            values.append(None)
+    return values
+
+# a 16 bit value as [ msb, lsb, crc ]
+def word(value, init=CRC_SGP):
+    data = [ (value >> 8) & 0xff, value & 0xff ]
+    data.append( crc8(data, init) )
+    return data
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+#
+# Node configuration for sensd
+# Raspberry Pi
+#
+# An INI file, the one named by SENSD_CONF or else /etc/sensd.conf.  With
+# neither sensd runs DEFAULT, the sensors this node has always had.
+#
+#   [sensd]
+#   mode = sched                serial, overlap or sched, see acquire.py
+#   tick = 1.0                  seconds per acquisition cycle
+#   report = 60                 ticks between bus and sink reports
+#   overrun = skip              skip, catchup or shed when behind, see acquire.py
+#
+#   [sinks]
+#   legacy = yes                the /tmp/<name>/<chan> files
+#   snapshot = yes              /tmp/sensd.json and /tmp/sensd.bin
+#   shm = yes                   /tmp/sensd.shm
+#   pubsub = yes                /tmp/sensd.sock
+#   mqtt =                      broker host[:port], "sim" for the stand-in
+#   log =                       seglog/history directory on the USB drive
+#   rollup =                    rollup directory
+#
+#   [SGP30]                     one section per sensor, named for it
+#   driver = sgp30              as registered, see registry.py
+#   module =                    the module registering it when not built in
+#   bus = 1
+#   address = 0x58
+#   directory = /tmp/SGP30      where its channels are written
+#   group = SGP30               sensdsup worker it runs in, see supervisor.py
+#   every = 1                   ticks between runs of the main job,
+#   base.every = 20             or of another of the driver's jobs, 0 for never
+#   priority = high             high, normal or low, also <job>.priority
+#   average = 60                samples in the driver's moving averages
+#   inputs = HTU21D             sensor whose files compensation falls back to,
+#                               or their directory
+#   voc.windows = 60 300 3600   statistics windows of a channel, or none
+#   enabled = yes
+#
+# Cadence is set per job, not per channel: a channel comes as often as the
+# job publishing it runs (registry.py PUBLISHES).  average is the length of
+# the moving averages the driver publishes, for all its channels, and
+# <chan>.windows only the .stats windows kept next to a channel's value.
+# inputs defaults to the first HTU21D or BME680 of the file, and the
+# directory of that sensor is what the driver is given.  Left out settings
+# take the driver's own defaults.  MQTT_HOST, SENSD_LOG,
+# SENSD_ROLLUP and I2C_LEGACY_FILES=0 in the environment override [sinks].
+#
+import ConfigParser
+import os
+import StringIO
+
+CONF_PATH = "/etc/sensd.conf"
+
+DEFAULT = """
+[sensd]
+mode = sched
+tick = 1.0
+report = 60
+overrun = skip
+
+[sinks]
+legacy = yes
+snapshot = yes
+shm = yes
+pubsub = yes
+mqtt =
+log =
+rollup =
+
+[SGP30]
+driver = sgp30
+address = 0x58
+
+[HTU21D]
+driver = htu21d
+address = 0x40
+
+[CCS811]
+driver = ccs811
+address = 0x5a
+enabled = no
+
+[K30]
+driver = k30
+address = 0x68
+
+[BME680]
+driver = bme680
+address = 0x77
+enabled = no
+"""
+
+GLOBAL = ( "sensd", "sinks" )
+
+# drivers publishing the tc, rh and ah others compensate with
+PROVIDERS = ( "htu21d", "bme680" )
+
+BOOLEANS = { "yes": True, "true": True, "on": True, "1": True,
+             "no": False, "false": False, "off": False, "0": False }
+
+
+#-----------------------------------------------------------------------------
+# One configured sensor
+#-----------------------------------------------------------------------------
+class Sensor(object):
+
+    __slots__ = ( "name", "driver", "module", "bus", "address", "directory",
+                  "group", "every", "priority", "average", "inputs", "windows" )
+
+    def __init__(self, name, driver):
+        self.name = name
+        self.driver = driver
+        self.module = None
+        self.bus = None
+        self.address = None
+        self.directory = None
+        self.group = name      # sensdsup worker
+        self.every = {}        # job -> ticks
+        self.priority = {}     # job -> "high", "normal" or "low"
+        self.average = None    # samples in the moving averages
+        self.inputs = None     # directory of the sensor compensation falls back to
+        self.windows = {}      # channel -> windows, () for none
+
+    # keyword arguments for the driver class, the ones the config sets
+    def kwargs(self, cls=None):
+        out = {}
+        if self.bus is not None:
+            out["bus"] = self.bus
+        if self.directory is not None:
+            out["directory"] = self.directory
+        if self.average is not None:
+            out["average"] = self.average
+        if self.inputs is not None and getattr(cls, "COMPENSATES", None):
+            out["inputs"] = self.inputs
+        return out
+
+
+def _windows(text):
+    if text.strip().lower() == "none":
+        return ()
+    return tuple([ int(w) for w in text.replace(",", " ").split() ])
+
+
+#-----------------------------------------------------------------------------
+# The whole file
+#-----------------------------------------------------------------------------
+class Config:
+
+    def __init__(self, path=None):
+        self.parser = ConfigParser.RawConfigParser()
+        self.parser.readfp(StringIO.StringIO(DEFAULT), "<default>")
+        self.path = None
+        if path is None:
+            path = os.environ.get("SENSD_CONF", CONF_PATH)
+            if not os.path.exists(path) and "SENSD_CONF" not in os.environ:
+                path = None
+        if path is not None:
+            # a file of its own replaces the default sensors
+            sensors = [ s for s in self.parser.sections() if s not in GLOBAL ]
+            for section in sensors:
+                self.parser.remove_section(section)
+            if not self.parser.read(path):
+                raise IOError("config: can't read %s" % path)
+            self.path = path
+
+    def get(self, section, option, default=None):
+        if self.parser.has_option(section, option):
+            value = self.parser.get(section, option).strip()
+            if value:
+                return value
+        return default
+
+    def getboolean(self, section, option, default=False):
+        value = self.get(section, option)
+        if value is None:
+            return default
+        if value.lower() not in BOOLEANS:
+            raise ValueError("config: [%s] %s = %s is not yes or no" % ( section, option, value ))
+        return BOOLEANS[value.lower()]
+
+    def getfloat(self, section, option, default=None):
+        value = self.get(section, option)
+        if value is None:
+            return default
+        return float(value)
+
+    #-----------------------------------------------------------------------------
+    # The enabled sensors in the order of the file
+    #-----------------------------------------------------------------------------
+    def sensors(self):
+        out = []
+        for section in self.parser.sections():
+            if section in GLOBAL or not self.getboolean(section, "enabled", True):
+                continue
+            driver = self.get(section, "driver")
+            if driver is None:
+                raise ValueError("config: [%s] has no driver" % section)
+            s = Sensor(section, driver)
+            s.module = self.get(section, "module")
+            for option, value in self.parser.items(section):
+                value = value.strip()
+                if not value:
+                    continue
+                job, dot, key = option.rpartition(".")
+                if option == "bus":
+                    s.bus = int(value, 0)
+                elif option == "address":
+                    s.address = int(value, 0)
+                elif option == "directory":
+                    s.directory = value
+                elif option == "group":
+                    s.group = value
+                elif option == "inputs":
+                    s.inputs = value
+                elif option == "average":
+                    s.average = int(value)
+                    if s.average < 1:
+                        raise ValueError("config: [%s] average = %s is not 1 or more" % ( section, value ))
+                elif key == "every":
+                    s.every[job] = int(value)
+                elif key == "priority":
+                    s.priority[job] = value.lower()
+                elif key == "windows" and job:
+                    s.windows[job] = _windows(value)
+                elif option not in ( "driver", "module", "enabled" ):
+                    raise ValueError("config: [%s] unknown setting %s" % ( section, option ))
+            out.append(s)
+
+        # inputs names a sensor, the driver gets its directory
+        directories = dict([ ( s.name, s.directory or "/tmp/" + s.name ) for s in out ])
+        providers = [ s.name for s in out if s.driver in PROVIDERS ]
+        for s in out:
+            name = s.inputs
+            if name is None:
+                others = [ p for p in providers if p != s.name ]
+                if not others:
+                    continue
+                name = others[0]
+            if name.startswith("/"):
+                continue
+            if name not in directories:
+                raise ValueError("config: [%s] inputs = %s is no sensor here" % ( s.name, name ))
+            s.inputs = directories[name]
+        return out
+
+#-----------------------------------------------------------------------------
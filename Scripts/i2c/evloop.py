@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+# Single threaded event loop for the i2c drivers
+# Raspberry Pi
+#
+# The drivers' *_steps() generators (see steps.py) run here as tasks, so
+# sensor acquisition, a socket server and an uplink publisher can share
+# one thread.  A task is a generator that yields:
+#
+#   a number of seconds   to sleep without blocking the loop
+#   another Task          to wait for it, its result is sent back in
+#   Done(value)           to finish with a result
+#
+# Each driver has atask() style methods that spawn their step generator
+# here, e.g. inside a task:  voc = yield SGP30.atask()
+#
+# Tasks spawned for the same device run one after the other so two
+# commands are never in flight on one chip.
+#
+# No daemon here runs on this loop: sensd drives the same step generators
+# from its acquisition cycle (acquire.py) and the socket sinks serve their
+# clients from threads of their own (pubsub.py, mqtt.py).  It is a library
+# API for scripts that want the drivers and their own sockets in one
+# thread, with add_reader() and add_writer(), and the evloop case of
+# benchmicro keeps it and the drivers' a*() methods working.
+#
+import heapq
+import select
+
+from . import clock
+from .steps import Done
+
+
+#-----------------------------------------------------------------------------
+# A running generator, yield it from another task to wait for its result
+#-----------------------------------------------------------------------------
+class Task(object):
+
+    def __init__(self, loop, gen, device):
+        self.loop = loop
+        self.gen = gen
+        self.device = device
+        self.finished = False
+        self.value = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        return self.value
+
+    # fn(task) runs on the loop once the task is finished
+    def add_done_callback(self, fn):
+        if self.finished:
+            self.loop.call_soon(fn, self)
+        else:
+            self.callbacks.append(fn)
+
+
+#-----------------------------------------------------------------------------
+# Timer handle returned by call_later()
+#-----------------------------------------------------------------------------
+class Timer(object):
+    __slots__ = ( "when", "fn", "args", "cancelled" )
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+#-----------------------------------------------------------------------------
+# Event loop
+#-----------------------------------------------------------------------------
+class EventLoop:
+
+    def __init__(self):
+        self.timers = []    # heap of ( when, seq, Timer )
+        self.seq = 0
+        self.readers = {}   # fd -> ( fn, args )
+        self.writers = {}
+        self.devices = {}   # device -> tasks waiting for it
+        self.running = False
+
+    def time(self):
+        return clock.now()
+
+    #-----------------------------------------------------------------------------
+    # Callbacks
+    #-----------------------------------------------------------------------------
+    def call_later(self, delay, fn, *args):
+        timer = Timer(clock.now() + delay, fn, args)
+        self.seq += 1
+        heapq.heappush(self.timers, ( timer.when, self.seq, timer ))
+        return timer
+
+    def call_soon(self, fn, *args):
+        return self.call_later(0, fn, *args)
+
+    def add_reader(self, fd, fn, *args):
+        self.readers[fd] = ( fn, args )
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, fn, *args):
+        self.writers[fd] = ( fn, args )
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    #-----------------------------------------------------------------------------
+    # Tasks
+    #-----------------------------------------------------------------------------
+    def spawn(self, gen, device=None):
+        task = Task(self, gen, device)
+        if device is not None:
+            if device in self.devices:
+                self.devices[device].append(task)
+                return task
+            self.devices[device] = []
+        self.call_soon(self._step, task, None)
+        return task
+
+    def _step(self, task, value):
+        try:
+            step = task.gen.send(value)
+        except StopIteration:
+            step = Done()
+        except:
+            print "evloop.step() task failed"
+            step = Done()
+
+        if isinstance(step, Done):
+            task.gen.close()
+            self._finish(task, step.value)
+        elif isinstance(step, Task):
+            step.add_done_callback(lambda t: self._step(task, t.value))
+        else:
+            self.call_later(step, self._step, task, None)
+
+    def _finish(self, task, value):
+        task.finished = True
+        task.value = value
+
+        if task.device is not None:
+            waiting = self.devices[task.device]
+            if waiting:
+                self.call_soon(self._step, waiting.pop(0), None)
+            else:
+                del self.devices[task.device]
+
+        for fn in task.callbacks:
+            self.call_soon(fn, task)
+        task.callbacks = []
+
+    #-----------------------------------------------------------------------------
+    # Running the loop
+    #-----------------------------------------------------------------------------
+    def run_until_complete(self, task):
+        if not isinstance(task, Task):
+            task = self.spawn(task)
+        self.running = True
+        while self.running and not task.finished:
+            if not self._run_once():
+                break
+        self.running = False
+        return task.value
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            if not self._run_once():
+                break
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    # one pass: wait for the next timer or file event, then dispatch
+    # returns False when there is nothing left that could ever run
+    def _run_once(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+
+        if not self.timers and not self.readers and not self.writers:
+            return False
+
+        timeout = None
+        if self.timers:
+            timeout = max(0.0, self.timers[0][0] - clock.now())
+
+        if self.readers or self.writers:
+            try:
+                r, w, x = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+            except select.error:
+                r, w = [], []
+            for fd in r:
+                if fd in self.readers:
+                    fn, args = self.readers[fd]
+                    fn(*args)
+            for fd in w:
+                if fd in self.writers:
+                    fn, args = self.writers[fd]
+                    fn(*args)
+        else:
+            clock.sleep(timeout)
+
+        now = clock.now()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.fn(*timer.args)
+
+        return True
+
+
+#-----------------------------------------------------------------------------
+# Process default loop
+#-----------------------------------------------------------------------------
+LOOP = None
+
+def get_loop():
+    global LOOP
+    if LOOP is None:
+        LOOP = EventLoop()
+    return LOOP
+
+def spawn(gen, device=None, loop=None):
+    if loop is None:
+        loop = get_loop()
+    return loop.spawn(gen, device)
+
+#-----------------------------------------------------------------------------
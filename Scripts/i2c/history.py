@@ -0,0 +1,439 @@
+#!/usr/bin/python
+#
+# Compressed long term history
+# Raspberry Pi
+#
+# Closed segments of the binary log (seglog.py) are packed into .gor files
+# with the encoding of Facebook's Gorilla paper, one bit stream per channel:
+#
+#   time   delta of delta, taken on the bits of the double as an integer.
+#          Within a power of two the bits count up evenly (about 0.24us a
+#          step for times in this century), so the small jitter on a
+#          regular cadence packs into a few bits and nothing is rounded.
+#              '0'                      same delta as the last record
+#              '10'    + 7 bits         zigzag delta of delta below 2^7
+#              '110'   + 9 bits                                below 2^9
+#              '1110'  + 12 bits                               below 2^12
+#              '11110' + 20 bits                               below 2^20
+#              '11111' + 64 bits        the time bits as they are
+#   flags  '0' same as the last record, '1' + 3 bits
+#   value  nothing for FLAG_NONE records
+#          FLAG_INT, zigzag delta from the last integer with the prefixes
+#          above and '11111' + 34 bits for the largest
+#          float32, XOR with the bits of the last float
+#              '0'                      the same value
+#              '10'    + bits           inside the last leading/trailing zeros
+#              '11'    + 5 bits leading zeros + 5 bits length - 1 + bits
+#
+# The first record of a stream has its 64 time bits and 3 flag bits in
+# full, the value is taken against 0.  A .gor file is
+#
+#   header  4s magic "I2CH", H version, H channels, d time the segment was created
+#   entry   H channel id, I records, I stream bytes     for each channel
+#
+# followed by the streams in the order of the entries.  Reading back merges
+# the channel streams in time order and decodes them READ_SIZE bytes at a
+# time, so a month of history is scanned in a small, fixed amount of memory.
+# Values come back exactly as seglog.records() gave them.
+#
+# compact() packs every segment but the one being written; sensd runs it
+# on its own thread each time the log starts a new segment.
+#
+import heapq
+import os
+import struct
+import threading
+
+from . import seglog
+
+MAGIC   = "I2CH"
+VERSION = 1
+HEADER  = struct.Struct("<4sHHd")
+ENTRY   = struct.Struct("<HII")
+
+READ_SIZE = 4096
+
+# ( prefix, prefix bits, payload bits ), '11111' is the escape
+BUCKETS = ( ( 0x2, 2, 7 ), ( 0x6, 3, 9 ), ( 0xe, 4, 12 ), ( 0x1e, 5, 20 ) )
+ESCAPE = 0x1f
+INT_BITS = 34
+
+_double = struct.Struct("<d")
+_qword  = struct.Struct("<Q")
+_float  = struct.Struct("<f")
+_dword  = struct.Struct("<I")
+_big64  = struct.Struct(">Q")
+
+
+def _zigzag(n):
+    if n >= 0:
+        return n << 1
+    return (-n << 1) - 1
+
+def _unzigzag(z):
+    if z & 1:
+        return -((z + 1) >> 1)
+    return z >> 1
+
+
+#-----------------------------------------------------------------------------
+# Bit streams, most significant bit first
+#-----------------------------------------------------------------------------
+class BitWriter:
+
+    def __init__(self):
+        self.out = []
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, n):
+        self.acc = (self.acc << n) | value
+        self.nbits += n
+        if self.nbits >= 64:
+            self.nbits -= 64
+            self.out.append( _big64.pack(self.acc >> self.nbits) )
+            self.acc &= (1 << self.nbits) - 1
+
+    # the bits so far, zero padded to a whole byte
+    def getvalue(self):
+        tail = ""
+        if self.nbits:
+            nbytes = (self.nbits + 7) // 8
+            tail = _big64.pack(self.acc << (64 - self.nbits))[:nbytes]
+        return "".join(self.out) + tail
+
+
+class BitReader:
+
+    # read(size) gives more of the stream, limit bytes of it in all
+    def __init__(self, read, limit):
+        self.source = read
+        self.left = limit
+        self.buf = ""
+        self.pos = 0
+        self.acc = 0
+        self.nbits = 0
+
+    def _refill(self):
+        if self.pos + 8 > len(self.buf):
+            more = ""
+            if self.left > 0:
+                more = self.source(min(READ_SIZE, self.left))
+                self.left -= len(more)
+            self.buf = self.buf[self.pos:] + more
+            self.pos = 0
+            if not more and len(self.buf) < 8:
+                # the last few bytes of the stream
+                if not self.buf:
+                    raise EOFError("history: stream ended early")
+                self.acc = (self.acc << 8) | ord(self.buf[0])
+                self.buf = self.buf[1:]
+                self.nbits += 8
+                return
+        self.acc = (self.acc << 64) | _big64.unpack_from(self.buf, self.pos)[0]
+        self.pos += 8
+        self.nbits += 64
+
+    def read(self, n):
+        while self.nbits < n:
+            self._refill()
+        self.nbits -= n
+        value = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        return value
+
+    # a zigzag number behind one of the BUCKETS prefixes, None for the escape
+    def bucketed(self):
+        n = 0
+        while n < 5 and self.read(1):
+            n += 1
+        if n == 0:
+            return 0
+        if n == 5:
+            return None
+        return self.read(BUCKETS[n - 1][2])
+
+
+def _write_bucketed(w, z):
+    if z == 0:
+        w.write(0, 1)
+        return True
+    for prefix, plen, bits in BUCKETS:
+        if z >> bits == 0:
+            w.write(prefix, plen)
+            w.write(z, bits)
+            return True
+    w.write(ESCAPE, 5)
+    return False
+
+
+#-----------------------------------------------------------------------------
+# One channel
+#-----------------------------------------------------------------------------
+class Encoder:
+
+    def __init__(self):
+        self.w = BitWriter()
+        self.count = 0
+        self.tb = 0          # time bits of the last record
+        self.delta = 0
+        self.flags = 0
+        self.int = 0         # last FLAG_INT value
+        self.fbits = 0       # bits of the last float value
+        self.lead = None     # leading/trailing zeros of the last XOR window
+        self.trail = 0
+
+    # one record as seglog._records() gives it
+    def add(self, t, flags, value):
+        w = self.w
+        tb = _qword.unpack(_double.pack(t))[0]
+        if self.count == 0:
+            w.write(tb, 64)
+            w.write(flags, 3)
+        else:
+            delta = tb - self.tb
+            if not _write_bucketed(w, _zigzag(delta - self.delta)):
+                w.write(tb, 64)
+            self.delta = delta
+            if flags == self.flags:
+                w.write(0, 1)
+            else:
+                w.write(1, 1)
+                w.write(flags, 3)
+        self.tb = tb
+        self.flags = flags
+        self.count += 1
+
+        if flags & seglog.FLAG_NONE:
+            return
+        if flags & seglog.FLAG_INT:
+            z = _zigzag(value - self.int)
+            if not _write_bucketed(w, z):
+                w.write(z, INT_BITS)
+            self.int = value
+            return
+
+        fbits = _dword.unpack(_float.pack(value))[0]
+        x = fbits ^ self.fbits
+        self.fbits = fbits
+        if x == 0:
+            w.write(0, 1)
+            return
+        lead = min(32 - x.bit_length(), 31)
+        trail = (x & -x).bit_length() - 1
+        if self.lead is not None and lead >= self.lead and trail >= self.trail:
+            w.write(0x2, 2)
+            w.write(x >> self.trail, 32 - self.lead - self.trail)
+        else:
+            length = 32 - lead - trail
+            w.write(0x3, 2)
+            w.write(lead, 5)
+            w.write(length - 1, 5)
+            w.write(x >> trail, length)
+            self.lead = lead
+            self.trail = trail
+
+    def getvalue(self):
+        return self.w.getvalue()
+
+
+# ( time, flags, value ) of a channel stream of count records
+def decode(read, limit, count):
+    r = BitReader(read, limit)
+    tb = delta = flags = iv = fbits = 0
+    lead = trail = 0
+    for i in xrange(count):
+        if i == 0:
+            tb = r.read(64)
+            flags = int(r.read(3))
+        else:
+            z = r.bucketed()
+            if z is None:
+                new = r.read(64)
+                delta = new - tb
+                tb = new
+            else:
+                delta += _unzigzag(z)
+                tb += delta
+            if r.read(1):
+                flags = int(r.read(3))
+        t = _double.unpack(_qword.pack(tb))[0]
+
+        if flags & seglog.FLAG_NONE:
+            yield t, flags, None
+        elif flags & seglog.FLAG_INT:
+            z = r.bucketed()
+            if z is None:
+                z = r.read(INT_BITS)
+            iv = int(iv + _unzigzag(z))
+            yield t, flags, iv
+        else:
+            if r.read(1):
+                if r.read(1):
+                    lead = r.read(5)
+                    length = r.read(5) + 1
+                    trail = 32 - lead - length
+                    fbits ^= r.read(length) << trail
+                else:
+                    fbits ^= r.read(32 - lead - trail) << trail
+            yield t, flags, _float.unpack(_dword.pack(fbits))[0]
+
+
+#-----------------------------------------------------------------------------
+# Whole segments
+#-----------------------------------------------------------------------------
+def encode_segment(data):
+    """.gor file contents for the contents of a closed seglog segment"""
+    encoders = {}
+    order = []
+    for t, cid, flags, value in seglog._records(data):
+        enc = encoders.get(cid)
+        if enc is None:
+            enc = encoders[cid] = Encoder()
+            order.append(cid)
+        enc.add(t, flags, value)
+
+    created = seglog.HEADER.unpack_from(data)[3]
+    parts = [ HEADER.pack(MAGIC, VERSION, len(order), created) ]
+    streams = []
+    for cid in order:
+        stream = encoders[cid].getvalue()
+        parts.append( ENTRY.pack(cid, encoders[cid].count, len(stream)) )
+        streams.append(stream)
+    return "".join(parts + streams)
+
+def _stream(path, offset, size, count, cid):
+    f = open(path, "rb")
+    try:
+        f.seek(offset)
+        for t, flags, value in decode(f.read, size, count):
+            yield t, cid, flags, value
+    finally:
+        f.close()
+
+# ( time, channel id, flags, value ) of a .gor file in time order
+def segment_records(path):
+    f = open(path, "rb")
+    magic, version, channels, created = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError("history: %s is not a version %d history file" % ( path, VERSION ))
+    entries = [ ENTRY.unpack(f.read(ENTRY.size)) for i in range(channels) ]
+    f.close()
+
+    offset = HEADER.size + channels * ENTRY.size
+    streams = []
+    for cid, count, size in entries:
+        streams.append( _stream(path, offset, size, count, cid) )
+        offset += size
+    return heapq.merge(*streams)
+
+def _same(a, b):
+    # per channel order is all the segment promises, and NaN != NaN
+    a = sorted([ ( r[1], r[0], r[2], repr(r[3]) ) for r in a ])
+    b = sorted([ ( r[1], r[0], r[2], repr(r[3]) ) for r in b ])
+    return a == b
+
+
+#-----------------------------------------------------------------------------
+# The log directory
+#-----------------------------------------------------------------------------
+# segment number -> "seg" or "gor", an unpacked segment wins
+def _files(directory):
+    files = {}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(".seg") or ( name.endswith(".gor") and name[:-4] not in files ):
+                files[name[:-4]] = name[-3:]
+    return files
+
+def compact(directory=seglog.LOG_DIR, keep=1):
+    """Pack all but the newest keep segments, returns how many were packed"""
+    segs = sorted([ n for n, kind in _files(directory).items() if kind == "seg" ])
+    packed = 0
+    for n in segs[:len(segs) - max(keep, 1)]:
+        seg = os.path.join(directory, n + ".seg")
+        gor = os.path.join(directory, n + ".gor")
+        f = open(seg, "rb")
+        data = f.read()
+        f.close()
+        if len(data) < seglog.HEADER.size or seglog.HEADER.unpack_from(data)[0] != seglog.MAGIC:
+            continue
+        f = open(gor + ".tmp", "wb")
+        f.write(encode_segment(data))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        # the segment only goes once the packed copy reads back the same
+        if _same(seglog._records(data), segment_records(gor + ".tmp")):
+            os.rename(gor + ".tmp", gor)
+            os.remove(seg)
+            packed += 1
+        else:
+            os.remove(gor + ".tmp")
+            print "history: %s did not read back the same packed, kept it" % seg
+    return packed
+
+_compacting = threading.Lock()
+
+# seglog.SegmentLog on_close hook, packs on a thread of its own
+def compact_async(directory):
+    def run():
+        if not _compacting.acquire(False):
+            return
+        try:
+            compact(directory)
+        except (IOError, OSError, ValueError) as e:
+            print "history: packing %s failed, %s" % ( directory, e )
+        finally:
+            _compacting.release()
+    thread = threading.Thread(target=run, name="history")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+#-----------------------------------------------------------------------------
+# Reading back
+#-----------------------------------------------------------------------------
+def _created(path):
+    f = open(path, "rb")
+    head = f.read(HEADER.size)
+    f.close()
+    if len(head) < HEADER.size:
+        return None
+    return HEADER.unpack(head)[3]
+
+# ( time, "node/chan", value, flags ) oldest first, packed or not, with
+# since <= time < until.  Every record of a segment was written before the
+# next segment was created, so segments older than since are not read at all.
+def records(directory=seglog.LOG_DIR, since=None, until=None):
+    names = {}
+    for key, cid in seglog._read_channels(directory).items():
+        names[cid] = key
+    files = _files(directory)
+    paths = [ os.path.join(directory, n + "." + files[n]) for n in sorted(files) ]
+    for i in range(len(paths)):
+        if since is not None and i + 1 < len(paths):
+            created = _created(paths[i + 1])
+            if created is not None and created < since:
+                continue
+        if paths[i].endswith(".gor"):
+            recs = segment_records(paths[i])
+        else:
+            f = open(paths[i], "rb")
+            recs = seglog._records(f.read())
+            f.close()
+        first = True
+        for t, cid, flags, value in recs:
+            if until is not None and t >= until:
+                if first:
+                    # this segment and all after it are later
+                    return
+                continue
+            first = False
+            if since is None or t >= since:
+                yield t, names.get(cid, "#%d" % cid), value, flags
+
+#-----------------------------------------------------------------------------
@@ -11,9 +11,16 @@
 #
 #
 import os
-import time
 #from smbus import SMBus
-from smbus2 import SMBus,i2c_msg
+from ..average import RingAverager
+from ..busmgr import BUSES
+from ..channel import Channel
+from .. import clock
+from .. import codec
+from .. import evloop
+from .. import registry
+from .. import hub
+from .. import steps
 from math import log10
 
 I2CBUS = 1
@@ -40,69 +47,78 @@ HTU21D_STATUS_LSBMASK     = 0b11111100
 
 # Maintain a 3 reading per minute moving average
 HTU21D_MAX = 3
-HTU21D_MAX_FLOAT = 3.0
 
-CRC_HTU = 0x00      # Instrumant Specialties HTU21D RH sensor
-CRC_SGP = 0xff      # Senserion VOC sensor
+
+#-----------------------------------------------------------------------------
+# Dew point in C from temperature in C and RH in %
+#-----------------------------------------------------------------------------
+def dew_point( temp, rh ):
+    A = 8.1332
+    B = 1762.39
+    C = 235.66
+    # data sheet page 16/21 Partial Pressure & Dew Point
+    pp = 10**( A - ( B / ( temp + C )))
+    return -(( B / ( log10( rh * pp / 100.0) - A )) + C )
+
+#-----------------------------------------------------------------------------
+# Absolute humidity in grams/M^3 from temperature in C and RH in %
+#-----------------------------------------------------------------------------
+def abs_humidity( temp, rh ):
+    e = 2.71828
+    a = 13.2473
+    b = e**((17.67 * temp)/(temp + 243.5))
+    c = 273.15 + temp
+    return a * b * rh / c
 
 
 #-----------------------------------------------------------------------------
 # HTU21D Measurement Specialties Temperature Humidity Sensor
 #-----------------------------------------------------------------------------
 class HTU21D:
-    
-    def __init__(self, name, i2c_addr):
+
+    # acquisition jobs and how sensd reports the main one, see registry.py
+    JOBS = ( ( "", "task_steps", 20, "low" ), )
+    REPORT = "%3.1f %3.1f"
+    # channel -> ( job publishing it, runs of that job per publish )
+    PUBLISHES = { "": ( "", 1 ) }
+
+    def __init__(self, name, i2c_addr=HTU21D_ADDR, bus=I2CBUS, directory=None, average=HTU21D_MAX):
         self.I2Caddr = i2c_addr
+        self.bus = bus
         
-        directory = "/tmp/" + name
+        if directory is None:
+            directory = "/tmp/" + name
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        self.FptrTC = directory + "/tc"
-        self.FptrRH = directory + "/rh"
-        self.FptrTD = directory + "/td"
-        self.FptrAH = directory + "/ah"
+        # T, RH and AH are what the VOC sensors compensate with
+        self.tc = Channel( directory, "tc", quantity=hub.TEMPERATURE )
+        self.rh = Channel( directory, "rh", quantity=hub.HUMIDITY )
+        self.td = Channel( directory, "td" )
+        self.ah = Channel( directory, "ah", quantity=hub.ABS_HUMIDITY )
         
         # For file handeling, maintaining the moving averages
-        self.temp_buff  = [ 0 ] * HTU21D_MAX
-        self.temp_ptr   = 0
-        self.humid_buff = [ 0 ] * HTU21D_MAX
-        self.humid_ptr  = 0  
-
-        self.init_buff = 1 # flag to fill buffers
+        self.temp_avg  = RingAverager( average )
+        self.humid_avg = RingAverager( average )
         
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte( self.I2Caddr, HTU21D_SOFT_RESET )
-            time.sleep(0.05)        
-            bus.close()
+            clock.sleep(0.05)        
             
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "htu21d.init() failed"
+        except Exception:
             print "htu21d.init() failed"
     
     
     #-----------------------------------------------------------------------------
     # CRC8 calculation for the HTU21D sensor
     #-----------------------------------------------------------------------------
-    # Need to provide device specific initial value: 
+    # see codec.py, responses are checked with codec.words()
     def crc8( self, value ):
-        crc = CRC_HTU
-        POLY = 0x31
-
-        for x in range(len(value)):
-            crc = crc ^ value[x]
-            for y in range(8):
-                if (crc & 0x80):
-                    crc = crc << 1
-                    crc = crc ^ POLY
-                else:
-                    crc = crc << 1
-            crc = crc & 0xff
-            
-        #print "htu21d.crc8() crc: 0x%02x" % crc        
-        
-        return crc
+        return codec.crc8( value, codec.CRC_HTU )
        
         
     #-----------------------------------------------------------------------------
@@ -110,6 +126,14 @@ class HTU21D:
     #-----------------------------------------------------------------------------
     # Call every 20 seconds
     def task(self):
+        return steps.run( self.task_steps() )
+
+    # task() on an event loop, the returned Task can be yielded on
+    def atask(self, loop=None):
+        return evloop.spawn( self.task_steps(), self.I2Caddr, loop )
+
+    # task() as a step generator, yields both conversion waits
+    def task_steps(self):
 
         temp  = 99999
         humid = 99999
@@ -118,51 +142,35 @@ class HTU21D:
         status = 0
         
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte( self.I2Caddr, HTU21D_READ_TEMP_NOHOLD )
-            time.sleep(0.05)
-            read = i2c_msg.read( self.I2Caddr, 3 )
+            yield 0.05
+            bus = BUSES.get(self.bus)
+            read = BUSES.read_msg( self.I2Caddr, 3 )
             bus.i2c_rdwr(read)
-            resp = list(read)
+            t = codec.words( read, 1, codec.CRC_HTU )[0]
 
-            if ( self.crc8(resp) == 0 ):
+            if t is not None:
                 status += 1
                 # data sheet 15/21 Temperature Conversion
-                t = (resp[0] << 8) | (resp[1] & HTU21D_STATUS_LSBMASK)
+                t &= ~HTU21D_STATUS_BITMASK
                 temp = ((175.72 * t) / 65536.0) - 46.86 
 
-                self.temp_buff[self.temp_ptr] = temp
-                self.temp_ptr += 1
-                if self.temp_ptr >= HTU21D_MAX:
-                    self.temp_ptr = 0
-
-                # runs first pass only
-                if self.init_buff :
-                    for i in range(HTU21D_MAX):
-                        self.temp_buff[i] = temp
-                # need to init humid_buff[] too
-                # so don't clear self.init_buff flag here
-            
-                avg_temp = 0
-                for i in range(HTU21D_MAX):
-                    avg_temp += self.temp_buff[i]
-                avg_temp /= HTU21D_MAX_FLOAT
-
-                f = open(self.FptrTC,"w")
-                f.write("%3.1f" % avg_temp)
-                f.close()
+                self.temp_avg.add( temp )
+                self.tc.sample( temp )
+                self.tc.publish( self.temp_avg.mean() )
                 
             bus.write_byte( self.I2Caddr, HTU21D_READ_HUM_NOHOLD )
-            time.sleep(0.05)
-            read = i2c_msg.read( self.I2Caddr, 3 )
+            yield 0.05
+            bus = BUSES.get(self.bus)
+            read = BUSES.read_msg( self.I2Caddr, 3 )
             bus.i2c_rdwr(read)
-            resp = list(read)
-            bus.close()
+            h = codec.words( read, 1, codec.CRC_HTU )[0]
 
-            if( self.crc8( resp ) == 0 ):
+            if h is not None:
                 status += 1
                 # data sheet 15/21 Relative Humidity
-                h = (resp[0] << 8) | (resp[1] & HTU21D_STATUS_LSBMASK)
+                h &= ~HTU21D_STATUS_BITMASK
                 humid = ((125.0 * h) / 65536.0) - 6.0 
             
                 # limit for out of range values
@@ -174,64 +182,43 @@ class HTU21D:
                 
                 # RH compensation per datasheet page: 4/12    
                 # JUN 28, 2018 changed to avg_temp
+                # the last average if this temperature read failed,
+                # none at all before the first one
+                avg_temp = self.temp_avg.mean()
+                if avg_temp is None:
+                    avg_temp = 25.0
                 rh = humid + ( 25.0 - avg_temp) * -0.15    
 
-                self.humid_buff[self.humid_ptr] = rh
-                self.humid_ptr += 1
-                if self.humid_ptr >= HTU21D_MAX:
-                    self.humid_ptr = 0
-            
-                # runs first pass only
-                if self.init_buff :
-                    for i in range(HTU21D_MAX):
-                        self.humid_buff[i] = rh
-                        self.init_buff = 0
-           
-                avg_humid = 0
-                for i in range(HTU21D_MAX):
-                    avg_humid += self.humid_buff[i]
-                avg_humid /= HTU21D_MAX_FLOAT
-
-                f = open(self.FptrRH,"w")
-                f.write("%3.1f" % avg_humid)
-                f.close()
+                self.humid_avg.add( rh )
+                self.rh.sample( rh )
+                avg_humid = self.humid_avg.mean()
+                self.rh.publish( avg_humid )
     
             # with both valid temperature and RH 
             # calculate the dew point and absolute humidity using average values
             if status > 1:
             
-                # Calculate dew point
-            
                 # because log of zero is not possible
                 if avg_humid < 0.1:
                     avg_humid = 0.1
-                A = 8.1332
-                B = 1762.39
-                C = 235.66
-                # data sheet page 16/21 Partial Pressure & Dew Point  
-                pp = 10**( A - ( B / ( avg_temp + C )))            
-                tdew = -(( B / ( log10( avg_humid * pp / 100.0) - A )) + C ) 
-            
-                f = open(self.FptrTD,"w")
-                f.write("%3.1f" % tdew)
-                f.close()
-
-                # Calculate absolute humidity in grams/M^3
-                e = 2.71828
-                a = 13.2473
-                b = e**((17.67 * avg_temp)/(avg_temp + 243.5))
-                c = 273.15 + avg_temp
-                ah = a * b * avg_humid / c
-            
-                f = open(self.FptrAH,"w")
-                f.write("%3.1f" % ah)
-                f.close()
+
+                tdew = dew_point( avg_temp, avg_humid )
+                self.td.sample( tdew )
+                self.td.publish( tdew )
+
+                ah = abs_humidity( avg_temp, avg_humid )
+                self.ah.sample( ah )
+                self.ah.publish( ah )
 
             #print "htu21d.task() T: %3.1f RH: %3.1f Tdew: %3.1f AH: %3.1f" %  ( avg_temp, avg_humid, tdew, ah )
         
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "htu21d.task() failed"
+        except Exception:
             print "htu21d.task() failed"
             
         # returning average values
-        return [ temp, humid, tdew ]        
+        yield steps.Done( [ temp, humid, tdew ] )
+
+registry.register("htu21d", HTU21D)
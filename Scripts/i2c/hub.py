@@ -0,0 +1,226 @@
+#!/usr/bin/python
+#
+# Where published channel values go
+# Raspberry Pi
+#
+# Every Channel registers with the process wide HUB and hands it each
+# published value.  The hub passes the channel on to its sinks:
+#
+#   FileSink      the legacy layout, /tmp/<name>/<chan> and <chan>.stats,
+#                 on unless I2C_LEGACY_FILES=0 is in the environment
+#   SnapshotSink  one file for the whole node, written after every
+#                 acquisition cycle by commit()
+#   ShmSink       every publish into a shared memory ring, see shmring.py
+#   PubSubSink    every publish to socket subscribers, see pubsub.py
+#   MqttSink      batches of published values to a broker, see mqtt.py
+#   SegmentLog    every publish to a binary log on the USB drive, see seglog.py
+#
+# All files are written to a temporary name and renamed over the old one,
+# so a reader sees either the previous or the new contents, never half.
+#
+# Channels that measure one of the QUANTITIES, temperature for one, are
+# made with quantity= set.  Drivers that compensate for it subscribe() to
+# the quantity rather than to a sensor, and are called with the channel on
+# every publish of it, from HTU21D or BME680 alike (channel.Input keeps the
+# latest one).
+#
+# The snapshot comes as compact JSON
+#
+#   {"seq":<cycle>,"t":<time>,"sensors":{"HTU21D":{"tc":{"seq":<n>,"t":<time>,"v":<value>},...},...}}
+#
+# with "c", the seconds between publishes of the channel, 0 for none
+# regular, in the channels sensd knows the cadence of (registry.cadences()),
+# and as a fixed layout little endian binary file for readers that would
+# rather not parse text, a header followed by one record per channel in
+# the order the channels were created:
+#
+#   header  4s magic "I2CS", H version, H channels, I cycle, d time
+#   record  8s node, 8s channel, d value (NaN before the first publish),
+#           d time, I seq, 4 pad bytes
+#
+# Names are NUL padded.  Times are seconds since the epoch from clock.wall().
+#
+import json
+import os
+import struct
+
+from . import clock
+
+SNAPSHOT_JSON = "/tmp/sensd.json"
+SNAPSHOT_BIN  = "/tmp/sensd.bin"
+
+SNAPSHOT_MAGIC   = "I2CS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER  = struct.Struct("<4sHHId")
+SNAPSHOT_RECORD  = struct.Struct("<8s8sddI4x")
+
+NAN = float("nan")
+
+# quantities drivers compensate for -> unit
+TEMPERATURE  = "temperature"
+HUMIDITY     = "humidity"
+ABS_HUMIDITY = "abs_humidity"
+QUANTITIES = { TEMPERATURE:  "C",
+               HUMIDITY:     "%RH",
+               ABS_HUMIDITY: "g/m^3" }
+
+
+#-----------------------------------------------------------------------------
+# Write and rename
+#-----------------------------------------------------------------------------
+def replace_file(path, data, mode="w"):
+    tmp = path + ".tmp"
+    f = open(tmp, mode)
+    f.write(data)
+    f.close()
+    os.rename(tmp, path)
+
+
+#-----------------------------------------------------------------------------
+# Legacy one file per value layout
+#-----------------------------------------------------------------------------
+class FileSink:
+
+    def channel(self, ch):
+        replace_file( ch.path, ch.text() )
+        if ch.stats is not None:
+            replace_file( ch.path + ".stats", ch.format_stats() )
+
+    def cycle(self, hub):
+        pass
+
+
+#-----------------------------------------------------------------------------
+# Whole node snapshot, JSON and binary
+#-----------------------------------------------------------------------------
+class SnapshotSink:
+
+    def __init__(self, json_path=SNAPSHOT_JSON, bin_path=SNAPSHOT_BIN):
+        self.json_path = json_path     # None to skip either one
+        self.bin_path = bin_path
+
+    def channel(self, ch):
+        pass
+
+    def cycle(self, hub):
+        if self.json_path is not None:
+            replace_file( self.json_path, self.json(hub) )
+        if self.bin_path is not None:
+            replace_file( self.bin_path, self.binary(hub), "wb" )
+
+    def json(self, hub):
+        sensors = {}
+        for ch in hub.channels:
+            node = sensors.setdefault(ch.node, {})
+            node[ch.name] = { "v": ch.value, "t": ch.stamp, "seq": ch.seq }
+            if ch.cadence is not None:
+                node[ch.name]["c"] = ch.cadence
+        snap = { "seq": hub.seq, "t": hub.stamp, "sensors": sensors }
+        return json.dumps(snap, sort_keys=True, separators=(",", ":"))
+
+    def binary(self, hub):
+        parts = [ SNAPSHOT_HEADER.pack( SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                        len(hub.channels), hub.seq, hub.stamp ) ]
+        for ch in hub.channels:
+            value = ch.value
+            if value is None:
+                value = NAN
+            parts.append( SNAPSHOT_RECORD.pack( ch.node, ch.name, value,
+                                                ch.stamp or 0.0, ch.seq ) )
+        return "".join(parts)
+
+
+#-----------------------------------------------------------------------------
+# Process wide channel registry
+#-----------------------------------------------------------------------------
+class Hub:
+
+    def __init__(self, sinks=None):
+        self.channels = []     # in the order they were created
+        self.index = {}        # "node/chan" -> position in channels
+        self.sinks = sinks
+        self.seq = 0           # cycles committed
+        self.stamp = None      # clock.wall() of the last commit
+        self.dirty = False
+        self.subscribers = {}  # quantity -> [ callback(ch) ]
+
+    def _sinks(self):
+        if self.sinks is None:
+            self.sinks = []
+            if os.environ.get("I2C_LEGACY_FILES") != "0":
+                self.sinks.append( FileSink() )
+        return self.sinks
+
+    #-----------------------------------------------------------------------------
+    # A channel created again for the same node takes over the old slot
+    #-----------------------------------------------------------------------------
+    def add(self, ch):
+        key = ch.node + "/" + ch.name
+        if key in self.index:
+            self.channels[self.index[key]] = ch
+        else:
+            self.index[key] = len(self.channels)
+            self.channels.append(ch)
+
+    # a late sink is given what has already been published
+    def add_sink(self, sink):
+        self._sinks().append(sink)
+        for ch in self.channels:
+            if ch.seq:
+                sink.channel(ch)
+
+    def remove_sink(self, sink):
+        self._sinks().remove(sink)
+
+    #-----------------------------------------------------------------------------
+    # Every publish of a quantity, starting with the latest one already out
+    #-----------------------------------------------------------------------------
+    def subscribe(self, quantity, callback):
+        if quantity not in QUANTITIES:
+            raise ValueError("hub: no quantity %s" % quantity)
+        self.subscribers.setdefault(quantity, []).append(callback)
+        latest = None
+        for ch in self.channels:
+            if ch.quantity == quantity and ch.seq and ( latest is None or ch.stamp >= latest.stamp ):
+                latest = ch
+        if latest is not None:
+            callback(latest)
+
+    def unsubscribe(self, quantity, callback):
+        self.subscribers.get(quantity, []).remove(callback)
+
+    # from Channel.publish(), a failing sink must not look like a bus fault
+    def publish(self, ch):
+        self.dirty = True
+        for sink in self._sinks():
+            try:
+                sink.channel(ch)
+            except:
+                print "hub.publish() %s failed" % sink.__class__.__name__
+        if ch.quantity is not None:
+            for callback in self.subscribers.get(ch.quantity, ()):
+                try:
+                    callback(ch)
+                except:
+                    print "hub.publish() %s subscriber failed" % ch.quantity
+
+    #-----------------------------------------------------------------------------
+    # End of an acquisition cycle, the sinks write out whatever was published
+    #-----------------------------------------------------------------------------
+    def commit(self):
+        if not self.dirty:
+            return False
+        self.dirty = False
+        self.seq += 1
+        self.stamp = clock.wall()
+        for sink in self._sinks():
+            try:
+                sink.cycle(self)
+            except:
+                print "hub.commit() %s failed" % sink.__class__.__name__
+        return True
+
+
+HUB = Hub()
+
+#-----------------------------------------------------------------------------
@@ -12,8 +12,13 @@
 #
 #
 import os
-import time
-from smbus2 import SMBus, i2c_msg
+from ..average import RingAverager
+from ..busmgr import BUSES
+from ..channel import Channel
+from .. import codec
+from .. import evloop
+from .. import registry
+from .. import steps
 
 I2CBUS = 1
 
@@ -41,18 +46,25 @@ CO2_MAX = 3
 #------------------------------------------------------------------------------
 class K30:
 
-    def __init__( self, name, i2c_addr ):
+    # acquisition jobs and how sensd reports the main one, see registry.py
+    JOBS = ( ( "", "task_steps", 20, "low" ), )
+    REPORT = "%d"
+    # channel -> ( job publishing it, runs of that job per publish )
+    PUBLISHES = { "": ( "", 1 ) }
+
+    def __init__( self, name, i2c_addr=K30_ADDR, bus=I2CBUS, directory=None, average=CO2_MAX ):
         self.I2Caddr = i2c_addr
+        self.bus = bus
 
-        directory = "/tmp/" + name
+        if directory is None:
+            directory = "/tmp/" + name
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        self.FptrCO2 = directory + "/co2"
+        self.co2 = Channel( directory, "co2", "%d" )
 
-        # init for 400ppm CO2
-        self.co2_buff = [ 400 ] * CO2_MAX
-        self.co2_ptr = 0
+        # rolling average of the last average readings, CO2_MAX by default
+        self.co2_avg = RingAverager( average )
 
 
     #------------------------------------------------------------------------------
@@ -60,20 +72,28 @@ class K30:
     #------------------------------------------------------------------------------    
     # typically called evey 20 seconds for 1 minute moving average
     def task(self):
+        return steps.run( self.task_steps() )
+
+    # task() on an event loop, the returned Task can be yielded on
+    def atask(self, loop=None):
+        return evloop.spawn( self.task_steps(), self.I2Caddr, loop )
+
+    # task() as a step generator, yields the conversion wait
+    def task_steps(self):
 
         co2_val = 99999
 
         try:
 
-            bus =  SMBus(I2CBUS)
-            write = i2c_msg.write( self.I2Caddr, K30_MSG)
+            bus =  BUSES.get(self.bus)
+            write = BUSES.write_msg( self.I2Caddr, K30_MSG)
             bus.i2c_rdwr(write)
-            time.sleep(0.02)
-            read = i2c_msg.read( self.I2Caddr, 4)
+            yield 0.02
+            bus = BUSES.get(self.bus)
+            read = BUSES.read_msg( self.I2Caddr, 4)
             bus.i2c_rdwr(read)
-            resp = list(read)
-            bus.close()
-            #print resp
+            resp = codec.buffer(read)
+            #print list(resp)
 
             cs = resp[0] + resp[1] + resp[2]
             cs &= 0xff
@@ -86,26 +106,22 @@ class K30:
 
                     # read of i2c co2 value passes muster
                     # include it in the rolling average
-                    self.co2_buff[self.co2_ptr] = co2_val
-                    self.co2_ptr += 1
-                    if self.co2_ptr >= CO2_MAX:
-                        self.co2_ptr = 0
-
-                    co2_avg = 0
-                    for i in range(CO2_MAX):
-                        co2_avg += self.co2_buff[i]
-                    co2_avg /= CO2_MAX
+                    self.co2_avg.add( co2_val )
+                    self.co2.sample( co2_val )
+                    co2_avg = int( self.co2_avg.mean() )
 
                     #print "CO2: %d" % co2_avg
-                    f = open(self.FptrCO2, "w")
-                    f.write("%d" % co2_avg)
-                    f.close()
+                    self.co2.publish( co2_avg )
 
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "k30.task() failed"
+        except Exception:
             print "k30.task() failed"
             
-        return co2_val
+        yield steps.Done( co2_val )
            
 
     #------------------------------------------------------------------------------
+
+registry.register("k30", K30)
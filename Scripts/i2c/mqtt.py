@@ -0,0 +1,431 @@
+#!/usr/bin/python
+#
+# Batched MQTT publishing from inside sensd
+# Raspberry Pi
+#
+# MqttSink is a hub sink (hub.py) that collects every published value and,
+# at the end of an acquisition cycle, closes a batch once it holds BATCH
+# samples, BATCH_BYTES of payload or is BATCH_SECONDS old.  A batch goes out
+# as one message on sensd/<host>:
+#
+#   {"host":"pi","seq":<batch>,"samples":[["HTU21D/tc",<time>,<value>,<seq>],...]}
+#
+# The network side runs on its own thread so a slow or missing broker never
+# holds up the bus.  Messages go out with QoS 1 by default, up to INFLIGHT
+# of them at a time before waiting for the broker's acknowledgements.  With
+# QoS 0 a message counts as delivered once it is handed to the client.
+#
+# While the broker can't be reached, and for messages it did not acknowledge
+# in ACK_TIMEOUT, batches are spooled to an outbox directory, meant to be on
+# the USB drive rather than the SD card.  The outbox keeps at most
+# OUTBOX_FILES batches and OUTBOX_BYTES on disk, dropping the oldest.  Once
+# the broker is back, new batches go first and the backlog is drained
+# oldest first at no more than DRAIN_RATE messages a second.
+#
+# paho-mqtt is only needed for a real broker.  MQTT_BACKEND=sim in the
+# environment, or a mqttsim.SimTransport handed to MqttSink, swaps in the
+# broker stand-in (mqttsim.py).
+#
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+from . import clock
+
+HOST = "localhost"
+PORT = 1883
+TOPIC = "sensd/%s"        # % host name
+QOS = 1
+
+BATCH = 60                # samples
+BATCH_BYTES = 16384       # payload bytes
+BATCH_SECONDS = 60.0
+
+INFLIGHT = 16             # unacknowledged messages
+ACK_TIMEOUT = 10.0        # seconds
+RETRY = 5.0               # first reconnect wait, doubled up to RETRY_MAX
+RETRY_MAX = 300.0
+DRAIN_RATE = 2.0          # backlog messages per second
+PENDING = 1000            # batches held in memory when the outbox can't take them
+
+OUTBOX = "/media/usb/sensd-outbox"
+OUTBOX_FILES = 10000
+OUTBOX_BYTES = 50 * 1024 * 1024
+
+
+#-----------------------------------------------------------------------------
+# MQTT client backend
+#-----------------------------------------------------------------------------
+class PahoTransport:
+
+    def __init__(self, host=HOST, port=PORT, client_id=None, keepalive=60):
+        import paho.mqtt.client as paho
+        self.paho = paho
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.client = paho.Client(client_id=client_id or "sensd-" + socket.gethostname())
+        self.client.max_inflight_messages_set(INFLIGHT)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.up = False
+        self.started = False
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.up = rc == 0
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.up = False
+
+    def connect(self, timeout=ACK_TIMEOUT):
+        self.client.connect(self.host, self.port, self.keepalive)
+        if not self.started:
+            self.client.loop_start()
+            self.started = True
+        end = clock.monotonic() + timeout
+        while not self.up and clock.monotonic() < end:
+            time.sleep(0.05)
+        if not self.up:
+            raise IOError("mqtt: no CONNACK from %s:%d" % ( self.host, self.port ))
+
+    def connected(self):
+        return self.up
+
+    # a token with is_published(), IOError if the client has no connection
+    def publish(self, topic, payload, qos):
+        info = self.client.publish(topic, payload, qos)
+        if info.rc != self.paho.MQTT_ERR_SUCCESS:
+            raise IOError("mqtt: publish failed rc %d" % info.rc)
+        return info
+
+    def close(self):
+        self.up = False
+        try:
+            self.client.disconnect()
+        except:
+            pass
+        if self.started:
+            self.client.loop_stop()
+            self.started = False
+
+
+def _default_backend(host, port):
+    if os.environ.get("MQTT_BACKEND") == "sim":
+        from . import mqttsim
+        return mqttsim.SimTransport(mqttsim.default_broker())
+    return PahoTransport(host, port)
+
+
+#-----------------------------------------------------------------------------
+# Store and forward directory, one file per batch
+#-----------------------------------------------------------------------------
+class Outbox:
+
+    def __init__(self, directory=OUTBOX, files=OUTBOX_FILES, size=OUTBOX_BYTES):
+        self.directory = directory
+        self.max_files = files
+        self.max_bytes = size
+        self.names = collections.deque()   # oldest first
+        self.sizes = {}
+        self.bytes = 0
+        self.next = 0
+        self.dropped = 0                   # batches lost to the size limits
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    self._index(name, os.path.getsize(os.path.join(directory, name)))
+            if self.names:
+                self.next = int(self.names[-1][:-5]) + 1
+
+    def _index(self, name, size):
+        self.names.append(name)
+        self.sizes[name] = size
+        self.bytes += size
+
+    def __len__(self):
+        return len(self.names)
+
+    # IOError/OSError when the drive is not there or full
+    def put(self, payload):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = "%012d.json" % self.next
+        path = os.path.join(self.directory, name)
+        f = open(path + ".tmp", "w")
+        f.write(payload)
+        f.close()
+        os.rename(path + ".tmp", path)
+        self.next += 1
+        self._index(name, len(payload))
+        while len(self.names) > self.max_files or self.bytes > self.max_bytes:
+            self.remove(self.names[0])
+            self.dropped += 1
+
+    # oldest n ( name, payload ), unreadable files are skipped and removed
+    def peek(self, n):
+        out = []
+        for name in list(self.names)[:n]:
+            try:
+                f = open(os.path.join(self.directory, name))
+                out.append( ( name, f.read() ) )
+                f.close()
+            except IOError:
+                self.remove(name)
+        return out
+
+    def remove(self, name):
+        if name not in self.sizes:
+            return
+        self.names.remove(name)
+        self.bytes -= self.sizes.pop(name)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+#-----------------------------------------------------------------------------
+# Hub sink and sender thread
+#-----------------------------------------------------------------------------
+class MqttSink:
+
+    def __init__(self, host=HOST, port=PORT, topic=None, qos=QOS,
+                 batch=BATCH, batch_bytes=BATCH_BYTES, batch_seconds=BATCH_SECONDS,
+                 outbox=OUTBOX, transport=None, start=True):
+        self.node = socket.gethostname()
+        self.topic = topic or TOPIC % self.node
+        self.qos = qos
+        self.batch = batch
+        self.batch_bytes = batch_bytes
+        self.batch_seconds = batch_seconds
+        self.transport = transport or _default_backend(host, port)
+        self.outbox = Outbox(outbox)
+
+        self.lock = threading.Condition()
+        self.samples = []         # [ "node/chan", t, value, seq ]
+        self.size = 0             # rough payload bytes of samples
+        self.opened = None        # clock.now() of the first sample
+        self.seq = 0              # batches made
+        self.pending = collections.deque()    # batches for the sender
+        self.lost = 0             # batches neither sent nor spooled
+
+        self.retry = RETRY
+        self.retry_at = 0.0
+        self.credit = 0.0         # backlog messages that may go now
+        self.credit_at = None
+        self.sent = 0
+        self.drained = 0
+        self.spooled = 0
+        self.unwritable = 0       # failed attempts to write the outbox
+        self.outbox_ok = True
+
+        self.stopped = False
+        self.thread = None
+        if start:
+            self.thread = threading.Thread(target=self.run, name="mqtt")
+            self.thread.daemon = True
+            self.thread.start()
+
+    #-----------------------------------------------------------------------------
+    # Hub sink calls
+    #-----------------------------------------------------------------------------
+    def channel(self, ch):
+        if ch.value is None:
+            return
+        with self.lock:
+            if self.opened is None:
+                self.opened = clock.now()
+            key = ch.node + "/" + ch.name
+            self.samples.append( [ key, ch.stamp, ch.value, ch.seq ] )
+            self.size += len(key) + 48
+
+    def cycle(self, hub):
+        with self.lock:
+            if not self.samples:
+                return
+            if len(self.samples) < self.batch and self.size < self.batch_bytes \
+                    and clock.now() - self.opened < self.batch_seconds:
+                return
+            self._close_batch()
+
+    # close the current batch now, whatever its size
+    def flush(self):
+        with self.lock:
+            if self.samples:
+                self._close_batch()
+
+    def _close_batch(self):
+        self.seq += 1
+        payload = json.dumps({ "host": self.node, "seq": self.seq, "samples": self.samples },
+                             separators=(",", ":"))
+        self.samples = []
+        self.size = 0
+        self.opened = None
+        self.pending.append(payload)
+        while len(self.pending) > PENDING:
+            self.pending.popleft()
+            self.lost += 1
+        self.lock.notify()
+
+    # the batches not sent yet go to the outbox, to be sent after a restart
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            batches = list(self.pending)
+            self.pending.clear()
+        self._spool(batches)
+        self.transport.close()
+
+    # at exit, the open batch included
+    def close(self):
+        self.flush()
+        self.stop()
+
+    #-----------------------------------------------------------------------------
+    # Sender thread
+    #-----------------------------------------------------------------------------
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.stopped:
+                    self.lock.wait(1.0)
+                if self.stopped:
+                    break
+            self.step()
+
+    def step(self):
+        with self.lock:
+            batches = list(self.pending)
+            self.pending.clear()
+
+        if not self._connect():
+            self._spool(batches)
+            return
+
+        left = self._send(batches)
+        if left:
+            self._spool(left)
+            return
+        self._drain()
+
+    def _connect(self):
+        if self.transport.connected():
+            return True
+        now = clock.now()
+        if now < self.retry_at:
+            return False
+        try:
+            self.transport.connect()
+            self.retry = RETRY
+            self.credit_at = None
+            print "mqtt: connected, %d batches in the outbox" % len(self.outbox)
+            return True
+        except:
+            self.retry_at = now + self.retry
+            self.retry = min(self.retry * 2, RETRY_MAX)
+            return False
+
+    #-----------------------------------------------------------------------------
+    # Publish a window at a time, returns the batches that did not get through
+    #-----------------------------------------------------------------------------
+    def _send(self, batches, delivered=None):
+        done = 0
+        while done < len(batches):
+            window = batches[done:done + INFLIGHT]
+            tokens = []
+            try:
+                for payload in window:
+                    tokens.append( self.transport.publish(self.topic, payload, self.qos) )
+            except:
+                self.transport.close()
+                return batches[done:]
+            if self.qos > 0:
+                end = clock.monotonic() + ACK_TIMEOUT
+                while not all([ t.is_published() for t in tokens ]):
+                    if clock.monotonic() > end or not self.transport.connected():
+                        self.transport.close()
+                        # whatever was acknowledged is through
+                        acked = 0
+                        while acked < len(tokens) and tokens[acked].is_published():
+                            acked += 1
+                        self._delivered(delivered, done, done + acked)
+                        return batches[done + acked:]
+                    time.sleep(0.01)
+            self._delivered(delivered, done, done + len(window))
+            done += len(window)
+        return []
+
+    def _delivered(self, delivered, start, end):
+        if delivered is None:
+            self.sent += end - start
+        else:
+            delivered(start, end)
+
+    # said once when the drive goes and once when it is back, the failed
+    # tries in between are counted in stats()
+    def _spool(self, batches):
+        for i in range(len(batches)):
+            try:
+                self.outbox.put(batches[i])
+                self.spooled += 1
+                if not self.outbox_ok:
+                    print "mqtt: outbox %s writable again" % self.outbox.directory
+                    self.outbox_ok = True
+            except (IOError, OSError):
+                # no drive, hold the rest for the next try
+                self.unwritable += 1
+                if self.outbox_ok:
+                    print "mqtt: outbox %s not writable" % self.outbox.directory
+                    self.outbox_ok = False
+                with self.lock:
+                    self.pending.extendleft(reversed(batches[i:]))
+                    while len(self.pending) > PENDING:
+                        self.pending.popleft()
+                        self.lost += 1
+                return
+
+    #-----------------------------------------------------------------------------
+    # Backlog, oldest first at DRAIN_RATE
+    #-----------------------------------------------------------------------------
+    def _drain(self):
+        if not len(self.outbox):
+            return
+        now = clock.now()
+        if self.credit_at is None:
+            self.credit_at = now
+        self.credit = min(self.credit + (now - self.credit_at) * DRAIN_RATE, INFLIGHT)
+        self.credit_at = now
+        n = int(self.credit)
+        if n == 0:
+            return
+        items = self.outbox.peek(n)
+        names = [ name for name, payload in items ]
+
+        # only what got through spends credit, a failed try costs nothing
+        def delivered(start, end):
+            for name in names[start:end]:
+                self.outbox.remove(name)
+            self.drained += end - start
+            self.credit -= end - start
+
+        self._send([ payload for name, payload in items ], delivered)
+
+    def stats(self):
+        with self.lock:
+            return { "batches": self.seq,
+                     "sent": self.sent,
+                     "spooled": self.spooled,
+                     "drained": self.drained,
+                     "outbox": len(self.outbox),
+                     "outbox_dropped": self.outbox.dropped,
+                     "outbox_unwritable": self.unwritable,
+                     "lost": self.lost }
+
+#-----------------------------------------------------------------------------
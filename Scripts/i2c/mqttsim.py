@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# MQTT broker stand-in
+# Raspberry Pi (or any Linux box)
+#
+# An in-memory broker for mqtt.py so the batching, outbox and backlog
+# draining can be run without paho-mqtt or a network.  The broker can be
+# taken down and brought back, and can hold back its acknowledgements, to
+# exercise the store and forward paths.
+#
+# Use it with:
+#   MQTT_BACKEND=sim ./sensd
+# or from python:
+#   broker = mqttsim.SimBroker()
+#   sink = mqtt.MqttSink(transport=mqttsim.SimTransport(broker))
+#
+import threading
+
+
+#-----------------------------------------------------------------------------
+# Delivery token, like paho's MQTTMessageInfo
+#-----------------------------------------------------------------------------
+class SimToken(object):
+
+    def __init__(self):
+        self.acked = False
+
+    def is_published(self):
+        return self.acked
+
+
+#-----------------------------------------------------------------------------
+# The broker
+#-----------------------------------------------------------------------------
+class SimBroker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.up = True
+        self.hold_acks = False      # leave QoS 1 messages unacknowledged
+        self.messages = []          # ( topic, payload, qos ) as received
+        self.unacked = []           # tokens held back
+        self.connects = 0
+        self.outages = 0            # times it went down, drops every connection
+
+    def set_up(self, up):
+        with self.lock:
+            if self.up and not up:
+                # the connections are gone, nothing more will be acknowledged
+                self.outages += 1
+                self.unacked = []
+            self.up = up
+
+    def set_hold_acks(self, hold):
+        with self.lock:
+            self.hold_acks = hold
+            if not hold:
+                for token in self.unacked:
+                    token.acked = True
+                self.unacked = []
+
+    def publish(self, topic, payload, qos):
+        with self.lock:
+            if not self.up:
+                raise IOError("mqttsim: broker down")
+            self.messages.append( ( topic, payload, qos ) )
+            token = SimToken()
+            if qos == 0 or not self.hold_acks:
+                token.acked = True
+            else:
+                self.unacked.append(token)
+            return token
+
+
+#-----------------------------------------------------------------------------
+# Client side, the same calls as mqtt.PahoTransport
+#-----------------------------------------------------------------------------
+class SimTransport:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.up = False
+        self.outage = None      # broker outages when connected
+
+    def connect(self, timeout=None):
+        if not self.broker.up:
+            raise IOError("mqttsim: connection refused")
+        self.broker.connects += 1
+        self.outage = self.broker.outages
+        self.up = True
+
+    def connected(self):
+        return self.up and self.broker.up and self.outage == self.broker.outages
+
+    def publish(self, topic, payload, qos):
+        if not self.connected():
+            self.up = False
+            raise IOError("mqttsim: not connected")
+        return self.broker.publish(topic, payload, qos)
+
+    def close(self):
+        self.up = False
+
+
+BROKER = None
+
+def default_broker():
+    global BROKER
+    if BROKER is None:
+        BROKER = SimBroker()
+    return BROKER
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+#
+# Push published values to subscribers over a Unix domain socket
+# Raspberry Pi
+#
+# PubSubSink is a hub sink (hub.py) with its own thread serving
+# /tmp/sensd.sock.  A subscriber connects and sends lines of
+#
+#   SUB SGP30/voc K30/co2     start getting these channels, * for all
+#   UNSUB SGP30/voc           stop, * for all
+#
+# and gets one JSON line per publish of a channel it is subscribed to,
+# starting with the current value when it subscribes:
+#
+#   {"ch":"SGP30/voc","seq":12,"t":1639000000.5,"v":25}
+#
+# Errors come back as {"error":"..."}.
+#
+# Publishing only formats the line and queues it, the socket writes are
+# all done by the server thread, so a slow subscriber never holds up the
+# bus.  Each subscriber has a queue of at most QUEUE lines.  When it
+# overflows the queue is coalesced to the latest line per channel; a
+# subscriber whose queue still overflows, or that has not taken any data
+# for DROP_AFTER seconds while some was waiting, is disconnected.
+#
+# A socket left at the path by a sensd that is gone is replaced, but one
+# that still takes connections belongs to a live sensd or sensdsup and the
+# sink refuses to start rather than take it over.
+#
+import collections
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+import threading
+
+from . import clock
+
+SOCK_PATH = "/tmp/sensd.sock"
+
+QUEUE = 256          # lines waiting per subscriber
+DROP_AFTER = 30.0    # seconds a subscriber may leave its socket full
+SEND_MAX = 65536     # bytes handed to one send()
+
+
+def _nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+# remove the socket at path unless something still listens on it
+def _remove_stale(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        probe.close()
+        if e.args[0] != errno.ECONNREFUSED:
+            raise
+        os.remove(path)
+        return
+    probe.close()
+    raise socket.error(errno.EADDRINUSE, "pubsub: %s is in use, is another sensd running?" % path)
+
+def message(key, value, t, seq):
+    return json.dumps({ "ch": key, "v": value, "t": t, "seq": seq },
+                      sort_keys=True, separators=(",", ":")) + "\n"
+
+
+#-----------------------------------------------------------------------------
+# One connected subscriber
+#-----------------------------------------------------------------------------
+class Subscriber:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = ""
+        self.outbuf = ""
+        self.queue = collections.deque()    # ( "node/chan", line )
+        self.channels = set()
+        self.all = False
+        self.blocked = None     # clock.monotonic() since data has been waiting
+        self.coalesced = 0      # lines dropped in favour of a newer one
+        self.behind = False     # to be dropped for not keeping up
+        self.dead = False
+
+    def wants(self, key):
+        return self.all or key in self.channels
+
+    def waiting(self):
+        return bool(self.outbuf or self.queue)
+
+    #-----------------------------------------------------------------------------
+    # Queue a line, keeping only the latest per channel when it gets full
+    #-----------------------------------------------------------------------------
+    def push(self, key, line, limit):
+        self.queue.append( ( key, line ) )
+        if len(self.queue) <= limit:
+            return
+        seen = set()
+        kept = collections.deque()
+        for item in reversed(self.queue):
+            if item[0] not in seen:
+                seen.add(item[0])
+                kept.appendleft(item)
+        self.coalesced += len(self.queue) - len(kept)
+        self.queue = kept
+        if len(kept) > limit:
+            self.behind = True
+
+
+#-----------------------------------------------------------------------------
+# Socket server and hub sink
+#-----------------------------------------------------------------------------
+class PubSubSink:
+
+    def __init__(self, path=SOCK_PATH, queue=QUEUE):
+        self.path = path
+        self.limit = queue
+        self.lock = threading.Lock()
+        self.subs = []
+        self.latest = {}        # "node/chan" -> ( value, t, seq )
+        self.dropped = 0        # subscribers disconnected for falling behind
+        self.stopped = False
+
+        _remove_stale(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(8)
+        self.listener.setblocking(0)
+
+        # publish() wakes the server thread through this pipe
+        self.wake_r, self.wake_w = os.pipe()
+        _nonblocking(self.wake_r)
+        _nonblocking(self.wake_w)
+
+        self.thread = threading.Thread(target=self.run, name="pubsub")
+        self.thread.daemon = True
+        self.thread.start()
+
+    #-----------------------------------------------------------------------------
+    # Hub sink calls, from whichever thread runs the drivers
+    #-----------------------------------------------------------------------------
+    def channel(self, ch):
+        key = ch.node + "/" + ch.name
+        line = None
+        with self.lock:
+            self.latest[key] = ( ch.value, ch.stamp, ch.seq )
+            for sub in self.subs:
+                if sub.wants(key):
+                    if line is None:
+                        line = message(key, ch.value, ch.stamp, ch.seq)
+                    sub.push(key, line, self.limit)
+        if line is not None:
+            self._wake()
+
+    def cycle(self, hub):
+        pass
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, "x")
+        except OSError:
+            # pipe already full, the thread is awake anyway
+            pass
+
+    def stop(self):
+        self.stopped = True
+        self._wake()
+        self.thread.join()
+        for sub in self.subs:
+            sub.sock.close()
+        self.subs = []
+        self.listener.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    #-----------------------------------------------------------------------------
+    # Server thread
+    #-----------------------------------------------------------------------------
+    def run(self):
+        while not self.stopped:
+            with self.lock:
+                subs = list(self.subs)
+            readers = [ self.listener, self.wake_r ] + [ sub.sock for sub in subs ]
+            writers = [ sub.sock for sub in subs if sub.waiting() ]
+            try:
+                r, w, x = select.select(readers, writers, [], 1.0)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wake_r in r:
+                try:
+                    while os.read(self.wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+            if self.listener in r:
+                self._accept()
+            for sub in subs:
+                if sub.sock in r:
+                    self._receive(sub)
+                if sub.sock in w and not ( sub.dead or sub.behind ):
+                    self._send(sub)
+            self._reap()
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        with self.lock:
+            self.subs.append( Subscriber(sock) )
+
+    def _receive(self, sub):
+        try:
+            data = sub.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                return
+            data = ""
+        if not data:
+            sub.dead = True
+            return
+        sub.inbuf += data
+        while "\n" in sub.inbuf:
+            line, sub.inbuf = sub.inbuf.split("\n", 1)
+            self._command(sub, line.split())
+        if len(sub.inbuf) > 4096:
+            sub.dead = True
+
+    def _command(self, sub, words):
+        if not words:
+            return
+        verb = words[0].upper()
+        keys = words[1:]
+        with self.lock:
+            if verb == "SUB":
+                for key in keys:
+                    if key == "*":
+                        sub.all = True
+                    else:
+                        sub.channels.add(key)
+                for key in sorted(self.latest):
+                    if key in keys or "*" in keys:
+                        value, t, seq = self.latest[key]
+                        sub.push(key, message(key, value, t, seq), self.limit)
+            elif verb == "UNSUB":
+                for key in keys:
+                    if key == "*":
+                        sub.all = False
+                        sub.channels.clear()
+                    else:
+                        sub.channels.discard(key)
+            else:
+                sub.push("", json.dumps({ "error": "unknown command %s" % verb }) + "\n", self.limit)
+
+    def _send(self, sub):
+        with self.lock:
+            if len(sub.outbuf) < SEND_MAX and sub.queue:
+                parts = [ sub.outbuf ]
+                size = len(sub.outbuf)
+                while sub.queue and size < SEND_MAX:
+                    line = sub.queue.popleft()[1]
+                    parts.append(line)
+                    size += len(line)
+                sub.outbuf = "".join(parts)
+        try:
+            sent = sub.sock.send(sub.outbuf)
+        except socket.error as e:
+            if e.args[0] in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                sent = 0
+            else:
+                sub.dead = True
+                return
+        sub.outbuf = sub.outbuf[sent:]
+        if sent:
+            sub.blocked = None
+
+    def _reap(self):
+        now = clock.monotonic()
+        with self.lock:
+            for sub in self.subs:
+                if sub.waiting() and sub.blocked is None:
+                    sub.blocked = now
+                if not sub.waiting():
+                    sub.blocked = None
+                elif now - sub.blocked > DROP_AFTER:
+                    sub.behind = True
+            gone = [ sub for sub in self.subs if sub.dead or sub.behind ]
+            self.subs = [ sub for sub in self.subs if not ( sub.dead or sub.behind ) ]
+        for sub in gone:
+            if sub.behind:
+                self.dropped += 1
+                print "pubsub: dropped a subscriber that fell behind"
+            try:
+                sub.sock.close()
+            except:
+                pass
+
+    # subscribers, lines coalesced away and subscribers dropped so far
+    def stats(self):
+        with self.lock:
+            return { "subscribers": len(self.subs),
+                     "coalesced": sum([ sub.coalesced for sub in self.subs ]),
+                     "dropped": self.dropped }
+
+#-----------------------------------------------------------------------------
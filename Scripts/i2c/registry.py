@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# Sensor driver registry
+# Raspberry Pi
+#
+# Each driver module registers its class under a short name,
+#
+#   registry.register("sgp30", SGP30)
+#
+# and the class lists the periodic acquisition jobs it has, the main one
+# named "":
+#
+#   JOBS = ( ( "",     "task_steps",         1,  "high" ),
+#            ( "base", "get_baseline_steps", 20, "normal" ) )
+#
+# as ( job, step generator method, ticks between runs, priority ).  A job
+# runs as "<sensor name>" or "<sensor name> <job>" in the acquisition cycle
+# (acquire.py).  REPORT is the format sensd prints the main job's result
+# with, None for nothing.  PUBLISHES tells how often each channel is
+# published,
+#
+#   PUBLISHES = { "":   ( "", 20 ),        every 20th run of the main job
+#                 "ah": ( "comp", 5 ),
+#                 "sid": None }             no regular cadence
+#
+# with "" for the channels not listed.  cadences() turns that into seconds
+# for the configured jobs, which sensd hands on to clients (client.py).
+#
+# A driver is constructed as cls(name, address, bus=, directory=, average=)
+# and keeps the address in I2Caddr, average being the samples in its moving
+# averages, only passed when the config sets it.  A driver that lists the
+# quantities it compensates with in COMPENSATES also gets inputs=, the
+# directory of the value files to fall back to (channel.Input).  get() imports the module of a driver the first
+# time it is asked for, the one in MODULES or any other module named in the
+# config, which is how a driver outside this package is plugged in.
+#
+import importlib
+
+from . import sched
+
+DRIVERS = {}
+
+# driver name -> module registering it, relative to this package
+MODULES = { "bme680": ".bme680",
+            "ccs811": ".ccs811",
+            "htu21d": ".htu21d",
+            "k30":    ".k30",
+            "sgp30":  ".sgp30" }
+
+PRIORITIES = { "high":   sched.PRIO_HIGH,
+               "normal": sched.PRIO_NORMAL,
+               "low":    sched.PRIO_LOW }
+
+
+def register(name, cls):
+    DRIVERS[name] = cls
+
+def get(name, module=None):
+    """The driver class registered as name, importing module for it"""
+    if name not in DRIVERS:
+        module = module or MODULES.get(name)
+        if module is None:
+            raise KeyError("registry: no driver %s" % name)
+        importlib.import_module(module, __package__)
+        if name not in DRIVERS:
+            raise KeyError("registry: %s did not register a driver %s" % ( module, name ))
+    return DRIVERS[name]
+
+
+#-----------------------------------------------------------------------------
+# Jobs of a driver instance, ( job name, steps, every, priority )
+#-----------------------------------------------------------------------------
+# every and priority are { job: value } overrides of what the driver lists
+def jobs(instance, name, every=None, priority=None):
+    out = []
+    for job, method, ticks, prio in instance.JOBS:
+        if every and job in every:
+            ticks = every[job]
+        if priority and job in priority:
+            prio = priority[job]
+        if prio not in PRIORITIES:
+            raise ValueError("registry: %s %s priority %s should be one of %s"
+                             % ( name, job or "job", prio, sorted(PRIORITIES) ))
+        if ticks <= 0:
+            # turned off
+            continue
+        out.append( ( ( name + " " + job ).strip(), getattr(instance, method), ticks, PRIORITIES[prio] ) )
+    return out
+
+
+#-----------------------------------------------------------------------------
+# Seconds between publishes of each channel of a driver instance
+#-----------------------------------------------------------------------------
+# 0 for a channel with no regular cadence or whose job is turned off, ""
+# for the channels PUBLISHES does not list
+def cadences(instance, tick, every=None):
+    ticks = {}
+    for job, method, n, prio in instance.JOBS:
+        if every and job in every:
+            n = every[job]
+        ticks[job] = n
+    out = {}
+    for chan, publish in getattr(instance, "PUBLISHES", { "": ( "", 1 ) }).items():
+        if publish is None or ticks.get(publish[0], 0) <= 0:
+            out[chan] = 0
+        else:
+            out[chan] = ticks[publish[0]] * publish[1] * tick
+    return out
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+#
+# Per minute, hour and day rollups of every channel
+# Raspberry Pi
+#
+# RollupSink is a hub sink (hub.py) that keeps the count, mean, min and max
+# of each channel over every minute, hour and day (UTC days), as the
+# values are published.  A window is written out once the wall clock has
+# passed its end, every FLUSH_SECONDS along with the others, to one file
+# per resolution, <directory>/minute.dat, hour.dat and day.dat:
+#
+#   header  4s magic "I2CR", H version, H record size, I seconds per window, 4x
+#   record  d window start, H channel id, 2x, I count, d mean, d min, d max
+#
+# Records are appended in order of window start, so every INDEX_EVERY'th
+# record has its start and number put in the sparse index <name>.idx
+#
+#   entry   d window start, I record number
+#
+# and a query looks up where to start there and reads on from that record
+# only.  The index is rebuilt from the data file for whatever it is missing.
+#
+# On exit the windows still open are written as they are.  After a restart
+# the same windows carry on in new records; query() merges records of one
+# channel and window back into one.  Values stamped before the last window
+# written, as after the clock was set back, are counted as late and left
+# out.  Channel ids are kept in <directory>/channels.json as for seglog.py.
+#
+import bisect
+import fnmatch
+import os
+import struct
+
+from . import clock
+from . import seglog
+
+ROLLUP_DIR = "/media/usb/sensd-rollup"
+
+RESOLUTIONS = ( ( "minute", 60 ), ( "hour", 3600 ), ( "day", 86400 ) )
+
+MAGIC   = "I2CR"
+VERSION = 1
+HEADER  = struct.Struct("<4sHHI4x")
+RECORD  = struct.Struct("<dH2xIddd")
+INDEX   = struct.Struct("<dI")
+
+INDEX_EVERY = 128          # records per index entry
+READ_RECORDS = 256         # records read at a time by a query
+FLUSH_SECONDS = 300.0
+
+
+#-----------------------------------------------------------------------------
+# One resolution, the data file and its index
+#-----------------------------------------------------------------------------
+class Series:
+
+    def __init__(self, directory, name, seconds, write=True):
+        self.name = name
+        self.seconds = seconds
+        self.path = os.path.join(directory, name + ".dat")
+        self.index_path = os.path.join(directory, name + ".idx")
+        self.file = None
+        self.index_file = None
+        self.count = 0             # records
+        self.last = None           # start of the last window written
+
+        if write and not os.path.exists(self.path):
+            f = open(self.path, "wb")
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, seconds))
+            f.close()
+        self.file = open(self.path, "r+b" if write else "rb")
+        magic, version, size, secs = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != RECORD.size or secs != seconds:
+            self.file.close()
+            raise ValueError("rollup: %s is not a %d second rollup file" % ( self.path, seconds ))
+
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        self.count = (end - HEADER.size) // RECORD.size
+        if write and end != HEADER.size + self.count * RECORD.size:
+            # a record only partly written
+            self.file.truncate(HEADER.size + self.count * RECORD.size)
+        if self.count:
+            self.last = self.record(self.count - 1)[0]
+        self._load_index(write)
+
+    def record(self, n):
+        self.file.seek(HEADER.size + n * RECORD.size)
+        return RECORD.unpack(self.file.read(RECORD.size))
+
+    #-----------------------------------------------------------------------------
+    # Index entries that are there, plus the ones the data has moved past
+    #-----------------------------------------------------------------------------
+    def _load_index(self, write):
+        self.starts = []
+        data = ""
+        if os.path.exists(self.index_path):
+            f = open(self.index_path, "rb")
+            data = f.read()
+            f.close()
+        for pos in range(0, len(data) - INDEX.size + 1, INDEX.size):
+            start, n = INDEX.unpack_from(data, pos)
+            if n != len(self.starts) * INDEX_EVERY or n >= self.count:
+                break
+            self.starts.append(start)
+        missing = range(len(self.starts) * INDEX_EVERY, self.count, INDEX_EVERY)
+        for n in missing:
+            self.starts.append(self.record(n)[0])
+        if write:
+            self.index_file = open(self.index_path, "r+b" if data else "wb")
+            if missing or len(data) != len(self.starts) * INDEX.size:
+                self.index_file.truncate(0)
+                self.index_file.write("".join([ INDEX.pack(start, i * INDEX_EVERY)
+                                                for i, start in enumerate(self.starts) ]))
+                self.index_file.flush()
+            self.index_file.seek(0, os.SEEK_END)
+
+    # ( start, cid, count, mean, min, max ) records in order of start
+    def append(self, records):
+        if not records:
+            return
+        entries = []
+        for i, r in enumerate(records):
+            n = self.count + i
+            if n % INDEX_EVERY == 0:
+                entries.append( INDEX.pack(r[0], n) )
+                self.starts.append(r[0])
+        self.file.seek(HEADER.size + self.count * RECORD.size)
+        self.file.write("".join([ RECORD.pack(*r) for r in records ]))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += len(records)
+        self.last = max(self.last, records[-1][0])
+        # the index only ever points at records already on disk
+        if entries:
+            self.index_file.write("".join(entries))
+            self.index_file.flush()
+
+    #-----------------------------------------------------------------------------
+    # Records with since <= start < until, read READ_RECORDS at a time
+    #-----------------------------------------------------------------------------
+    def read(self, since=None, until=None):
+        n = 0
+        if since is not None:
+            i = bisect.bisect_left(self.starts, since)
+            if i > 0:
+                n = (i - 1) * INDEX_EVERY
+        while n < self.count:
+            self.file.seek(HEADER.size + n * RECORD.size)
+            chunk = self.file.read(min(READ_RECORDS, self.count - n) * RECORD.size)
+            for pos in range(0, len(chunk), RECORD.size):
+                r = RECORD.unpack_from(chunk, pos)
+                if until is not None and r[0] >= until:
+                    return
+                if since is None or r[0] >= since:
+                    yield r
+            n += READ_RECORDS
+
+    def close(self):
+        self.file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+#-----------------------------------------------------------------------------
+# Hub sink
+#-----------------------------------------------------------------------------
+class RollupSink:
+
+    def __init__(self, directory=ROLLUP_DIR, flush_seconds=FLUSH_SECONDS,
+                 resolutions=RESOLUTIONS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ids = seglog._read_channels(directory)
+        self.series = [ Series(directory, name, seconds) for name, seconds in resolutions ]
+        self.windows = [ {} for s in self.series ]    # cid -> [ start, sum, min, max, count ]
+        self.pending = [ [] for s in self.series ]    # closed windows to write
+        self.flushed_at = clock.now()
+        self.written = 0
+        self.late = 0
+
+    def _channel_id(self, key):
+        cid = self.ids.get(key)
+        if cid is None:
+            cid = len(self.ids) + 1
+            self.ids[key] = cid
+            seglog._write_channels(self.directory, self.ids)
+        return cid
+
+    def channel(self, ch):
+        v = ch.value
+        if not isinstance(v, ( int, long, float )) or v != v:
+            return
+        cid = self._channel_id(ch.node + "/" + ch.name)
+        t = ch.stamp
+        for i in range(len(self.series)):
+            s = self.series[i]
+            start = t - t % s.seconds
+            if s.last is not None and start < s.last:
+                self.late += 1
+                continue
+            w = self.windows[i].get(cid)
+            if w is not None and w[0] != start:
+                self._close(i, cid)
+                w = None
+            if w is None:
+                self.windows[i][cid] = [ start, v, v, v, 1 ]
+            else:
+                w[1] += v
+                if v < w[2]:
+                    w[2] = v
+                if v > w[3]:
+                    w[3] = v
+                w[4] += 1
+
+    def _close(self, i, cid):
+        start, total, low, high, count = self.windows[i].pop(cid)
+        self.pending[i].append( ( start, cid, count, float(total) / count, low, high ) )
+
+    def cycle(self, hub):
+        now = clock.wall()
+        for i in range(len(self.series)):
+            seconds = self.series[i].seconds
+            for cid, w in self.windows[i].items():
+                if w[0] + seconds <= now:
+                    self._close(i, cid)
+        if clock.now() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    # write out the closed windows, and the open ones too when closing
+    def flush(self, partial=False):
+        self.flushed_at = clock.now()
+        for i in range(len(self.series)):
+            if partial:
+                for cid in self.windows[i].keys():
+                    self._close(i, cid)
+            records = sorted(self.pending[i])
+            self.pending[i] = []
+            try:
+                self.series[i].append(records)
+                self.written += len(records)
+            except (IOError, OSError):
+                print "rollup: write to %s failed" % self.series[i].path
+
+    def close(self):
+        self.flush(True)
+        for s in self.series:
+            s.close()
+
+    def stats(self):
+        return { "written": self.written,
+                 "open": sum([ len(w) for w in self.windows ]),
+                 "late": self.late }
+
+
+#-----------------------------------------------------------------------------
+# Queries
+#-----------------------------------------------------------------------------
+def _merge(group, names):
+    merged = {}
+    for start, cid, count, mean, low, high in group:
+        m = merged.get(cid)
+        if m is None:
+            merged[cid] = [ start, count, mean, low, high ]
+        else:
+            total = m[1] + count
+            m[2] = (m[2] * m[1] + mean * count) / total
+            m[1] = total
+            m[3] = min(m[3], low)
+            m[4] = max(m[4], high)
+    out = [ ( m[0], names[cid], m[1], m[2], m[3], m[4] ) for cid, m in merged.items() ]
+    out.sort()
+    return out
+
+# ( start, "node/chan", count, mean, min, max ) in order of start then channel,
+# for the channels matching any of the patterns, "SGP30/*" say
+def query(directory=ROLLUP_DIR, resolution="hour", since=None, until=None, channels=None):
+    seconds = dict(RESOLUTIONS).get(resolution)
+    if seconds is None:
+        raise ValueError("rollup: no %s resolution" % resolution)
+    names = {}
+    for key, cid in seglog._read_channels(directory).items():
+        if not channels or any([ fnmatch.fnmatchcase(key, p) for p in channels ]):
+            names[cid] = key
+    if not os.path.exists(os.path.join(directory, resolution + ".dat")):
+        return
+    series = Series(directory, resolution, seconds, write=False)
+    try:
+        group = []
+        for r in series.read(since, until):
+            if r[1] not in names:
+                continue
+            if group and r[0] != group[0][0]:
+                for row in _merge(group, names):
+                    yield row
+                group = []
+            group.append(r)
+        for row in _merge(group, names):
+            yield row
+    finally:
+        series.close()
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+#
+# Central I2C transaction scheduler
+# Raspberry Pi
+#
+# One thread owns the i2c bus.  Drivers hand it step generators (see
+# steps.py) with a priority and a deadline.  The bus work between two
+# yields runs as one unit; while a device is converting its transaction
+# is parked and the bus is free for the next ready transaction, so a long
+# HTU21D or K30 read no longer holds up the once a second SGP30 read.
+#
+# Ready transactions are served by priority and then earliest deadline.
+# Transactions for the same device never overlap, a device that is in the
+# middle of a conversion is not sent another command.
+#
+import heapq
+import threading
+
+from . import clock
+from .steps import Done
+
+PRIO_HIGH   = 0
+PRIO_NORMAL = 1
+PRIO_LOW    = 2
+
+NO_DEADLINE = float("inf")
+
+
+#-----------------------------------------------------------------------------
+# A submitted transaction, wait() blocks until it is finished
+#-----------------------------------------------------------------------------
+class Transaction:
+
+    def __init__(self, gen, priority, deadline, seq, device):
+        self.gen = gen
+        self.device = device
+        self.started = False
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.ready_at = clock.now()  # when it last became ready to run
+        self.result = None
+        self.finished_at = None
+        self.late = False
+        self.event = threading.Event()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.result
+
+    def done(self):
+        return self.event.is_set()
+
+
+#-----------------------------------------------------------------------------
+# Scheduler thread
+#-----------------------------------------------------------------------------
+class Scheduler(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="i2c-sched")
+        self.daemon = True
+        self.cond = threading.Condition()
+        self.ready = []   # heap of ( priority, deadline, seq, transaction )
+        self.parked = []  # heap of ( wake time, seq, transaction )
+        self.seq = 0
+        self.running = True
+        self.busy = set() # devices with a started, unfinished transaction
+
+        # counters
+        self.max_depth = 0
+        self.completed = 0
+        self.late = 0
+        self.waits = {}   # priority -> [ count, total seconds, max seconds ]
+
+    #-----------------------------------------------------------------------------
+    # Queue a step generator, returns the Transaction to wait on
+    #-----------------------------------------------------------------------------
+    # device is any key naming the chip, usually its i2c address
+    def submit(self, gen, priority=PRIO_NORMAL, deadline=None, device=None):
+        if deadline is None:
+            deadline = NO_DEADLINE
+
+        with self.cond:
+            self.seq += 1
+            xact = Transaction(gen, priority, deadline, self.seq, device)
+            heapq.heappush(self.ready, ( priority, deadline, xact.seq, xact ))
+            depth = len(self.ready) + len(self.parked)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self.cond.notify()
+
+        return xact
+
+    # submit and block for the result
+    def call(self, gen, priority=PRIO_NORMAL, deadline=None, device=None):
+        return self.submit(gen, priority, deadline, device).wait()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    #-----------------------------------------------------------------------------
+    # Thread body
+    #-----------------------------------------------------------------------------
+    def run(self):
+        while True:
+            with self.cond:
+                xact = self._next()
+            if xact is None:
+                return
+            self._step(xact)
+
+    # pick the next transaction to step, waiting for parked ones if needed
+    # called holding self.cond
+    def _next(self):
+        while self.running:
+            now = clock.now()
+            while self.parked and self.parked[0][0] <= now:
+                wake, seq, xact = heapq.heappop(self.parked)
+                xact.ready_at = wake
+                heapq.heappush(self.ready, ( xact.priority, xact.deadline, seq, xact ))
+
+            xact = self._pop_ready()
+            if xact is not None:
+                self._count_wait(xact.priority, now - xact.ready_at)
+                return xact
+
+            if self.parked:
+                self.cond.wait(self.parked[0][0] - now)
+            else:
+                self.cond.wait()
+
+        return None
+
+    # best ready transaction whose device is free, called holding self.cond
+    def _pop_ready(self):
+        held = []
+        found = None
+        while self.ready:
+            entry = heapq.heappop(self.ready)
+            xact = entry[3]
+            if xact.started or xact.device is None or xact.device not in self.busy:
+                found = xact
+                break
+            held.append(entry)
+
+        for entry in held:
+            heapq.heappush(self.ready, entry)
+
+        if found is not None and not found.started:
+            found.started = True
+            if found.device is not None:
+                self.busy.add(found.device)
+        return found
+
+    # run one bus step of a transaction, outside the lock
+    def _step(self, xact):
+        try:
+            step = next(xact.gen)
+        except StopIteration:
+            step = Done()
+        except:
+            print "sched.step() transaction failed"
+            step = Done()
+
+        if isinstance(step, Done):
+            xact.gen.close()
+            self._finish(xact, step.value)
+        else:
+            with self.cond:
+                wake = clock.now() + step
+                heapq.heappush(self.parked, ( wake, xact.seq, xact ))
+
+    def _finish(self, xact, result):
+        with self.cond:
+            self.busy.discard(xact.device)
+            self.completed += 1
+            xact.finished_at = clock.now()
+            if xact.finished_at > xact.deadline:
+                xact.late = True
+                self.late += 1
+            self.cond.notify()
+        xact.result = result
+        xact.event.set()
+
+    def _count_wait(self, priority, waited):
+        w = self.waits.get(priority)
+        if w is None:
+            w = self.waits[priority] = [ 0, 0.0, 0.0 ]
+        w[0] += 1
+        w[1] += waited
+        if waited > w[2]:
+            w[2] = waited
+
+    #-----------------------------------------------------------------------------
+    # Queue depth and per priority wait time counters
+    #-----------------------------------------------------------------------------
+    def stats(self):
+        with self.cond:
+            info = { "depth": len(self.ready) + len(self.parked),
+                     "max_depth": self.max_depth,
+                     "completed": self.completed,
+                     "late": self.late,
+                     "waits": {} }
+            for prio, w in self.waits.items():
+                avg = 0.0
+                if w[0]:
+                    avg = w[1] / w[0]
+                info["waits"][prio] = { "count": w[0], "avg": avg, "max": w[2] }
+            return info
+
+    def report(self):
+        info = self.stats()
+        print "sched: depth: %d max: %d done: %d late: %d" % \
+            ( info["depth"], info["max_depth"], info["completed"], info["late"] )
+        for prio in sorted(info["waits"]):
+            w = info["waits"][prio]
+            print "sched: prio %d waits: %d avg: %.1fms max: %.1fms" % \
+                ( prio, w["count"], w["avg"] * 1000.0, w["max"] * 1000.0 )
+
+#-----------------------------------------------------------------------------
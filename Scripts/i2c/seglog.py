@@ -0,0 +1,313 @@
+#!/usr/bin/python
+#
+# Append only binary log of published values
+# Raspberry Pi
+#
+# SegmentLog is a hub sink (hub.py) for long term logging to the USB drive.
+# Every published value becomes a fixed size record, little endian:
+#
+#   record  d time, H channel id, H flags, f value      16 bytes
+#
+# or i value, a 32 bit integer, for records flagged FLAG_INT.
+#
+# Records are collected in RAM and written out every FLUSH_SECONDS as one
+# block: the records, a commit record
+#
+#   commit  d time, H 0xffff, H records in the block, I crc32 of them
+#
+# and zero padding up to the next CHUNK boundary, so the drive only ever
+# sees whole, aligned chunks written once and never a page rewritten for a
+# few more records.  Each block is fsync'ed.
+#
+# Blocks go into segment files <directory>/<number>.seg, each starting with
+#
+#   header  4s magic "I2CL", H version, H record size, d time created
+#
+# and a new segment is started once one reaches SEGMENT_BYTES or is
+# SEGMENT_SECONDS old.  Channel ids are kept in <directory>/channels.json.
+#
+# On start the last segment is checked block by block and cut back to the
+# end of its last intact block, so whatever a crash or power cut left half
+# written is dropped and logging carries on from there.  records() reads
+# the log back, committed blocks only.  Closed segments can be packed much
+# smaller by history.py, whose records() reads packed and unpacked alike.
+#
+import json
+import os
+import struct
+import zlib
+
+from . import clock
+
+LOG_DIR = "/media/usb/sensd-log"
+
+MAGIC   = "I2CL"
+VERSION = 1
+HEADER  = struct.Struct("<4sHHd")
+RECORD  = struct.Struct("<dHHf")
+RECORD_INT = struct.Struct("<dHHi")
+COMMIT  = struct.Struct("<dHHI")
+COMMIT_ID = 0xffff
+
+CHUNK = 4096
+FLUSH_SECONDS   = 300.0
+SEGMENT_BYTES   = 4 * 1024 * 1024
+SEGMENT_SECONDS = 86400.0
+
+# record flags
+FLAG_NONE    = 0x01    # no value, the value field is NaN
+FLAG_INT     = 0x02    # an integer, the value field is an int32
+FLAG_RESTART = 0x04    # first record of the channel since the log was opened
+
+NAN = float("nan")
+
+
+def _segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted([ name for name in os.listdir(directory) if name.endswith(".seg") ])
+
+#-----------------------------------------------------------------------------
+# Committed blocks of a segment, yields ( records data, end of block )
+#-----------------------------------------------------------------------------
+def _blocks(data):
+    size = RECORD.size
+    pos = HEADER.size
+    start = pos
+    while pos + size <= len(data):
+        t, cid, count, crc = COMMIT.unpack_from(data, pos)
+        if cid == COMMIT_ID:
+            body = data[start:pos]
+            if count * size != len(body) or zlib.crc32(body) & 0xffffffff != crc:
+                return
+            pos += size
+            end = pos + (-pos % CHUNK)
+            yield body, end
+            pos = start = end
+        elif t == 0.0 and cid == 0:
+            # padding only ever follows a commit
+            return
+        else:
+            pos += size
+
+# ( time, channel id, flags, value ) of the committed records of a segment
+def _records(data):
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        return
+    for body, end in _blocks(data):
+        for pos in range(0, len(body), RECORD.size):
+            t, cid, flags, value = RECORD.unpack_from(body, pos)
+            if flags & FLAG_NONE:
+                value = None
+            elif flags & FLAG_INT:
+                value = RECORD_INT.unpack_from(body, pos)[3]
+            yield t, cid, flags, value
+
+def _read_channels(directory):
+    try:
+        f = open(os.path.join(directory, "channels.json"))
+        ids = json.load(f)
+        f.close()
+        return dict(ids)
+    except:
+        return {}
+
+def _write_channels(directory, ids):
+    path = os.path.join(directory, "channels.json")
+    f = open(path + ".tmp", "w")
+    json.dump(ids, f, sort_keys=True)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(path + ".tmp", path)
+
+
+#-----------------------------------------------------------------------------
+# Reading the log back
+#-----------------------------------------------------------------------------
+# ( time, "node/chan", value, flags ) oldest first
+def records(directory=LOG_DIR, since=None):
+    names = {}
+    for key, cid in _read_channels(directory).items():
+        names[cid] = key
+    for seg in _segments(directory):
+        f = open(os.path.join(directory, seg), "rb")
+        data = f.read()
+        f.close()
+        for t, cid, flags, value in _records(data):
+            if since is None or t >= since:
+                yield t, names.get(cid, "#%d" % cid), value, flags
+
+
+#-----------------------------------------------------------------------------
+# Writer, hub sink
+#-----------------------------------------------------------------------------
+class SegmentLog:
+
+    def __init__(self, directory=LOG_DIR, flush_seconds=FLUSH_SECONDS,
+                 segment_bytes=SEGMENT_BYTES, segment_seconds=SEGMENT_SECONDS,
+                 on_close=None):
+        self.directory = directory
+        self.on_close = on_close   # called with the directory when a segment is closed
+        self.flush_seconds = flush_seconds
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.ids = _read_channels(directory)
+        self.restarted = set()     # channels logged since opening
+        self.buf = bytearray()
+        self.count = 0             # records in buf
+        self.flushed_at = clock.now()
+        self.file = None
+        self.number = 0
+        self.created = None
+        self.size = 0
+        self.recovered = 0         # bytes cut off the last segment
+        self.bytes_written = 0
+        self.dropped = 0           # records lost to write errors
+        self._recover()
+
+    #-----------------------------------------------------------------------------
+    # Carry on from the end of the last intact block of the last segment
+    #-----------------------------------------------------------------------------
+    def _recover(self):
+        segs = _segments(self.directory)
+        if not segs:
+            return
+        name = segs[-1]
+        path = os.path.join(self.directory, name)
+        f = open(path, "r+b")
+        data = f.read()
+        if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+            # not even a header made it out, start that segment over
+            f.close()
+            os.remove(path)
+            self.number = int(name[:-4])
+            return
+        end = HEADER.size
+        for body, end in _blocks(data):
+            pass
+        # a block whose padding did not all make it out is extended again
+        if end != len(data):
+            if end < len(data):
+                self.recovered = len(data) - end
+                print "seglog: cut %d bytes of an unfinished block off %s" % ( self.recovered, name )
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+        f.seek(end)
+        self.file = f
+        self.number = int(name[:-4])
+        self.created = HEADER.unpack_from(data)[3]
+        self.size = end
+
+    def _open_segment(self):
+        closed = self.file is not None
+        if closed:
+            self.file.close()
+            self.file = None
+            self.number += 1
+        path = os.path.join(self.directory, "%08d.seg" % self.number)
+        self.file = open(path, "wb")
+        self.created = clock.wall()
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.created))
+        self.size = HEADER.size
+        # again, for a drive that was away when a channel was added
+        _write_channels(self.directory, self.ids)
+        if closed and self.on_close is not None:
+            self.on_close(self.directory)
+
+    def _channel_id(self, key):
+        cid = self.ids.get(key)
+        if cid is None:
+            cid = len(self.ids) + 1
+            if cid >= COMMIT_ID:
+                return None
+            self.ids[key] = cid
+            try:
+                _write_channels(self.directory, self.ids)
+            except (IOError, OSError):
+                # the next segment written has it
+                pass
+        return cid
+
+    #-----------------------------------------------------------------------------
+    # Hub sink calls
+    #-----------------------------------------------------------------------------
+    def channel(self, ch):
+        key = ch.node + "/" + ch.name
+        cid = self._channel_id(key)
+        if cid is None:
+            return
+        flags = 0
+        value = ch.value
+        if value is None:
+            flags |= FLAG_NONE
+            value = NAN
+        elif isinstance(value, ( int, long )) and -0x80000000 <= value <= 0x7fffffff:
+            flags |= FLAG_INT
+        if key not in self.restarted:
+            self.restarted.add(key)
+            flags |= FLAG_RESTART
+        if flags & FLAG_INT:
+            self.buf.extend( RECORD_INT.pack(ch.stamp, cid, flags, value) )
+        else:
+            self.buf.extend( RECORD.pack(ch.stamp, cid, flags, value) )
+        self.count += 1
+
+    def cycle(self, hub):
+        if clock.now() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    #-----------------------------------------------------------------------------
+    # Write the buffered records out as one committed, padded block, or drop
+    # them when the drive is gone so the buffer does not grow meanwhile
+    #-----------------------------------------------------------------------------
+    def flush(self):
+        self.flushed_at = clock.now()
+        if not self.count:
+            return
+        now = clock.wall()
+        body = bytes(self.buf)
+        block = body + COMMIT.pack(now, COMMIT_ID, self.count, zlib.crc32(body) & 0xffffffff)
+        try:
+            if self.file is None or self.size >= self.segment_bytes \
+                    or now - self.created >= self.segment_seconds:
+                self._open_segment()
+            # a block goes up to the next chunk boundary of the file
+            end = self.size + len(block)
+            block += "\0" * (-end % CHUNK)
+            self.file.write(block)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(block)
+            self.bytes_written += len(block)
+        except (IOError, OSError):
+            print "seglog: write to %s failed" % self.directory
+            self.dropped += self.count
+            try:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self._recover()
+            except (IOError, OSError):
+                pass
+        self.buf = bytearray()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return { "segment": self.number,
+                 "buffered": self.count,
+                 "bytes_written": self.bytes_written,
+                 "recovered": self.recovered,
+                 "dropped": self.dropped }
+
+#-----------------------------------------------------------------------------
@@ -17,8 +17,15 @@
 #
 #
 import os
-import time
-from smbus2 import SMBus, i2c_msg
+from ..average import RingAverager
+from ..busmgr import BUSES
+from ..channel import Channel, Input, INPUT_DIR, INPUT_FILES
+from .. import clock
+from .. import codec
+from .. import evloop
+from .. import registry
+from .. import hub
+from .. import steps
 
 I2CBUS = 1
 
@@ -45,13 +52,8 @@ SGP30_MEASURE_RAW = 0x50 # H2 then Ethanol values
 #
 # Maintain a 1 minute moving average
 SGP30_MAX = 60
-SGP30_MAX_FLOAT = 60.0
 # compensate every five minutes
 SGP30_T_MAX = 5
-SGP30_T_MAX_FLOAT = 5.0
-#
-CRC_HTU = 0x00      # Instrumant Specialties HTU21D RH sensor
-CRC_SGP = 0xff      # Senserion VOC sensor
 
 #
 #-----------------------------------------------------------------------------
@@ -59,39 +61,63 @@ CRC_SGP = 0xff      # Senserion VOC sensor
 #-----------------------------------------------------------------------------
 class SGP30:
 
-    def __init__(self, name, i2c_addr):
+    # acquisition jobs and how sensd reports the main one, see registry.py
+    JOBS = ( ( "",     "task_steps",         1,  "high" ),
+             ( "base", "get_baseline_steps", 20, "normal" ),
+             ( "comp", "comp_task_steps",    60, "normal" ) )
+    REPORT = "%.0f"
+    # channel -> ( job publishing it, runs of that job per publish ), None
+    # for no regular cadence, "" for the other channels
+    PUBLISHES = { "":       ( "", 20 ),
+                  "base_c": ( "base", 1 ),
+                  "base_v": ( "base", 1 ),
+                  "ah":     ( "comp", SGP30_T_MAX ),
+                  "h2":     None,
+                  "et":     None,
+                  "sid":    None,
+                  "ver":    None }
+    # quantities it compensates with, taken from another sensor (inputs=)
+    COMPENSATES = ( hub.ABS_HUMIDITY, )
+
+    def __init__(self, name, i2c_addr=SGP30_ADDR, bus=I2CBUS, directory=None, average=SGP30_MAX,
+                 inputs=INPUT_DIR):
         self.I2Caddr = i2c_addr             # i2c address
+        self.bus = bus                      # i2c bus number
         
-        directory = "/tmp/" + name
+        if directory is None:
+            directory = "/tmp/" + name
         if not os.path.exists(directory):
             os.makedirs(directory)
         
         
-        self.FptrVoc = directory + "/voc" # filename for voc value in /tmp
-        self.FptrBaseC = directory + "/base_c"
-        self.FptrBaseV = directory + "/base_v"
-        self.FptrAH = directory + "/ah"
+        self.voc = Channel( directory, "voc", "%d" ) # voc value in /tmp
+        self.base_c = Channel( directory, "base_c", "%d", None )
+        self.base_v = Channel( directory, "base_v", "%d", None )
+        self.ah = Channel( directory, "ah", "%3.1f", None )
         # raw sensor values
-        self.FptrH2 = directory + "/h2"
-        self.FptrET = directory + "/et" 
+        self.h2 = Channel( directory, "h2", "%d" )
+        self.et = Channel( directory, "et", "%d" )
         # device serial number
-        self.FptrSID = directory + "/sid"
-        self.FptrVer = directory + "/ver"
+        self.sid = Channel( directory, "sid", "%d", None )
+        self.ver = Channel( directory, "ver", "%d", None )
         
-        # to retreave Absolute Humidity value for compensation
-        self.FptrHTU21D_AH = "/tmp/HTU21D/ah"
+        # Absolute Humidity for compensation, as HTU21D or BME680 publish it in
+        # this process, or from the file in inputs, the directory of the sensor
+        # providing it, when that runs on its own
+        self.FptrHTU21D_AH = inputs + "/" + INPUT_FILES[hub.ABS_HUMIDITY]
+        self.ah_in = Input( hub.ABS_HUMIDITY, self.FptrHTU21D_AH )
         
         # to track RH compenation event
         self.comp_minute = SGP30_T_MAX
         # Long term AH averaging 
-        self.ah_buff = [ 10.28 ] * SGP30_T_MAX
-        # one minute averaging buffer
-        self.voc_buff = [0] * SGP30_MAX
+        self.ah_avg = RingAverager( SGP30_T_MAX )
+        # one minute moving average, written every 20 samples
+        self.voc_avg = RingAverager( average )
         self.voc_ptr = 0
         
         # for raw sensor values
-        self.h2_buff = [0] * SGP30_MAX
-        self.et_buff = [0] * SGP30_MAX
+        self.h2_avg = RingAverager( average )
+        self.et_avg = RingAverager( average )
         self.raw_ptr = 0
         
         self.get_sid()     # serial number
@@ -103,44 +129,30 @@ class SGP30:
         
         try:
             
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_MSB, SGP30_INIT )
-            time.sleep(0.01)
-            bus.close()
+            clock.sleep(0.01)
         
             # Init envronmental compensation registers
             ah = 10.28 # equal to T:23c & RH: 50% 
             self.set_comp( ah )
             # will implement periodically in loop
             
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.init() failed"
+        except Exception:
             print "sgp30.init() failed"
         
-        time.sleep(0.01)
+        clock.sleep(0.01)
         
 
     #-----------------------------------------------------------------------------
     # CRC8 calculation for the SGP30 sensor
     #-----------------------------------------------------------------------------
-    # Need to provide device specific initial value: 
+    # see codec.py, responses are checked with codec.words()
     def crc8( self, value ):
-        crc = CRC_SGP
-        POLY = 0x31
-
-        for x in range(len(value)):
-            crc = crc ^ value[x]
-            for y in range(8):
-                if (crc & 0x80):
-                    crc = crc << 1
-                    crc = crc ^ POLY
-                else:
-                    crc = crc << 1
-            crc = crc & 0xff
-
-        #print "sgp30.crc8() crc: 0x%02x" % crc
-
-        return crc
+        return codec.crc8( value, codec.CRC_SGP )
 
 
     #-----------------------------------------------------------------------------
@@ -148,6 +160,9 @@ class SGP30:
     #-----------------------------------------------------------------------------
     # usually called by comp_task() and __init__()
     def set_comp( self, ah ):
+        steps.run( self.set_comp_steps( ah ) )
+
+    def set_comp_steps( self, ah ):
         
         msg = [ SGP30_SET_AH ] # start with command LSB
 
@@ -166,30 +181,24 @@ class SGP30:
         ah_d = int( (ah % 1) * 256.0 ) # decimal byte
         ah_d &= 0xff   
 
-        ah_comp = [ ah_i, ah_d ]       # in SGP30 format
-        ah_crc = self.crc8( ah_comp )
-
-        # addend crc byte
-        ah_comp.append( ah_crc )
-        # add AH data list to message list
-        msg.extend(ah_comp)
+        # in SGP30 format with crc byte
+        msg.extend( codec.word( (ah_i << 8) | ah_d ) )
 
         print "sgp30.set_comp(): set AH: %.1f" % ( ah )
         print "sgp30.set_comp(): AH regs. 0x%02x 0x%02x" % ( ah_i, ah_d )
 
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             resp = bus.write_i2c_block_data( self.I2Caddr, SGP30_MSB, msg )
-            bus.close()
-            time.sleep(0.01)
+            yield 0.01
         
             # log AH value
-            f = open(self.FptrAH,"w")
-            f.write("%3.1f" % ah)
-            f.close()
+            self.ah.publish( ah )
         
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.set_comp() failed"
+        except Exception:
             print "sgp30.set_comp() failed"
         
         
@@ -198,80 +207,79 @@ class SGP30:
     #----------------------------------------------------------------------------- 
     # run task once a minute
     def comp_task(self):
-        # Try to read the externally expected temperature and humidity files
-        try:
-            file = open( self.FptrHTU21D_AH, "r")
-            ah = float( file.read() )
-            file.close()
-            
-            # make sure AH value looks okay before proceeding            
-            if ah < 100 and ah >= .1 :
-                self.comp_minute -= 1
-                self.ah_buff[self.comp_minute] = ah
-                print "sgp30.comp_task(): minute AH: %3.1f" % ( ah )
-
-                if self.comp_minute == 0:
-                    # calculate averages and set CCS811 compensation
-                    avg_ah  = 0
-                    for i in range(SGP30_T_MAX):
-                        avg_ah += self.ah_buff[i]
-                    avg_ah  /= SGP30_T_MAX_FLOAT
-                    
-                    self.set_comp( avg_ah )
-                    self.comp_minute = SGP30_T_MAX
-
-        except:
-            print "sgp30.comp_task(): can't read AH file"    
+        steps.run( self.comp_task_steps() )
+
+    def acomp_task(self, loop=None):
+        return evloop.spawn( self.comp_task_steps(), self.I2Caddr, loop )
+
+    def comp_task_steps(self):
+        ah = self.ah_in.read()
+        if ah is None:
+            print "sgp30.comp_task(): no AH value"
+            return
+
+        # make sure AH value looks okay before proceeding            
+        if ah < 100 and ah >= .1 :
+            self.comp_minute -= 1
+            self.ah_avg.add( ah )
+            print "sgp30.comp_task(): minute AH: %3.1f from %s" % ( ah, self.ah_in.source )
+
+            if self.comp_minute == 0:
+                # calculate averages and set CCS811 compensation
+                avg_ah = self.ah_avg.mean()
+                
+                for step in self.set_comp_steps( avg_ah ):
+                    yield step
+                self.comp_minute = SGP30_T_MAX
 
 
     #-----------------------------------------------------------------------------
     # Get internal auto calibration and write to file system 
     #-----------------------------------------------------------------------------        
     def get_baseline(self):
+        steps.run( self.get_baseline_steps() )
+
+    def aget_baseline(self, loop=None):
+        return evloop.spawn( self.get_baseline_steps(), self.I2Caddr, loop )
+
+    def get_baseline_steps(self):
         try:
             # eCO2 baseline word first + crc
             # tVOC baseline word second + crc       
             # these two lists need to be in reverse order for setting baseline
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_MSB, SGP30_GET_BASE )
-            time.sleep(0.02)
+            yield 0.02
             
             # for some reason an extra null byte is needed to get data
+            bus = BUSES.get(self.bus)
             resp = bus.read_i2c_block_data( self.I2Caddr, 0, 6 )
             # below doesn't work
             #read = i2c_msg.read( selfI2Caddr, 6 )
             #bus.i2c_rdwr(read)
             #resp = list(read)
-            bus.close()
         
             # Because there are two set of baselines we will just
             # write them directly to the file-system instead of
             # looking for changes
-            baseline_co2 = [ resp[0], resp[1], resp[2] ]
-            baseline_voc = [ resp[3], resp[4], resp[5] ]
-        
-            if ( self.crc8( baseline_co2 ) == 0 ):
-                # comma delimited output
-                #msg = str(baseline_co2).strip('[]')
-                bl = ( resp[0] << 8 ) | resp[1]
-                f = open(self.FptrBaseC,"w")
-                f.write("%d" % bl)
-                f.close()
+            baseline_co2, baseline_voc = codec.words( resp, 2 )
+        
+            if baseline_co2 is not None:
+                bl = baseline_co2
+                self.base_c.publish( bl )
             
                 print "sgp30.get_baseline() co2: 0x%04x" % bl
             
-            if ( self.crc8( baseline_voc ) == 0 ):
-                # comma delimited output
-                #msg = str(baseline_voc).strip('[]')
-                bl = ( resp[3] << 8 ) | resp[4]
-                f = open(self.FptrBaseV,"w")
-                f.write("%d" % bl)
-                f.close()
+            if baseline_voc is not None:
+                bl = baseline_voc
+                self.base_v.publish( bl )
             
                 print "sgp30.get_baseline() voc: 0x%04x" % bl
             
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.get_baseline() failed"
+        except Exception:
             print "sgp30.get_baseline() failed"
             
             
@@ -282,36 +290,27 @@ class SGP30:
     def set_baseline( self, baseline_voc, baseline_co2 ):
         # tVOC baseline word first + crc
         # eCO2 baseline word second + crc
-        baseline = [0x00] * 2
-                
         msg = [ SGP30_SET_BASE ] # start with command LSB
         
         # VOC first
-        baseline[0] = (baseline_voc & 0xff00) >> 8
-        baseline[0] &= 0xff
-        baseline[1] = baseline_voc & 0xff
-        msg.extend(baseline)
-        msg.append( self.crc8(baseline) )
+        msg.extend( codec.word( baseline_voc ) )
         
         # Then eCO2
-        baseline[0] = (baseline_co2 & 0xff00) >> 8
-        baseline[0] &= 0xff
-        baseline[1] = baseline_co2 & 0xff
-        msg.extend(baseline)
-        msg.append( self.crc8(baseline) )
+        msg.extend( codec.word( baseline_co2 ) )
 
         print "sgp30.set_baseline() voc: %02x %02x crc: %02x" % ( msg[1], msg[2], msg[3] )
         print "sgp30.set_baseline() co2: %02x %02x crc: %02x" % ( msg[4], msg[5], msg[6] )
         
         try:    
             
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             resp = bus.write_i2c_block_data( self.I2Caddr, SGP30_MSB, msg )
-            bus.close()
-            time.sleep(0.01)
+            clock.sleep(0.01)
 
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.set_baseline() failed"
+        except Exception:
             print "sgp30.set_baseline() failed"
 
     #-----------------------------------------------------------------------------
@@ -320,27 +319,25 @@ class SGP30:
     def get_version(self):
         info = 99999
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_MSB, SGP30_GET_VERSION )
-            time.sleep(0.01)
+            clock.sleep(0.01)
             #resp = bus.read_i2c_block_data( self.I2Caddr, 0, 3 )
-            read = i2c_msg.read( self.I2Caddr, 3 )
+            read = BUSES.read_msg( self.I2Caddr, 3 )
             bus.i2c_rdwr(read)
-            resp = list(read)
-            bus.close()
+            version = codec.words( read, 1 )[0]
         
-            if ( self.crc8( resp ) == 0 ):
-                print "sgp30.get_version() Feature Set Type: 0x%02x Version: 0x%02x" % ( resp[0], resp[1] )
-            
-                info = (resp[0] << 8) | resp[1]
+            if version is not None:
+                info = version
+                print "sgp30.get_version() Feature Set Type: 0x%02x Version: 0x%02x" % ( info >> 8, info & 0xff )
                 
                 #log Feature & Version Info
-                f = open(self.FptrVer,"w")
-                f.write("%d" % info)
-                f.close()
+                self.ver.publish( info )
         
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "spg30.get_version() failed"
+        except Exception:
             print "spg30.get_version() failed"
         
         return info
@@ -352,47 +349,27 @@ class SGP30:
     def get_sid(self):
         sid = 99999
         try:
-            info = [ 0xffff ] * 3
-            test = 0
-    
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_SID_MSB, SGP30_SID_LSB )
-            time.sleep(0.01)
+            clock.sleep(0.01)
             #resp = bus.read_i2c_block_data( self.I2Caddr, 0, 9 )
-            read = i2c_msg.read( self.I2Caddr, 9 )
+            read = BUSES.read_msg( self.I2Caddr, 9 )
             bus.i2c_rdwr(read)
-            resp = list(read)
-            bus.close()
-
-            sid_1 = [ resp[0], resp[1], resp[2] ]
-            sid_2 = [ resp[3], resp[4], resp[5] ]
-            sid_3 = [ resp[6], resp[7], resp[8] ]
-
-            if ( self.crc8( sid_1 ) == 0 ):
-                info[0] = (sid_1[0] << 8 ) | sid_1[1]
-                test += 1
-            
-            if ( self.crc8( sid_2 ) == 0 ):
-                info[1] = (sid_2[0] << 8) | sid_2[1]
-                test += 1            
-
-            if ( self.crc8( sid_3 ) == 0 ):
-                info[2] = (sid_3[0] << 8) | sid_3[1]   
-                test += 1
+            info = codec.words( read, 3 )
         
-            if test == 3:
+            if None not in info:
                 sid = (info[0] << 32) | (info[1] << 16) | info[2]
                 print "sgp30.get_sid(): 0x%012x" % ( sid )  
             
                 #log Serial ID
-                f = open(self.FptrSID,"w")
-                f.write("%d" % sid)
-                f.close()
+                self.sid.publish( sid )
             else:
                 print "sgp30.get_sid(): CRC error"
                 
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.get_sid() failed"
+        except Exception:
             print "sgp30.get_sid() failed"
         
         return sid
@@ -403,60 +380,54 @@ class SGP30:
     #-----------------------------------------------------------------------------
     # should be run once per second if used
     def raw(self):
+        return steps.run( self.raw_steps() )
+
+    def araw(self, loop=None):
+        return evloop.spawn( self.raw_steps(), self.I2Caddr, loop )
+
+    def raw_steps(self):
         h2 = 99999 # Hydrogen
         et = 99999 # Ethanol
         test = 0
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_MSB, SGP30_MEASURE_RAW )
-            time.sleep(0.03)
+            yield 0.03
+            bus = BUSES.get(self.bus)
             resp = bus.read_i2c_block_data( self.I2Caddr, 0, 6 )
             #read = i2c_msg.read( self.I2Caddr, 6 )
             #bus.i2c_rdwr(read)
             #resp = list(read)
-            bus.close()
         
             # raw sensor values
             # bytes 0-2 are H2 + CRC8
             # bytes 3-5 are Ethanol + CRC8
-            temp = [ resp[0], resp[1], resp[2] ]
-            if ( self.crc8( temp ) == 0 ):
-                h2 = (resp[0] << 8) | resp[1]
-                # maintain 1 minute moving average buffer
-                self.h2_buff[ self.raw_ptr ] = h2
+            h2_word, et_word = codec.words( resp, 2 )
+            if h2_word is not None:
+                h2 = h2_word
+                # maintain 1 minute moving average
+                self.h2_avg.add( h2 )
+                self.h2.sample( h2 )
                 test += 1
                 
-            temp = [ resp[3], resp[4], resp[5] ]
-            if ( self.crc8( temp ) == 0 ):
-                et = (resp[3] << 8) | resp[4]
-                # maintain 1 minute moving average buffer
-                self.et_buff[ self.raw_ptr ] = et
+            if et_word is not None:
+                et = et_word
+                # maintain 1 minute moving average
+                self.et_avg.add( et )
+                self.et.sample( et )
                 test += 1
                 
             # every 20 seconds write to file system
-            if (self.raw_ptr % 20 == 0 ):             
+            if (self.raw_ptr % 20 == 0 and test == 2):             
             
-                # calculate current average voc value
-                # 60 samples per minute
-                avg_h2 = 0
-                avg_et = 0
-                for i in range( SGP30_MAX ):
-                    avg_h2 += self.h2_buff[i]
-                    avg_et += self.et_buff[i]
-                avg_h2 /= SGP30_MAX_FLOAT
-                avg_et /= SGP30_MAX_FLOAT
-                avg_h2 = int(round( avg_h2 ))
-                avg_et = int(round( avg_et ))
+                # current averages, 60 samples per minute
+                avg_h2 = int(round( self.h2_avg.mean() ))
+                avg_et = int(round( self.et_avg.mean() ))
             
                 print "sgp30.raw() h2 avg: %d ethanol avg: %d" % ( avg_h2, avg_et )
                 
-                f = open(self.FptrH2,"w")
-                f.write("%d" % avg_h2)
-                f.close()
-                
-                f = open(self.FptrET,"w")
-                f.write("%d" % avg_et)
-                f.close()
+                self.h2.publish( avg_h2 )
+                self.et.publish( avg_et )
             
             # only if all data is valid, do we increment the pointer            
             if test == 2:
@@ -464,12 +435,14 @@ class SGP30:
                 if self.raw_ptr >= SGP30_MAX:
                     self.raw_ptr = 0   
         
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.get_raw() failed"
+        except Exception:
             print "sgp30.get_raw() failed"
         
         # returning latest values, not averages
-        return [ h2, et ]
+        yield steps.Done( [ h2, et ] )
         
         
     #-----------------------------------------------------------------------------
@@ -477,54 +450,59 @@ class SGP30:
     #-----------------------------------------------------------------------------
     # should be run once per second
     def task(self):
+        return steps.run( self.task_steps() )
+
+    # task() on an event loop, the returned Task can be yielded on
+    def atask(self, loop=None):
+        return evloop.spawn( self.task_steps(), self.I2Caddr, loop )
+
+    # task() as a step generator, yields the conversion wait
+    def task_steps(self):
         t_voc = 99999
         try:
-            bus = SMBus(I2CBUS)
+            bus = BUSES.get(self.bus)
             bus.write_byte_data( self.I2Caddr, SGP30_MSB, SGP30_MEASURE )
-            time.sleep(0.02)
+            yield 0.02
+            bus = BUSES.get(self.bus)
             resp = bus.read_i2c_block_data( self.I2Caddr, 0, 6 )
             #read = i2c_msg.read( self.I2Caddr, 6 )
             #bus.i2c_rdwr(read)
             #resp = list(read)
 
-            bus.close()
             # Only care about tVOC since eCO2 is just that
             # bytes 0-2 are eCO2 + CRC8
             # bytes 3-5 are tVOC + CRC8
-            temp = [ resp[3], resp[4], resp[5] ]
-            if ( self.crc8( temp ) == 0 ):
-                t_voc = (resp[3] << 8) | resp[4]
+            voc_word = codec.words( resp, 2 )[1]
+            if voc_word is not None:
+                t_voc = voc_word
             
-                # maintain 1 minute moving average buffer
-                self.voc_buff[ self.voc_ptr ] = t_voc
+                # maintain 1 minute moving average
+                self.voc_avg.add( t_voc )
+                self.voc.sample( t_voc )
                 
                 # every 20 seconds write to file system
                 if (self.voc_ptr % 20 == 0 ): 
-                    # calculate current average voc value
-                    # 60 samples per minute
-                    avg_voc = 0
-                    for i in range( SGP30_MAX ):
-                        avg_voc += self.voc_buff[i]
-                    avg_voc /= SGP30_MAX_FLOAT
-                    avg_voc = int(round( avg_voc ))      
+                    # current average voc value, 60 samples per minute
+                    avg_voc = int(round( self.voc_avg.mean() ))
             
                     print "sgp30.task() voc: %d avg: %d " % ( t_voc, avg_voc )
                 
-                    f = open(self.FptrVoc,"w")
-                    f.write("%d" % avg_voc)
-                    f.close()
+                    self.voc.publish( avg_voc )
                 
                 self.voc_ptr += 1
                 if self.voc_ptr >= SGP30_MAX:
                     self.voc_ptr = 0
             
-        except:
-            bus.close()
+        except (IOError, OSError):
+            BUSES.fault(self.bus)
+            print "sgp30.task() failed"
+        except Exception:
             print "sgp30.task() failed"
         
         # returning latest value, not average
-        return t_voc
+        yield steps.Done( t_voc )
             
             
     #-----------------------------------------------------------------------------
-    
+
+registry.register("sgp30", SGP30)
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+#
+# Latest values and recent history in shared memory
+# Raspberry Pi
+#
+# ShmSink is a hub sink (hub.py) that keeps every published channel in a
+# memory mapped file on tmpfs, /tmp/sensd.shm by default.  Readers map the
+# same file with ShmReader and read values straight out of memory, no
+# open/read/stat per channel and no lock shared with sensd.
+#
+# The file is a 64 byte header followed by fixed size slots, one per
+# channel, all little endian:
+#
+#   header  4s magic "I2CM", H version, H slots, H ring, H slots in use
+#   slot    I lock, B kind (0 float, 1 int), 3 pad bytes, 8s node,
+#           8s channel, d value, d time, I seq, I samples written,
+#           I crc32 of kind to samples written, I crc32 of the ring,
+#           then ring x ( d time, d value )
+#
+# Node and channel names are NUL padded and cut to 8 characters.
+#
+# Each slot is guarded by a seqlock: the writer makes the lock odd, writes
+# the slot and makes it even again.  A reader copies the slot and keeps it
+# only if the lock was even and unchanged over the copy, otherwise it tries
+# again.  Python has no memory barriers, and on the Pi's ARM cores nothing
+# keeps another process from seeing the lock and the data stores in a
+# different order, so the lock alone only catches most torn copies.  The
+# reader also checks the copy against the crc32s the writer stored with
+# it, and tries again on a mismatch.  The ring holds the last `ring` published values, the newest at
+# (samples written - 1) % ring.
+#
+# Slots are handed out in the order channels first publish.  A restarted
+# sensd reuses a file with the same layout in place, so mapped readers
+# carry on; a reader checks the names in the slot it reads and looks the
+# channel up again when they don't match.
+#
+import mmap
+import os
+import struct
+import zlib
+
+SHM_PATH = "/tmp/sensd.shm"
+
+MAGIC   = "I2CM"
+VERSION = 2
+SLOTS   = 32      # channels
+RING    = 64      # recent values per channel
+
+HEADER      = struct.Struct("<4sHHHH")
+HEADER_SIZE = 64
+USED        = struct.Struct("<H")
+USED_AT     = 10
+LOCK        = struct.Struct("<I")
+SLOT_HEAD   = struct.Struct("<IB3x8s8sddIIII")
+BODY        = struct.Struct("<B3x8s8sddII")     # the part of the head under its crc
+BODY_AT     = LOCK.size
+SAMPLE      = struct.Struct("<dd")
+
+# a reader gives up on a slot after this many torn copies, e.g. a writer
+# that died half way through
+RETRIES = 1000
+
+KIND_FLOAT = 0
+KIND_INT   = 1
+
+NAN = float("nan")
+
+
+def slot_size(ring):
+    return SLOT_HEAD.size + ring * SAMPLE.size
+
+def file_size(slots, ring):
+    return HEADER_SIZE + slots * slot_size(ring)
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+#-----------------------------------------------------------------------------
+# Writer side, one per file
+#-----------------------------------------------------------------------------
+class ShmSink:
+
+    def __init__(self, path=SHM_PATH, slots=SLOTS, ring=RING):
+        self.path = path
+        self.slots = slots
+        self.ring = ring
+        self.slot_size = slot_size(ring)
+        self.size = file_size(slots, ring)
+        self.index = {}    # "node/chan" -> [ offset, lock, samples written ]
+        self.full = False
+        self.map = self._open()
+
+    #-----------------------------------------------------------------------------
+    # Map the file, reusing one with the same layout in place
+    #-----------------------------------------------------------------------------
+    def _open(self):
+        header = HEADER.pack(MAGIC, VERSION, self.slots, self.ring, 0)
+        try:
+            if os.path.getsize(self.path) == self.size:
+                f = open(self.path, "r+b")
+                m = mmap.mmap(f.fileno(), self.size)
+                f.close()
+                if m[:USED_AT] == header[:USED_AT]:
+                    m[:HEADER_SIZE] = header.ljust(HEADER_SIZE, "\0")
+                    return m
+                m.close()
+        except:
+            pass
+
+        tmp = self.path + ".tmp"
+        f = open(tmp, "w+b")
+        f.write(header.ljust(self.size, "\0"))
+        f.flush()
+        m = mmap.mmap(f.fileno(), self.size)
+        f.close()
+        os.rename(tmp, self.path)
+        return m
+
+    def close(self):
+        self.map.close()
+
+    def _allot(self, ch, key):
+        used = len(self.index)
+        if used >= self.slots:
+            if not self.full:
+                print "shmring: no free slot for %s" % key
+                self.full = True
+            return None
+        off = HEADER_SIZE + used * self.slot_size
+        slot = [ off, 0, 0 ]
+        m = self.map
+        # keep whatever lock count the slot had so readers see the change
+        slot[1] = ((LOCK.unpack_from(m, off)[0] + 1) | 1) & 0xffffffff
+        LOCK.pack_into(m, off, slot[1])
+        ring = "\0" * (self.slot_size - SLOT_HEAD.size)
+        m[off + SLOT_HEAD.size:off + self.slot_size] = ring
+        body = BODY.pack(KIND_FLOAT, ch.node, ch.name, NAN, 0.0, 0, 0)
+        SLOT_HEAD.pack_into(m, off, slot[1], KIND_FLOAT, ch.node, ch.name, NAN, 0.0, 0, 0,
+                            _crc(body), _crc(ring))
+        slot[1] = (slot[1] + 1) & 0xffffffff
+        LOCK.pack_into(m, off, slot[1])
+        USED.pack_into(m, USED_AT, used + 1)
+        self.index[key] = slot
+        return slot
+
+    #-----------------------------------------------------------------------------
+    # Hub sink calls
+    #-----------------------------------------------------------------------------
+    def channel(self, ch):
+        key = ch.node + "/" + ch.name
+        slot = self.index.get(key)
+        if slot is None:
+            slot = self._allot(ch, key)
+            if slot is None:
+                return
+        off, lock, count = slot
+        value = ch.value
+        kind = KIND_FLOAT
+        if value is None:
+            value = NAN
+        elif isinstance(value, ( int, long )):
+            kind = KIND_INT
+        m = self.map
+
+        lock = (lock + 1) & 0xffffffff
+        LOCK.pack_into(m, off, lock)
+        ring = off + SLOT_HEAD.size
+        SAMPLE.pack_into(m, ring + (count % self.ring) * SAMPLE.size, ch.stamp, value)
+        count += 1
+        body = BODY.pack(kind, ch.node, ch.name, value, ch.stamp, ch.seq, count)
+        SLOT_HEAD.pack_into(m, off, lock, kind, ch.node, ch.name, value, ch.stamp, ch.seq, count,
+                            _crc(body), _crc(m[ring:off + self.slot_size]))
+        lock = (lock + 1) & 0xffffffff
+        LOCK.pack_into(m, off, lock)
+
+        slot[1] = lock
+        slot[2] = count
+
+    def cycle(self, hub):
+        pass
+
+
+#-----------------------------------------------------------------------------
+# Reader side, any number of processes
+#-----------------------------------------------------------------------------
+class ShmReader:
+
+    def __init__(self, path=SHM_PATH):
+        self.path = path
+        f = open(path, "rb")
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic, version, slots, ring, used = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d sensd shared memory file" % ( path, VERSION ))
+        self.slots = slots
+        self.ring = ring
+        self.slot_size = slot_size(ring)
+        self.index = {}    # "node/chan" -> offset
+
+    def close(self):
+        self.map.close()
+
+    #-----------------------------------------------------------------------------
+    # Consistent copy of one slot, None if the writer never let go of it
+    #-----------------------------------------------------------------------------
+    def _read(self, off, samples=False):
+        m = self.map
+        end = off + self.slot_size
+        for i in range(RETRIES):
+            lock = LOCK.unpack_from(m, off)[0]
+            if lock & 1:
+                continue
+            raw = m[off:off + SLOT_HEAD.size]
+            ring = None
+            if samples:
+                ring = m[off + SLOT_HEAD.size:end]
+            if LOCK.unpack_from(m, off)[0] != lock:
+                continue
+            head = SLOT_HEAD.unpack(raw)
+            if _crc(raw[BODY_AT:BODY_AT + BODY.size]) != head[8]:
+                continue
+            if samples and _crc(ring) != head[9]:
+                continue
+            return head, ring
+        return None
+
+    def _scan(self):
+        self.index = {}
+        used = USED.unpack_from(self.map, USED_AT)[0]
+        for i in range(min(used, self.slots)):
+            off = HEADER_SIZE + i * self.slot_size
+            got = self._read(off)
+            if got is not None:
+                head = got[0]
+                self.index[head[2].rstrip("\0") + "/" + head[3].rstrip("\0")] = off
+
+    def _slot(self, node, name, samples):
+        node = node[:8]
+        name = name[:8]
+        key = node + "/" + name
+        for attempt in range(2):
+            off = self.index.get(key)
+            if off is not None:
+                got = self._read(off, samples)
+                if got is not None and got[0][2].rstrip("\0") == node \
+                        and got[0][3].rstrip("\0") == name:
+                    return got
+            # new channel or a restarted writer moved it
+            self._scan()
+        return None
+
+    #-----------------------------------------------------------------------------
+    # Queries
+    #-----------------------------------------------------------------------------
+    def channels(self):
+        self._scan()
+        return sorted(self.index)
+
+    # ( value, time, seq ) of the last publish, None for an unknown channel
+    def latest(self, node, name):
+        got = self._slot(node, name, False)
+        if got is None:
+            return None
+        lock, kind, n, c, value, t, seq, count = got[0][:8]
+        if seq == 0:
+            return None
+        if kind == KIND_INT:
+            value = int(value)
+        return ( value, t, seq )
+
+    # [ ( time, value ) ] of the recent publishes, oldest first
+    def recent(self, node, name):
+        got = self._slot(node, name, True)
+        if got is None:
+            return []
+        kind = got[0][1]
+        count = got[0][7]
+        ring = got[1]
+        n = min(count, self.ring)
+        out = []
+        for i in range(count - n, count):
+            t, value = SAMPLE.unpack_from(ring, (i % self.ring) * SAMPLE.size)
+            if kind == KIND_INT and value == value:
+                value = int(value)
+            out.append( ( t, value ) )
+        return out
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,664 @@
+#!/usr/bin/python
+#
+# Simulated i2c bus with device models
+# Raspberry Pi (or any Linux box)
+#
+# An in-memory stand-in for smbus2's SMBus/i2c_msg so sensd, the drivers
+# and the benchmarks can run without the sensors attached.  The device
+# models answer the same commands as the real chips, frame their data the
+# same way (Sensirion CRC8 words, K30 checksums, BME680 calibration and
+# field registers) and are only readable once their conversion time has
+# passed.  Every device can be given NACK, CRC corruption and timeout
+# rates to exercise the drivers' error paths.
+#
+# Use it with:
+#   I2C_BACKEND=sim ./sensd
+# or from python:
+#   sim = simbus.default_bus()
+#   BUSES.set_backend( *simbus.backend(sim) )
+#
+import errno
+import math
+import random
+
+from . import clock
+
+I2C_M_RD = 0x0001
+
+# The README slows the Pi's i2c down to 20kHz for the CCS811
+I2C_BAUD = 20000
+BYTE_TIME = 9.0 / I2C_BAUD   # 8 data bits + ack
+OPEN_TIME = 0.0001           # open() + ioctl(I2C_SLAVE) on /dev/i2c-N
+
+
+#-----------------------------------------------------------------------------
+# CRC8 as used by the Sensirion and Measurement Specialties parts
+#-----------------------------------------------------------------------------
+def crc8(data, init):
+    crc = init
+    for byte in data:
+        crc ^= byte
+        for i in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x31) & 0xff
+            else:
+                crc = (crc << 1) & 0xff
+    return crc
+
+def word(value, init=0xff):
+    msb = (value >> 8) & 0xff
+    lsb = value & 0xff
+    return [ msb, lsb, crc8([ msb, lsb ], init) ]
+
+
+#-----------------------------------------------------------------------------
+# Errors raised like the kernel i2c driver does
+#-----------------------------------------------------------------------------
+def nack():
+    return IOError(errno.EREMOTEIO, "Remote I/O error")
+
+def timeout():
+    return IOError(errno.ETIMEDOUT, "Connection timed out")
+
+
+#-----------------------------------------------------------------------------
+# Fault injection rates, each a probability per bus transfer
+#-----------------------------------------------------------------------------
+class Faults:
+
+    def __init__(self, nack=0.0, crc=0.0, timeout=0.0, timeout_s=0.025, seed=None):
+        self.nack = nack
+        self.crc = crc
+        self.timeout = timeout
+        self.timeout_s = timeout_s  # how long a timed out transfer hangs
+        self.rng = random.Random(seed)
+        self.counts = { "nack": 0, "crc": 0, "timeout": 0 }
+        self.hung = 0.0
+
+    # raise for a transfer that fails outright
+    def transfer(self):
+        r = self.rng.random()
+        if r < self.nack:
+            self.counts["nack"] += 1
+            raise nack()
+        if r < self.nack + self.timeout:
+            self.counts["timeout"] += 1
+            self.hung += self.timeout_s
+            clock.sleep(self.timeout_s)
+            raise timeout()
+
+    # flip one bit of a read back
+    def corrupt(self, data):
+        if data and self.rng.random() < self.crc:
+            self.counts["crc"] += 1
+            i = self.rng.randrange(len(data))
+            data[i] ^= 1 << self.rng.randrange(8)
+        return data
+
+
+#-----------------------------------------------------------------------------
+# Shared surroundings the device models measure
+#-----------------------------------------------------------------------------
+# slow daily swing plus a little noise so averages have something to do
+class Environment:
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.temp = 22.0     # C
+        self.rh = 45.0       # %
+        self.pressure = 1013.0 # hPa
+        self.co2 = 450       # ppm
+        self.tvoc = 25       # ppb
+        self.period = 86400.0
+
+    def _swing(self, base, amplitude, noise):
+        phase = 2.0 * math.pi * clock.now() / self.period
+        return base + amplitude * math.sin(phase) + self.rng.gauss(0.0, noise)
+
+    def temperature(self):
+        return self._swing(self.temp, 3.0, 0.05)
+
+    def humidity(self):
+        return min(100.0, max(0.0, self._swing(self.rh, -8.0, 0.2)))
+
+    def hpa(self):
+        return self._swing(self.pressure, 2.0, 0.02)
+
+    def co2_ppm(self):
+        return int(round(self._swing(self.co2, 60.0, 5.0)))
+
+    def tvoc_ppb(self):
+        return max(0, int(round(self._swing(self.tvoc, 10.0, 3.0))))
+
+
+#-----------------------------------------------------------------------------
+# Device model base, a command/response part that NACKs while converting
+#-----------------------------------------------------------------------------
+class Device(object):
+
+    def __init__(self, addr, env=None, faults=None):
+        self.addr = addr
+        self.env = env or Environment()
+        self.faults = faults or Faults()
+        self.ready_at = 0.0
+        self.pending = []
+
+    def respond(self, data, latency):
+        self.pending = data
+        self.ready_at = clock.now() + latency
+
+    def write(self, data):
+        pass
+
+    def read(self, length):
+        if clock.now() < self.ready_at:
+            raise nack()
+        data = self.pending[:length]
+        data += [ 0xff ] * (length - len(data))
+        return data
+
+
+#-----------------------------------------------------------------------------
+# Sensirion SGP30
+#-----------------------------------------------------------------------------
+SGP30_LATENCY = { 0x03: 0.010,   # init air quality
+                  0x08: 0.012,   # measure air quality
+                  0x15: 0.010,   # get baseline
+                  0x1e: 0.010,   # set baseline
+                  0x61: 0.010,   # set humidity
+                  0x2f: 0.002,   # get feature set
+                  0x50: 0.025 }  # measure raw signals
+
+class SGP30(Device):
+
+    def __init__(self, addr=0x58, env=None, faults=None, serial=0x00000172a2b3):
+        Device.__init__(self, addr, env, faults)
+        self.serial = serial
+        self.feature_set = 0x0020
+        self.baseline_co2 = 0x8973
+        self.baseline_voc = 0x8aae
+        self.ah = None
+        self.initialized = False
+
+    def write(self, data):
+        # a lone byte is the register pointer smbus sends before a block read
+        if len(data) < 2:
+            return
+
+        if data[0] == 0x36 and data[1] == 0x82:
+            s = self.serial
+            self.respond( word((s >> 32) & 0xffff) + word((s >> 16) & 0xffff) + word(s & 0xffff), 0.0005 )
+            return
+
+        if data[0] != 0x20 or data[1] not in SGP30_LATENCY:
+            raise nack()
+
+        cmd = data[1]
+        latency = SGP30_LATENCY[cmd]
+        if cmd == 0x03:
+            self.initialized = True
+            self.respond( [], latency )
+        elif cmd == 0x08:
+            co2 = 400
+            voc = 0
+            if self.initialized:
+                co2 = self.env.co2_ppm()
+                voc = self.env.tvoc_ppb()
+            self.respond( word(co2) + word(voc), latency )
+        elif cmd == 0x15:
+            self.respond( word(self.baseline_co2) + word(self.baseline_voc), latency )
+        elif cmd == 0x1e:
+            if len(data) >= 8 and crc8(data[2:4], 0xff) == data[4] and crc8(data[5:7], 0xff) == data[7]:
+                self.baseline_voc = (data[2] << 8) | data[3]
+                self.baseline_co2 = (data[5] << 8) | data[6]
+            self.respond( [], latency )
+        elif cmd == 0x61:
+            if len(data) >= 5 and crc8(data[2:4], 0xff) == data[4]:
+                self.ah = data[2] + data[3] / 256.0
+            self.respond( [], latency )
+        elif cmd == 0x2f:
+            self.respond( word(self.feature_set), latency )
+        elif cmd == 0x50:
+            h2 = 13600 + self.env.rng.randint(-40, 40)
+            et = 18200 + self.env.rng.randint(-40, 40)
+            self.respond( word(h2) + word(et), latency )
+
+
+#-----------------------------------------------------------------------------
+# Measurement Specialties HTU21D
+#-----------------------------------------------------------------------------
+HTU21D_TEMP_LATENCY = 0.050
+HTU21D_HUM_LATENCY  = 0.016
+HTU21D_RESET_LATENCY = 0.015
+
+class HTU21D(Device):
+
+    def write(self, data):
+        cmd = data[0]
+        if cmd == 0xfe:
+            self.respond( [], HTU21D_RESET_LATENCY )
+        elif cmd in ( 0xf3, 0xe3 ):
+            t = self.env.temperature()
+            raw = int((t + 46.85) * 65536.0 / 175.72) & 0xfffc
+            self._measure( raw, HTU21D_TEMP_LATENCY, cmd == 0xe3 )
+        elif cmd in ( 0xf5, 0xe5 ):
+            h = self.env.humidity()
+            raw = (int((h + 6.0) * 65536.0 / 125.0) & 0xfffc) | 0x02
+            self._measure( raw, HTU21D_HUM_LATENCY, cmd == 0xe5 )
+        elif cmd == 0xe7:
+            self.respond( [ 0x02 ], 0.0 )
+        elif cmd == 0xe6:
+            pass
+        else:
+            raise nack()
+
+    def _measure(self, raw, latency, hold):
+        if hold:
+            # hold master stretches the clock instead of NACKing
+            clock.sleep(latency)
+            latency = 0.0
+        self.respond( word(raw, 0x00), latency )
+
+
+#-----------------------------------------------------------------------------
+# CO2 Meter K30
+#-----------------------------------------------------------------------------
+K30_LATENCY = 0.010
+
+class K30(Device):
+
+    def write(self, data):
+        if len(data) < 4 or (sum(data[:-1]) & 0xff) != data[-1]:
+            raise nack()
+        if data[0] == 0x22 and data[2] == 0x08:
+            co2 = self.env.co2_ppm()
+            resp = [ 0x21, (co2 >> 8) & 0xff, co2 & 0xff ]
+            resp.append( sum(resp) & 0xff )
+            self.respond( resp, K30_LATENCY )
+        else:
+            self.respond( [ 0x20, 0, 0, 0x20 ], K30_LATENCY )
+
+
+#-----------------------------------------------------------------------------
+# Register file part, the first written byte is the register pointer
+#-----------------------------------------------------------------------------
+class RegisterDevice(Device):
+
+    def __init__(self, addr, env=None, faults=None):
+        Device.__init__(self, addr, env, faults)
+        self.regs = [ 0 ] * 256
+        self.ptr = 0
+
+    def update(self):
+        pass
+
+    def read(self, length):
+        self.update()
+        data = []
+        for i in range(length):
+            data.append( self.read_reg( (self.ptr + i) & 0xff ) )
+        return data
+
+    def read_reg(self, reg):
+        return self.regs[reg]
+
+
+#-----------------------------------------------------------------------------
+# AMS CCS811
+#-----------------------------------------------------------------------------
+CCS811_APP_START_LATENCY = 0.002
+
+class CCS811(RegisterDevice):
+
+    def __init__(self, addr=0x5a, env=None, faults=None):
+        RegisterDevice.__init__(self, addr, env, faults)
+        self.regs[0x00] = 0x10       # APP_VALID, still in boot mode
+        self.regs[0x20] = 0x81       # HW ID
+        self.regs[0x21] = 0x12       # HW version
+        self.regs[0x23] = 0x10       # boot version
+        self.regs[0x24] = 0x20       # app version 2.0.0
+        self.regs[0x25] = 0x00
+        self.regs[0x11] = 0x84
+        self.regs[0x12] = 0x7b
+        self.drive_period = 0.0
+        self.next_sample = 0.0
+
+    def write(self, data):
+        reg = data[0]
+        self.ptr = reg
+        if reg == 0xf4:
+            self.regs[0x00] |= 0x80  # FW_MODE
+            self.ready_at = clock.now() + CCS811_APP_START_LATENCY
+            return
+        if len(data) == 1:
+            return
+        if not self.regs[0x00] & 0x80 and reg not in ( 0xf1, 0xf2, 0xf3, 0xff ):
+            raise nack()
+
+        if reg == 0x01:
+            self.regs[0x01] = data[1]
+            mode = (data[1] >> 4) & 0x07
+            self.drive_period = { 0: 0.0, 1: 1.0, 2: 10.0, 3: 60.0, 4: 0.25 }.get(mode, 0.0)
+            self.next_sample = clock.now() + self.drive_period
+        else:
+            for i, value in enumerate(data[1:]):
+                self.regs[(reg + i) & 0xff] = value
+
+    def update(self):
+        if clock.now() < self.ready_at:
+            raise nack()
+        if self.drive_period and clock.now() >= self.next_sample:
+            while self.next_sample <= clock.now():
+                self.next_sample += self.drive_period
+            eco2 = self.env.co2_ppm()
+            tvoc = min(1187, self.env.tvoc_ppb())
+            self.regs[0x02:0x06] = [ eco2 >> 8, eco2 & 0xff, tvoc >> 8, tvoc & 0xff ]
+            self.regs[0x00] |= 0x08  # DATA_READY
+
+    def read(self, length):
+        data = RegisterDevice.read(self, length)
+        if self.ptr == 0x02:
+            self.regs[0x00] &= ~0x08
+        return data
+
+
+#-----------------------------------------------------------------------------
+# Bosch BME680
+#-----------------------------------------------------------------------------
+# calibration of a typical part, laid out as in the 0x89 and 0xe1 blocks
+BME680_CALIB = { "t1": 26203, "t2": 26153, "t3": 3,
+                 "p1": 36478, "p2": -10451, "p3": 88, "p4": 7014, "p5": -79,
+                 "p6": 30, "p7": 37, "p8": -3016, "p9": -1928, "p10": 30,
+                 "h1": 762, "h2": 1034, "h3": 0, "h4": 45, "h5": 20, "h6": 120, "h7": -100,
+                 "gh1": -30, "gh2": -11943, "gh3": 18 }
+BME680_HEAT_RANGE = 0x10
+BME680_HEAT_VAL = 44
+BME680_SW_ERR = 0x00
+
+def _bme680_calibration(c):
+    cal = [ 0 ] * 41
+
+    def put16(lsb, value):
+        value &= 0xffff
+        cal[lsb] = value & 0xff
+        cal[lsb + 1] = value >> 8
+
+    def put8(i, value):
+        cal[i] = value & 0xff
+
+    put16(1, c["t2"]); put8(3, c["t3"])
+    put16(5, c["p1"]); put16(7, c["p2"]); put8(9, c["p3"])
+    put16(11, c["p4"]); put16(13, c["p5"]); put8(15, c["p7"]); put8(16, c["p6"])
+    put16(19, c["p8"]); put16(21, c["p9"]); put8(23, c["p10"])
+    cal[25] = (c["h2"] >> 4) & 0xff
+    cal[26] = ((c["h2"] & 0x0f) << 4) | (c["h1"] & 0x0f)
+    cal[27] = (c["h1"] >> 4) & 0xff
+    put8(28, c["h3"]); put8(29, c["h4"]); put8(30, c["h5"]); put8(31, c["h6"]); put8(32, c["h7"])
+    put16(33, c["t1"]); put16(35, c["gh2"]); put8(37, c["gh1"]); put8(38, c["gh3"])
+    return cal
+
+class BME680(RegisterDevice):
+
+    def __init__(self, addr=0x77, env=None, faults=None, calib=None):
+        RegisterDevice.__init__(self, addr, env, faults)
+        self.calib = _bme680_calibration(calib or BME680_CALIB)
+        self.meas_index = 0
+        self.converting = False
+        self.ready_at_meas = 0.0
+        self.reset()
+
+    def reset(self):
+        for reg in range(0x1d, 0x76):
+            self.regs[reg] = 0
+        self.regs[0xd0] = 0x61
+        self.regs[0x00] = BME680_HEAT_VAL
+        self.regs[0x02] = BME680_HEAT_RANGE
+        self.regs[0x04] = BME680_SW_ERR
+        for i in range(25):
+            self.regs[0x89 + i] = self.calib[i]
+        for i in range(16):
+            self.regs[0xe1 + i] = self.calib[25 + i]
+        self.converting = False
+
+    # i2c writes are register/value pairs, a lone byte sets the pointer
+    def write(self, data):
+        self.update()
+        self.ptr = data[0]
+        pairs = data
+        if len(pairs) % 2:
+            pairs = pairs[:-1]
+        for i in range(0, len(pairs), 2):
+            self.write_reg( pairs[i], pairs[i + 1] )
+
+    def write_reg(self, reg, value):
+        if reg == 0xe0:
+            if value == 0xb6:
+                self.reset()
+                self.ready_at = clock.now() + 0.002
+            return
+        self.regs[reg] = value
+        if reg == 0x74 and (value & 0x03) == 0x01:
+            self.converting = True
+            self.regs[0x1d] &= ~0x80
+            self.ready_at_meas = clock.now() + self.conversion_time()
+
+    def conversion_time(self):
+        cycles = [ 0, 1, 2, 4, 8, 16 ]
+        os_t = cycles[min(5, (self.regs[0x74] >> 5) & 0x07)]
+        os_p = cycles[min(5, (self.regs[0x74] >> 2) & 0x07)]
+        os_h = cycles[min(5, self.regs[0x72] & 0x07)]
+        t = (os_t + os_p + os_h) * 0.001963 + 0.000477 * 4 + 0.000477 * 5 + 0.001
+        if self.regs[0x71] & 0x10:
+            profile = self.regs[0x71] & 0x0f
+            wait = self.regs[0x64 + profile]
+            t += (wait & 0x3f) * (4 ** (wait >> 6)) / 1000.0
+        return t
+
+    def update(self):
+        if clock.now() < self.ready_at:
+            raise nack()
+        if self.converting and clock.now() >= self.ready_at_meas:
+            self.converting = False
+            self.fill_fields()
+            self.regs[0x74] &= ~0x03
+
+    # ADC counts for the current environment with this part's calibration
+    def fill_fields(self):
+        rng = self.env.rng
+        adc_temp = 483400 + int((self.env.temperature() - 20.0) * 3206) + rng.randint(-40, 40)
+        adc_pres = 347100 - int((self.env.hpa() - 1000.0) * 584) + rng.randint(-20, 20)
+        adc_hum = 20044 + int((self.env.humidity() - 40.0) * 170) + rng.randint(-10, 10)
+        adc_gas = 620 + rng.randint(-6, 6)
+        gas_range = 5
+
+        self.meas_index = (self.meas_index + 1) & 0xff
+        profile = self.regs[0x71] & 0x0f
+        f = self.regs
+        f[0x1d] = 0x80 | profile
+        f[0x1e] = self.meas_index
+        f[0x1f] = (adc_pres >> 12) & 0xff
+        f[0x20] = (adc_pres >> 4) & 0xff
+        f[0x21] = (adc_pres & 0x0f) << 4
+        f[0x22] = (adc_temp >> 12) & 0xff
+        f[0x23] = (adc_temp >> 4) & 0xff
+        f[0x24] = (adc_temp & 0x0f) << 4
+        f[0x25] = (adc_hum >> 8) & 0xff
+        f[0x26] = adc_hum & 0xff
+        f[0x2a] = (adc_gas >> 2) & 0xff
+        f[0x2b] = ((adc_gas & 0x03) << 6) | gas_range
+        if self.regs[0x71] & 0x10:
+            f[0x2b] |= 0x20 | 0x10   # gas valid, heater stable
+
+
+#-----------------------------------------------------------------------------
+# i2c_msg stand-in for i2c_rdwr()
+#-----------------------------------------------------------------------------
+class SimMsg(object):
+
+    def __init__(self, addr, flags, data):
+        self.addr = addr
+        self.flags = flags
+        self.buf = bytearray(data)
+        self.len = len(self.buf)
+
+    @staticmethod
+    def read(address, length):
+        return SimMsg(address, I2C_M_RD, length)
+
+    @staticmethod
+    def write(address, buf):
+        return SimMsg(address, 0, buf)
+
+    def __iter__(self):
+        return iter(self.buf)
+
+    def __len__(self):
+        return self.len
+
+    def __bytes__(self):
+        return bytes(self.buf)
+
+    def __str__(self):
+        return str(self.buf)
+
+
+#-----------------------------------------------------------------------------
+# SMBus stand-in, one per open()
+#-----------------------------------------------------------------------------
+class SimSMBus(object):
+
+    def __init__(self, sim, busnum):
+        self.sim = sim
+        self.busnum = busnum
+        self.closed = False
+        sim.wait(sim.open_time)
+        sim.opens += 1
+
+    def _device(self, addr, nbytes):
+        if self.closed:
+            raise IOError(errno.EBADF, "Bad file descriptor")
+        self.sim.transfers += 1
+        self.sim.bytes += nbytes + 1
+        self.sim.wait((nbytes + 1) * self.sim.byte_time)
+        dev = self.sim.devices.get(self.busnum, {}).get(addr)
+        if dev is None:
+            raise nack()
+        try:
+            dev.faults.transfer()
+        finally:
+            self.sim.bus_time += dev.faults.hung
+            dev.faults.hung = 0.0
+        return dev
+
+    def _read(self, addr, length):
+        dev = self._device(addr, length)
+        return dev.faults.corrupt( dev.read(length) )
+
+    def _write(self, addr, data):
+        self._device(addr, len(data)).write( list(data) )
+
+    def write_quick(self, addr):
+        self._device(addr, 0)
+
+    def read_byte(self, addr):
+        return self._read(addr, 1)[0]
+
+    def write_byte(self, addr, value):
+        self._write(addr, [ value ])
+
+    def read_byte_data(self, addr, register):
+        self._write(addr, [ register ])
+        return self._read(addr, 1)[0]
+
+    def write_byte_data(self, addr, register, value):
+        self._write(addr, [ register, value ])
+
+    def read_word_data(self, addr, register):
+        self._write(addr, [ register ])
+        data = self._read(addr, 2)
+        return data[0] | (data[1] << 8)
+
+    def write_word_data(self, addr, register, value):
+        self._write(addr, [ register, value & 0xff, (value >> 8) & 0xff ])
+
+    def read_i2c_block_data(self, addr, register, length):
+        self._write(addr, [ register ])
+        return self._read(addr, length)
+
+    def write_i2c_block_data(self, addr, register, data):
+        self._write(addr, [ register ] + list(data))
+
+    def i2c_rdwr(self, *msgs):
+        for msg in msgs:
+            if msg.flags & I2C_M_RD:
+                data = self._read(msg.addr, msg.len)
+                for i in range(msg.len):
+                    msg.buf[i] = data[i]
+            else:
+                self._write(msg.addr, list(msg))
+
+    def close(self):
+        self.closed = True
+
+
+#-----------------------------------------------------------------------------
+# A set of simulated buses, its open() is the SMBus factory
+#-----------------------------------------------------------------------------
+class SimBus:
+
+    def __init__(self, open_time=OPEN_TIME, byte_time=BYTE_TIME):
+        self.open_time = open_time
+        self.byte_time = byte_time
+        self.devices = {}    # bus number -> { addr: Device }
+        self.opens = 0
+        self.transfers = 0
+        self.bytes = 0
+        self.bus_time = 0.0  # modelled seconds spent on the wires
+
+    # time taken by the bus itself, as opposed to a conversion wait
+    def wait(self, seconds):
+        self.bus_time += seconds
+        clock.sleep(seconds)
+
+    def add(self, dev, busnum=1):
+        self.devices.setdefault(busnum, {})[dev.addr] = dev
+        return dev
+
+    def open(self, busnum):
+        return SimSMBus(self, busnum)
+
+    def stats(self):
+        info = { "opens": self.opens, "transfers": self.transfers, "bytes": self.bytes,
+                 "bus_time": self.bus_time, "faults": {} }
+        for busnum, devs in self.devices.items():
+            for addr, dev in devs.items():
+                info["faults"]["%d-%02x" % ( busnum, addr )] = dict(dev.faults.counts)
+        return info
+
+
+#-----------------------------------------------------------------------------
+# The five supported sensors at the addresses sensd uses
+#-----------------------------------------------------------------------------
+def default_bus(faults=None, seed=None, **kw):
+    sim = SimBus(**kw)
+    env = Environment(seed)
+
+    def f():
+        if faults is None:
+            return Faults(seed=seed)
+        return Faults(faults.nack, faults.crc, faults.timeout, faults.timeout_s, seed)
+
+    sim.add( SGP30(0x58, env, f()) )
+    sim.add( HTU21D(0x40, env, f()) )
+    sim.add( K30(0x68, env, f()) )
+    sim.add( CCS811(0x5a, env, f()) )
+    sim.add( BME680(0x77, env, f()) )
+    return sim
+
+# ( SMBus factory, i2c_msg ) pair for BusManager.set_backend()
+def backend(sim=None):
+    if sim is None:
+        sim = default_bus()
+    return sim.open, SimMsg
+
+#-----------------------------------------------------------------------------
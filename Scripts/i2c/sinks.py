@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Hub sinks of a node
+# Raspberry Pi
+#
+# Adds the sinks the [sinks] section of the config (config.py) asks for to
+# a hub, the same for sensd running all sensors itself and for sensdsup
+# collecting the values of its workers (supervisor.py).  MQTT_HOST,
+# MQTT_BACKEND=sim, SENSD_LOG and SENSD_ROLLUP in the environment win over
+# the config.  The legacy per value files are not here, the hub makes
+# those itself (hub.py).
+#
+import atexit
+import os
+
+from . import history
+from . import mqtt
+from . import pubsub
+from . import rollup
+from . import seglog
+from . import shmring
+from .hub import HUB, SnapshotSink
+
+
+class Sinks:
+
+    def __init__(self, conf, hub=HUB):
+        # whole node snapshot in /tmp/sensd.json and /tmp/sensd.bin after every tick
+        if conf.getboolean("sinks", "snapshot", True):
+            hub.add_sink( SnapshotSink() )
+        # and every value as it is published in /tmp/sensd.shm, see shmring.py
+        if conf.getboolean("sinks", "shm", True):
+            hub.add_sink( shmring.ShmSink() )
+        # and pushed to subscribers of /tmp/sensd.sock, see pubsub.py
+        if conf.getboolean("sinks", "pubsub", True):
+            hub.add_sink( pubsub.PubSubSink() )
+
+        # and batched to an MQTT broker when one is given, see mqtt.py, what
+        # is not sent by exit is kept in the outbox
+        self.mqtt = None
+        broker = os.environ.get("MQTT_HOST", conf.get("sinks", "mqtt"))
+        if broker == "sim":
+            os.environ["MQTT_BACKEND"] = "sim"
+            broker = None
+        if broker is not None or os.environ.get("MQTT_BACKEND") == "sim":
+            host, port = mqtt.HOST, mqtt.PORT
+            if broker is not None:
+                host, sep, port = broker.partition(":")
+                port = port or mqtt.PORT
+            self.mqtt = mqtt.MqttSink( host, int(os.environ.get("MQTT_PORT", port)),
+                                       outbox=os.environ.get("MQTT_OUTBOX", mqtt.OUTBOX) )
+            hub.add_sink( self.mqtt )
+            atexit.register( self.mqtt.close )
+
+        # and logged to the USB drive when SENSD_LOG names a directory on it,
+        # see seglog.py, whatever is still buffered is written out on exit and
+        # closed segments are packed into compressed history, history.py
+        self.log = None
+        directory = os.environ.get("SENSD_LOG", conf.get("sinks", "log"))
+        if directory is not None:
+            self.log = seglog.SegmentLog( directory, on_close=history.compact_async )
+            hub.add_sink( self.log )
+            atexit.register( self.log.close )
+
+        # and rolled up per minute, hour and day when SENSD_ROLLUP names a
+        # directory for them, see rollup.py and sensq to query them
+        self.rollup = None
+        directory = os.environ.get("SENSD_ROLLUP", conf.get("sinks", "rollup"))
+        if directory is not None:
+            self.rollup = rollup.RollupSink( directory )
+            hub.add_sink( self.rollup )
+            atexit.register( self.rollup.close )
+
+    def report(self):
+        if self.mqtt is not None:
+            print "mqtt: %s" % self.mqtt.stats()
+        if self.log is not None:
+            print "seglog: %s" % self.log.stats()
+        if self.rollup is not None:
+            print "rollup: %s" % self.rollup.stats()
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# Sliding window statistics over several time spans at once
+# Raspberry Pi
+#
+# Every sample goes into one queue sized for the longest window.  Each
+# window keeps its own count, sum and sum of squares and its own min/max
+# candidate queues.  Adding a sample and expiring old ones is O(1)
+# amortized per window, so asking for the stats never walks the samples.
+#
+# Sums are taken relative to the first sample seen so the variance of a
+# large value with little spread, e.g. pressure in hPa, keeps its digits.
+#
+import collections
+import math
+
+# 1 min, 5 min, 15 min and 1 hour
+WINDOWS = ( 60, 300, 900, 3600 )
+
+
+#-----------------------------------------------------------------------------
+# One time span
+#-----------------------------------------------------------------------------
+class Window(object):
+    __slots__ = ( "span", "n", "total", "squares", "mins", "maxs" )
+
+    def __init__(self, span):
+        self.span = span
+        self.n = 0            # newest n samples of the shared queue
+        self.total = 0.0
+        self.squares = 0.0
+        self.mins = collections.deque()   # ( t, v ) rising v
+        self.maxs = collections.deque()   # ( t, v ) falling v
+
+
+#-----------------------------------------------------------------------------
+# Statistics for every window of one channel
+#-----------------------------------------------------------------------------
+class MultiWindow(object):
+
+    def __init__(self, windows=WINDOWS):
+        self.windows = [ Window(span) for span in sorted(windows) ]
+        self.samples = collections.deque()   # ( t, v ) oldest first
+        self.offset = None
+
+    def add(self, t, value):
+        if self.offset is None:
+            self.offset = value
+        self.samples.append( ( t, value ) )
+        d = value - self.offset
+
+        for w in self.windows:
+            w.n += 1
+            w.total += d
+            w.squares += d * d
+
+            mins = w.mins
+            while mins and mins[-1][1] >= value:
+                mins.pop()
+            mins.append( ( t, value ) )
+
+            maxs = w.maxs
+            while maxs and maxs[-1][1] <= value:
+                maxs.pop()
+            maxs.append( ( t, value ) )
+
+        self.expire(t)
+
+    # drop samples that have fallen out of each window as of time now
+    def expire(self, now):
+        samples = self.samples
+        for w in self.windows:
+            cutoff = now - w.span
+            while w.n and samples[-w.n][0] <= cutoff:
+                d = samples[-w.n][1] - self.offset
+                w.total -= d
+                w.squares -= d * d
+                w.n -= 1
+            if w.n == 0:
+                w.total = 0.0
+                w.squares = 0.0
+            while w.mins and w.mins[0][0] <= cutoff:
+                w.mins.popleft()
+            while w.maxs and w.maxs[0][0] <= cutoff:
+                w.maxs.popleft()
+
+        # the longest window holds the most samples
+        keep = self.windows[-1].n
+        while len(samples) > keep:
+            samples.popleft()
+
+    #-----------------------------------------------------------------------------
+    # [ ( span, n, mean, min, max, std ) ] shortest window first, None
+    # for the values of a window with no samples
+    #-----------------------------------------------------------------------------
+    def stats(self, now=None):
+        if now is not None:
+            self.expire(now)
+        info = []
+        for w in self.windows:
+            if w.n == 0:
+                info.append( ( w.span, 0, None, None, None, None ) )
+                continue
+            mean = w.total / w.n
+            var = max(0.0, w.squares / w.n - mean * mean)
+            info.append( ( w.span, w.n, mean + self.offset,
+                           w.mins[0][1], w.maxs[0][1], math.sqrt(var) ) )
+        return info
+
+#-----------------------------------------------------------------------------
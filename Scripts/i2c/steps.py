@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Step generators for i2c transactions
+# Raspberry Pi
+#
+# A driver method written as a generator does its bus writes and reads
+# between yields and yields the number of seconds the device needs to
+# finish a conversion.  Whoever runs the generator decides what happens
+# during that wait: run() below just sleeps, a scheduler can use the bus
+# for other devices.  Python 2 generators can't return a value, so the
+# last thing yielded is a Done() holding the method's result.
+#
+import heapq
+
+from . import clock
+
+#-----------------------------------------------------------------------------
+# Result marker, always the final step
+#-----------------------------------------------------------------------------
+class Done(object):
+    __slots__ = ( "value", )
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+#-----------------------------------------------------------------------------
+# Run a step generator to completion, sleeping through its waits
+#-----------------------------------------------------------------------------
+def run(gen):
+    result = None
+    for step in gen:
+        if isinstance(step, Done):
+            result = step.value
+            gen.close()
+            break
+        clock.sleep(step)
+    return result
+
+#-----------------------------------------------------------------------------
+# Run several step generators at once, results come back in the same order
+#-----------------------------------------------------------------------------
+# Every device gets its command first, then each one is read back as soon
+# as its own wait is over, so a pass costs about the longest wait instead
+# of the sum of them.  Generators for the same device (devices[i]) run one
+# after the other in the order given.  If finished is a list it gets the
+# clock time each generator completed at.
+def run_all(gens, devices=None, finished=None):
+    results = [ None ] * len(gens)
+    queued = {}   # device -> indexes waiting for the device to be free
+    device = {}   # index -> device
+    active = []   # heap of ( wake time, index )
+
+    now = clock.now()
+    for i in range(len(gens)):
+        dev = None
+        if devices is not None:
+            dev = devices[i]
+        if dev is None:
+            dev = ( "gen", i )
+        device[i] = dev
+        if dev in queued:
+            queued[dev].append(i)
+        else:
+            queued[dev] = []
+            heapq.heappush(active, ( now, i ))
+
+    while active:
+        wake, i = heapq.heappop(active)
+        clock.sleep(wake - clock.now())
+
+        gen = gens[i]
+        try:
+            step = next(gen)
+        except StopIteration:
+            step = Done()
+
+        if isinstance(step, Done):
+            results[i] = step.value
+            gen.close()
+            if finished is not None:
+                finished[i] = clock.now()
+            # device is free for its next generator
+            waiting = queued[device[i]]
+            if waiting:
+                heapq.heappush(active, ( clock.now(), waiting.pop(0) ))
+        else:
+            heapq.heappush(active, ( clock.now() + step, i ))
+
+    return results
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+#
+# Per sensor worker processes for sensdsup
+# Raspberry Pi
+#
+# sensdsup runs each sensor group of the config (config.py, group =, the
+# sensor's own name when not set) as a sensd worker process of its own, so
+# a driver that throws only takes its own group down.  A worker that exits
+# is started again after RESTART_MIN seconds, twice as long after each exit
+# in a row up to RESTART_MAX, and back to RESTART_MIN once it has kept
+# running for STABLE_SECONDS.  The other workers keep sampling meanwhile.
+#
+# Workers get SENSD_WORKER=<group>, SENSD_PIPE=<fd> and I2C_LOCK=1 in the
+# environment.  They write the legacy files themselves and hand every
+# published value to the supervisor through the pipe (ForwardSink), one
+# JSON line each
+#
+#   ["<node>", "<chan>", <value>, <time>, "<quantity>" or null]
+#
+# and an empty line at the end of each acquisition cycle.  Once its sensors
+# are made a worker declares all their channels, ["<node>", "<chan>",
+# "<quantity>" or null, <cadence> or null] each, so the snapshot lists them
+# from the start with no value and how often they come, as sensd on its own
+# does.  The supervisor publishes them
+# into its own hub (Relay), which runs the other sinks (sinks.py) once for
+# the whole node.  With I2C_LOCK=1 the bus manager holds an flock on the
+# bus while it makes a call, so the workers never interleave their
+# transfers (busmgr.py).  A worker inherits nothing of the supervisor but
+# its pipe.
+#
+# Compensation inputs published by a sensor in another worker are read
+# from its legacy files, in the directory config.py gives for the sensor
+# named by inputs = (channel.Input), so keep those on, or put the sensors
+# that feed each other in one group.
+#
+import errno
+import fcntl
+import json
+import os
+import select
+import subprocess
+
+from . import clock
+from .channel import Channel
+from .hub import HUB
+
+RESTART_MIN = 0.25
+RESTART_MAX = 30.0
+STABLE_SECONDS = 60.0
+STOP_SECONDS = 5.0      # for workers to exit before they are killed
+READ_SIZE = 65536
+
+try:
+    MAXFD = os.sysconf("SC_OPEN_MAX")
+except (AttributeError, ValueError):
+    MAXFD = 256
+
+
+# for Popen(), the worker gets stdin, stdout, stderr and its pipe and none
+# of the sockets and files of the sinks here.  They are marked close on
+# exec rather than closed so Popen's own pipe for exec errors still works.
+def _keep_only(keep):
+    def close_others():
+        try:
+            fds = [ int(name) for name in os.listdir("/proc/self/fd") ]
+        except OSError:
+            fds = range(3, MAXFD)
+        for fd in fds:
+            if fd > 2 and fd != keep:
+                try:
+                    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+                except (IOError, OSError):
+                    pass
+    return close_others
+
+# ( group, [ sensor names ] ) in the order of the config
+def groups(sensors):
+    out = []
+    index = {}
+    for s in sensors:
+        if s.group not in index:
+            index[s.group] = len(out)
+            out.append( ( s.group, [] ) )
+        out[index[s.group]][1].append(s.name)
+    return out
+
+
+#-----------------------------------------------------------------------------
+# Worker side, hub sink writing to the supervisor's pipe
+#-----------------------------------------------------------------------------
+class ForwardSink:
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lines = []
+
+    def channel(self, ch):
+        self.lines.append( json.dumps([ ch.node, ch.name, ch.value, ch.stamp, ch.quantity ]) )
+
+    # every channel of the worker, before any is published
+    def declare(self, hub):
+        self._write( "".join([ json.dumps([ ch.node, ch.name, ch.quantity, ch.cadence ]) + "\n"
+                               for ch in hub.channels ]) )
+
+    def cycle(self, hub):
+        self.lines.append("")
+        data = "\n".join(self.lines) + "\n"
+        self.lines = []
+        self._write(data)
+
+    def _write(self, data):
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                # the supervisor is gone and nobody gets the values
+                print "supervisor: lost the supervisor, exiting"
+                os._exit(1)
+            raise
+
+
+#-----------------------------------------------------------------------------
+# Supervisor side, what the workers publish into this process' hub
+#-----------------------------------------------------------------------------
+class Relay:
+
+    def __init__(self, hub=HUB):
+        self.hub = hub
+        self.channels = {}     # "node/chan" -> Channel
+        self.partial = {}      # fd -> unfinished line
+        self.bad = 0           # lines that did not parse
+
+    def feed(self, fd, data):
+        lines = ( self.partial.pop(fd, "") + data ).split("\n")
+        if lines[-1]:
+            self.partial[fd] = lines[-1]
+        for line in lines[:-1]:
+            if not line:
+                self.hub.commit()
+                continue
+            try:
+                fields = json.loads(line)
+                if len(fields) == 4:
+                    node, name, quantity, cadence = fields
+                else:
+                    node, name, value, stamp, quantity = fields
+            except ValueError:
+                self.bad += 1
+                continue
+            ch = self._channel(node, name, quantity)
+            if len(fields) == 4:
+                # declared only
+                ch.cadence = cadence
+                continue
+            # as the worker published it, its time stamp included
+            ch.value = value
+            ch.stamp = stamp
+            ch.seq += 1
+            self.hub.publish(ch)
+
+    def _channel(self, node, name, quantity):
+        key = node + "/" + name
+        ch = self.channels.get(key)
+        if ch is None:
+            if quantity is not None:
+                quantity = str(quantity)
+            ch = Channel( "/tmp/" + str(node), str(name), windows=None, hub=self.hub,
+                          quantity=quantity )
+            self.channels[key] = ch
+        return ch
+
+
+#-----------------------------------------------------------------------------
+# One sensor group
+#-----------------------------------------------------------------------------
+class Worker:
+
+    def __init__(self, group, sensors):
+        self.group = group
+        self.sensors = sensors
+        self.proc = None
+        self.fd = None             # read end of its pipe
+        self.started = None
+        self.start_at = 0.0        # clock time to start it again
+        self.delay = RESTART_MIN   # before the next restart
+        self.restarts = 0
+
+
+#-----------------------------------------------------------------------------
+# Start, watch and restart the workers
+#-----------------------------------------------------------------------------
+class Supervisor:
+
+    def __init__(self, groups, argv, relay):
+        self.workers = [ Worker(group, sensors) for group, sensors in groups ]
+        self.argv = argv           # the worker command, sensd and its mode
+        self.relay = relay
+
+    def start(self, w):
+        rfd, wfd = os.pipe()
+        fcntl.fcntl(rfd, fcntl.F_SETFD, fcntl.fcntl(rfd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        env = dict(os.environ)
+        env["SENSD_WORKER"] = w.group
+        env["SENSD_PIPE"] = str(wfd)
+        env["I2C_LOCK"] = "1"
+        try:
+            w.proc = subprocess.Popen(self.argv, env=env, preexec_fn=_keep_only(wfd))
+        except OSError:
+            os.close(rfd)
+            os.close(wfd)
+            print "supervisor: can't start %s" % w.group
+            self._restart_later(w, clock.now())
+            return
+        # only the worker has the write end now, its exit is the end of the pipe
+        os.close(wfd)
+        w.fd = rfd
+        w.started = clock.now()
+
+    def _restart_later(self, w, now):
+        if w.started is not None and now - w.started >= STABLE_SECONDS:
+            w.delay = RESTART_MIN
+        w.start_at = now + w.delay
+        w.delay = min(w.delay * 2, RESTART_MAX)
+
+    #-----------------------------------------------------------------------------
+    # Read what the workers sent for up to timeout seconds, restart the dead
+    #-----------------------------------------------------------------------------
+    def step(self, timeout=0.1):
+        now = clock.now()
+        for w in self.workers:
+            if w.proc is None and now >= w.start_at:
+                self.start(w)
+
+        fds = [ w.fd for w in self.workers if w.fd is not None ]
+        ready = []
+        if fds:
+            try:
+                ready = select.select(fds, [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        else:
+            clock.sleep(timeout)
+
+        for w in self.workers:
+            if w.fd in ready:
+                data = os.read(w.fd, READ_SIZE)
+                if data:
+                    self.relay.feed(w.fd, data)
+                else:
+                    self.relay.partial.pop(w.fd, None)
+                    os.close(w.fd)
+                    w.fd = None
+            if w.proc is not None and w.proc.poll() is not None:
+                if w.fd is not None:
+                    # whatever it still wrote before it went
+                    continue
+                now = clock.now()
+                self._restart_later(w, now)
+                w.restarts += 1
+                print "supervisor: %s exited with %d after %.1fs, restarting in %.2fs" \
+                    % ( w.group, w.proc.returncode, now - w.started, w.start_at - now )
+                w.proc = None
+
+    #-----------------------------------------------------------------------------
+    # Stop every worker, killed if it does not exit in STOP_SECONDS
+    #-----------------------------------------------------------------------------
+    def stop(self):
+        running = [ w for w in self.workers if w.proc is not None ]
+        for w in running:
+            try:
+                w.proc.terminate()
+            except OSError:
+                pass
+        deadline = clock.now() + STOP_SECONDS
+        for w in running:
+            while w.proc.poll() is None and clock.now() < deadline:
+                clock.sleep(0.05)
+            if w.proc.poll() is None:
+                w.proc.kill()
+                w.proc.wait()
+            if w.fd is not None:
+                os.close(w.fd)
+                w.fd = None
+            w.proc = None
+
+    def report(self):
+        now = clock.now()
+        for w in self.workers:
+            state = "down"
+            if w.proc is not None:
+                state = "up %.0fs" % ( now - w.started )
+            print "supervisor: %s %s restarts: %d" % ( w.group, state, w.restarts )
+        if self.relay.bad:
+            print "supervisor: %d lines did not parse" % self.relay.bad
+
+#-----------------------------------------------------------------------------